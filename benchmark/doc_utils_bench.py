@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# summary: benchmark of field projection and $set conversion in doc_utils
+# usage: python -m benchmark.doc_utils_bench [-n N]
+
+import argparse
+import random
+import time
+from mongosync.doc_utils import gen_doc_with_fields, doc_flat_to_nested, merge_doc, \
+    FieldProjection, set_to_nested
+
+FIELDS = ['name', 'profile.age', 'profile.address.city', 'profile.address.zip', 'tags', 'stats.views',
+          'stats.likes', 'meta']
+
+
+def gen_doc(i):
+    """ Generate a nested document like a user profile.
+    """
+    return {'_id': i,
+            'name': 'user-%d' % i,
+            'email': 'user-%d@example.com' % i,
+            'profile': {'age': random.randint(18, 80),
+                        'bio': 'x' * 64,
+                        'address': {'city': 'city-%d' % (i % 100),
+                                    'street': 'street-%d' % i,
+                                    'zip': '%05d' % (i % 100000)}},
+            'tags': ['t%d' % j for j in xrange(5)],
+            'stats': {'views': i * 3, 'likes': i, 'shares': i / 2, 'history': [i] * 10},
+            'meta': {'created': i, 'updated': i}}
+
+
+def gen_set(i):
+    """ Generate $set of an update oplog.
+    """
+    return {'profile.age': i % 80,
+            'profile.address.city': 'city-%d' % i,
+            'profile.bio': 'y' * 64,
+            'stats.views': i * 4,
+            'stats.likes': i + 1,
+            'email': 'new-%d@example.com' % i}
+
+
+def old_set_to_nested(set_doc, fields):
+    doc = {}
+    for k, v in set_doc.iteritems():
+        if k in fields:
+            merge_doc(doc, doc_flat_to_nested(k.split('.'), v))
+    return doc
+
+
+def measure(name, func, items):
+    t = time.time()
+    for item in items:
+        func(item)
+    time_used = time.time() - t
+    print('%-32s %10.0f docs/s' % (name, len(items) / time_used))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of field projection and $set conversion.')
+    parser.add_argument('-n', type=int, default=100000, help='documents to process, default is 100000')
+    args = parser.parse_args()
+
+    docs = [gen_doc(i) for i in xrange(args.n)]
+    sets = [gen_set(i) for i in xrange(args.n)]
+    fields = frozenset(FIELDS)
+    projection = FieldProjection(FIELDS)
+
+    measure('gen_doc_with_fields', lambda doc: gen_doc_with_fields(doc, fields), docs)
+    measure('FieldProjection.project', projection.project, docs)
+    measure('doc_flat_to_nested + merge_doc', lambda set_doc: old_set_to_nested(set_doc, fields), sets)
+    measure('set_to_nested', lambda set_doc: set_to_nested(set_doc, projection), sets)
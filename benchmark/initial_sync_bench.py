@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# summary: benchmark of initial sync between local mongods with a sweep of settings
+# usage: python -m benchmark.initial_sync_bench [--src HOST:PORT] [--dst HOST:PORT] [--batch-size 1000,5000] ...
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+import uuid
+import pymongo
+from bson.objectid import ObjectId
+from mongosync.config import Config, MongoConfig
+from mongosync.logger import Logger
+from mongosync.mongo.syncer import MongoSyncer
+
+SRC_DBNAME = 'mongosync_bench_src'
+DST_DBNAME = 'mongosync_bench_dst'
+
+# (setting, config attribute, default values) swept by product
+SWEEP = [
+    ('collections', 'gevent_collections', '20'),
+    ('processes', 'gevent_processes', '8'),
+    ('batch_size', 'gevent_batch_size', '5000'),
+    ('batches', 'gevent_batches', '1'),
+    ('partition_batch_size', 'gevent_partition_batch_size', '100'),
+    ('partition_batches', 'gevent_partition_batches', '10'),
+]
+
+
+def gen_id(dist, i, rnd):
+    """ Generate _id of the i-th document.
+    """
+    if dist == 'objectid':
+        return ObjectId()
+    if dist == 'int':
+        return i
+    if dist == 'random_int':
+        return rnd.getrandbits(63)
+    if dist == 'uuid':
+        return uuid.UUID(int=rnd.getrandbits(128))
+    if dist == 'string':
+        return '%016x' % rnd.getrandbits(64)
+    raise Exception('invalid _id distribution: %s' % dist)
+
+
+def fill(client, n_colls, n_docs, doc_size, id_dist, seed):
+    """ Fill source database with collections of generated documents.
+    The database is kept if it's filled with the same parameters.
+    """
+    db = client[SRC_DBNAME]
+    params = {'_id': 'params', 'colls': n_colls, 'docs': n_docs, 'doc_size': doc_size, 'id_dist': id_dist,
+              'seed': seed}
+    if db['bench_params'].find_one({'_id': 'params'}) == params:
+        print('reuse source database %s' % SRC_DBNAME)
+        return
+    client.drop_database(SRC_DBNAME)
+    rnd = random.Random(seed)
+    payload = 'x' * doc_size
+    for i in xrange(n_colls):
+        coll = db['coll%d' % i]
+        t = time.time()
+        docs = []
+        for j in xrange(n_docs):
+            docs.append({'_id': gen_id(id_dist, j, rnd), 'n': j, 'payload': payload})
+            if len(docs) == 10000:
+                coll.insert_many(docs, ordered=False)
+                docs = []
+        if docs:
+            coll.insert_many(docs, ordered=False)
+        print('fill %s.coll%d with %d docs in %.1fs' % (SRC_DBNAME, i, n_docs, time.time() - t))
+    db['bench_params'].insert_one(params)
+
+
+def run_one(args, settings, res_q):
+    """ Run initial sync with settings in a new process, so that peak RSS is of this run only.
+    """
+    conf = Config()
+    conf.src_conf = MongoConfig(unicode(args.src), '', '', '', False)
+    conf.dst_conf = MongoConfig(unicode(args.dst), '', '', '', False)
+    for i in xrange(args.colls):
+        conf.data_filter.add_include_coll('%s.coll%d' % (SRC_DBNAME, i))
+    conf.dbmap[SRC_DBNAME] = DST_DBNAME
+    conf.gevent_large_collection_docs = args.large_collection_docs
+    for name, attr, _ in SWEEP:
+        setattr(conf, attr, settings[name])
+
+    syncer = MongoSyncer(conf)
+    t = time.time()
+    syncer._initial_sync()
+    secs = time.time() - t
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    res_q.put((secs, max(self_rss, children_rss) / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of initial sync with a sweep of settings.')
+    parser.add_argument('--src', default='localhost:27017', help='host:port of source mongod')
+    parser.add_argument('--dst', default='localhost:27017',
+                        help='host:port of destination mongod, database %s is dropped before each run' % DST_DBNAME)
+    parser.add_argument('--colls', type=int, default=4, help='collections, default is 4')
+    parser.add_argument('--docs', type=int, default=200000, help='documents per collection, default is 200000')
+    parser.add_argument('--doc-size', type=int, default=512, help='payload bytes of a document, default is 512')
+    parser.add_argument('--id-dist', choices=('objectid', 'int', 'random_int', 'uuid', 'string'), default='objectid',
+                        help='_id distribution, default is objectid')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, default is 1')
+    parser.add_argument('--large-collection-docs', type=int, default=100000,
+                        help='collections with more documents are copied by processes, default is 100000')
+    for name, _, default in SWEEP:
+        parser.add_argument('--%s' % name.replace('_', '-'), default=default,
+                            help='comma separated values of sync.gevent.%s to sweep, default is %s' % (name, default))
+    parser.add_argument('-o', '--output', default='initial_sync_bench.json', help='JSON result file')
+    parser.add_argument('--log', default='initial_sync_bench.log', help='log file of syncer')
+    args = parser.parse_args()
+
+    Logger.init(args.log)
+    src = pymongo.MongoClient('mongodb://%s' % args.src)
+    dst = pymongo.MongoClient('mongodb://%s' % args.dst)
+    fill(src, args.colls, args.docs, args.doc_size, args.id_dist, args.seed)
+    collstats = [src[SRC_DBNAME].command('collstats', 'coll%d' % i) for i in xrange(args.colls)]
+    n_docs = sum(stats['count'] for stats in collstats)
+    n_bytes = sum(stats['size'] for stats in collstats)
+
+    names = [name for name, _, _ in SWEEP]
+    values = [[int(v) for v in getattr(args, name).split(',')] for name in names]
+    results = []
+    for combination in itertools.product(*values):
+        settings = dict(zip(names, combination))
+        dst.drop_database(DST_DBNAME)
+        res_q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_one, args=(args, settings, res_q))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            print('%s failed with exit code %d' % (settings, p.exitcode))
+            continue
+        secs, peak_rss_mb = res_q.get()
+        n_synced = sum(dst[DST_DBNAME]['coll%d' % i].count() for i in xrange(args.colls))
+        result = {'settings': settings,
+                  'docs': n_docs,
+                  'synced_docs': n_synced,
+                  'seconds': round(secs, 3),
+                  'docs_per_second': round(n_docs / secs, 1),
+                  'mb_per_second': round(float(n_bytes) / 1024 / 1024 / secs, 2),
+                  'peak_rss_mb': round(peak_rss_mb, 1)}
+        results.append(result)
+        print(json.dumps(result, sort_keys=True))
+        if n_synced != n_docs:
+            print('warning: %d docs synced, expect %d' % (n_synced, n_docs))
+
+    report = {'workload': {'colls': args.colls, 'docs': args.docs, 'doc_size': args.doc_size, 'id_dist': args.id_dist,
+                           'seed': args.seed, 'large_collection_docs': args.large_collection_docs,
+                           'bytes': n_bytes},
+              'results': sorted(results, key=lambda r: r['docs_per_second'], reverse=True)}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('write results into %s' % args.output)
+    dst.drop_database(DST_DBNAME)
+    return 0 if results else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
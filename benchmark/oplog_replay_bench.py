@@ -0,0 +1,303 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# summary: benchmark of oplog replay with synthetic oplogs
+# usage: python -m benchmark.oplog_replay_bench [-n N] [--mix i=60,u=30,d=8,c=2] [--target fake|mongod]
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import collections
+import gc
+import os
+import random
+import resource
+import time
+import gevent
+from bson.timestamp import Timestamp
+from mongosync.config import Config, MongoConfig
+from mongosync.mongo.syncer import MongoSyncer
+from mongosync.mongo.handler import MongoHandler
+from mongosync.multi_oplog_replayer import MultiOplogReplayer
+from mongosync.common_syncer import CommonSyncer, Stage
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DBNAME = 'mongosync_bench'
+
+
+def parse_mix(s):
+    """ Parse op mix like 'i=60,u=30,d=8,c=2' into [(op, weight)].
+    """
+    mix = []
+    for item in s.split(','):
+        op, weight = item.split('=')
+        if op not in ('i', 'u', 'd', 'c'):
+            raise Exception('invalid op in mix: %s' % op)
+        mix.append((op, float(weight)))
+    return mix
+
+
+def gen_oplogs(n, mix, n_namespaces, doc_size, hot_keys, hot_ratio, seed):
+    """ Generate a stream of n oplogs after a no-op at the start optime.
+
+    Updates and deletes pick hot documents, the first hot_keys fraction of live documents,
+    with probability hot_ratio.
+    Return (start optime, oplogs).
+    """
+    rnd = random.Random(seed)
+    namespaces = ['%s.coll%d' % (DBNAME, i) for i in xrange(n_namespaces)]
+    live_ids = [[] for _ in namespaces]
+    next_ids = [0] * n_namespaces
+    ops, weights = zip(*mix)
+    total_weight = sum(weights)
+    payload = 'x' * doc_size
+
+    t = int(time.time())
+    start_optime = Timestamp(t, 1)
+    oplogs = [{'ts': start_optime, 'op': 'n', 'ns': '', 'o': {'msg': 'benchmark'}}]
+    for i in xrange(n):
+        ts = Timestamp(t + (i + 2) / 10000, (i + 2) % 10000 + 1)
+        k = rnd.randrange(n_namespaces)
+        ns = namespaces[k]
+        ids = live_ids[k]
+
+        r = rnd.random() * total_weight
+        for op, weight in zip(ops, weights):
+            if r < weight:
+                break
+            r -= weight
+        if op in ('u', 'd') and not ids:
+            op = 'i'
+
+        if op == 'i':
+            _id = next_ids[k]
+            next_ids[k] += 1
+            ids.append(_id)
+            oplogs.append({'ts': ts, 'op': 'i', 'ns': ns, 'o': {'_id': _id, 'n': i, 'payload': payload}})
+        elif op in ('u', 'd'):
+            n_hot = max(1, int(len(ids) * hot_keys))
+            pos = rnd.randrange(n_hot) if rnd.random() < hot_ratio else rnd.randrange(len(ids))
+            _id = ids[pos]
+            if op == 'u':
+                oplogs.append({'ts': ts, 'op': 'u', 'ns': ns, 'o2': {'_id': _id},
+                               'o': {'$v': 1, '$set': {'n': i}}})
+            else:
+                ids[pos] = ids[-1]
+                ids.pop()
+                oplogs.append({'ts': ts, 'op': 'd', 'ns': ns, 'o': {'_id': _id}})
+        else:
+            oplogs.append({'ts': ts, 'op': 'c', 'ns': '%s.$cmd' % DBNAME, 'o': {'collMod': ns.split('.', 1)[1]}})
+    return start_optime, oplogs
+
+
+class RecordingHandler(MongoHandler):
+    """ MongoHandler that records writes instead of sending them, optionally with latency per request.
+    """
+    def __init__(self, latency=0):
+        MongoHandler.__init__(self, MongoConfig(u'recording:0', '', '', '', False))
+        self._latency = latency
+        self.n_requests = 0
+        self.reqs = collections.Counter()  # request type => count
+
+    def _record(self, reqs):
+        self.n_requests += 1
+        for req in reqs:
+            self.reqs[type(req).__name__] += 1
+        if self._latency:
+            gevent.sleep(self._latency)
+
+    def bulk_write(self, dbname, collname, reqs, ordered=True, ignore_duplicate_key_error=False, print_log=False):
+        self._record(reqs)
+
+    def bulk_insert(self, dbname, collname, reqs, print_log=False):
+        self._record(reqs)
+
+    def apply_oplog(self, oplog, ignore_duplicate_key_error=False, print_log=False):
+        self.n_requests += 1
+        self.reqs['command'] += 1
+
+
+class _Done(Exception):
+    pass
+
+
+class _Cursor(object):
+    """ Cursor over synthetic oplogs, which raises StopIteration once at the end like a tailable cursor
+    with nothing new, then _Done to stop the replay loop.
+    """
+    def __init__(self, oplogs):
+        self._it = iter(oplogs)
+        self._stopped = False
+        self.alive = True
+
+    def next(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            if self._stopped:
+                raise _Done()
+            self._stopped = True
+            raise
+
+
+class _Client(object):
+    address = ('synthetic', 0)
+
+
+class SyntheticSource(object):
+    """ Source handler that tails synthetic oplogs.
+    """
+    def __init__(self, oplogs):
+        self._oplogs = oplogs
+
+    def client(self):
+        return _Client()
+
+    def tail_oplog(self, start_optime=None, await_time_ms=None):
+        return _Cursor(self._oplogs)
+
+    def reconnect(self):
+        pass
+
+
+class BenchSyncer(MongoSyncer):
+    """ MongoSyncer replaying oplogs from a given source into a given destination without connecting.
+    """
+    def __init__(self, conf, src, dst):
+        CommonSyncer.__init__(self, conf)
+        self._src = src
+        self._dst = dst
+        self._multi_oplog_replayer = MultiOplogReplayer(self._dst, 10, memory=self._memory)
+        self._verifier = None
+        self._verifier_greenlet = None
+        self._stage = Stage.oplog_sync
+        self.log_interval = 3600
+
+
+def replay_with_replayer(oplogs, handler, batch_size=1000):
+    """ Push oplogs into MultiOplogReplayer and apply them in batches, as replay loop does in oplog_sync stage.
+    """
+    replayer = MultiOplogReplayer(handler, 10)
+    for oplog in oplogs:
+        if oplog['op'] == 'n':
+            continue
+        if oplog['op'] == 'c':
+            replayer.apply(plain_insert=True)
+            replayer.clear()
+            handler.apply_oplog(oplog)
+            continue
+        replayer.push(oplog)
+        if replayer.count() >= batch_size:
+            replayer.apply(plain_insert=True)
+            replayer.clear()
+    if replayer.count() > 0:
+        replayer.apply(plain_insert=True)
+        replayer.clear()
+
+
+def replay_with_syncer(start_optime, oplogs, handler):
+    """ Replay oplogs by MongoSyncer._replay_oplog until the end of stream.
+    """
+    conf = Config()
+    conf.src_conf = MongoConfig(u'synthetic:0', '', '', '', False)
+    conf.dst_conf = handler._conf
+    syncer = BenchSyncer(conf, SyntheticSource(oplogs), handler)
+    try:
+        syncer._replay_oplog(start_optime)
+    except _Done:
+        pass
+
+
+class AllocCounter(object):
+    """ Count allocations during a run.
+
+    Traced blocks and peak bytes are counted by tracemalloc if available.
+    Otherwise only objects tracked by gc that are still alive after the run are counted.
+    """
+    def start(self):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        self._n_objects = len(gc.get_objects())
+
+    def stop(self):
+        if tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            n_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+            tracemalloc.stop()
+            return 'peak %.1fMB traced, %d blocks alive' % (float(peak) / 1024 / 1024, n_blocks)
+        gc.collect()
+        return '%+d gc objects alive' % (len(gc.get_objects()) - self._n_objects)
+
+
+def measure(name, n_ops, func):
+    alloc_counter = AllocCounter()
+    alloc_counter.start()
+    t0 = time.time()
+    c0 = os.times()
+    func()
+    c1 = os.times()
+    time_used = time.time() - t0
+    cpu_used = (c1[0] - c0[0]) + (c1[1] - c0[1])
+    allocs = alloc_counter.stop()
+    print('%-32s %10.0f ops/s %8.1f us cpu/op   %s' % (name, n_ops / time_used, cpu_used / n_ops * 1000000, allocs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of oplog replay with synthetic oplogs.')
+    parser.add_argument('-n', type=int, default=100000, help='oplogs to replay, default is 100000')
+    parser.add_argument('--mix', default='i=60,u=30,d=8,c=2',
+                        help='weights of insert, update, delete and command, default is i=60,u=30,d=8,c=2')
+    parser.add_argument('--namespaces', type=int, default=10, help='collections, default is 10')
+    parser.add_argument('--doc-size', type=int, default=256, help='payload bytes of inserted documents, default is 256')
+    parser.add_argument('--hot-keys', type=float, default=0.01,
+                        help='fraction of documents that are hot, default is 0.01')
+    parser.add_argument('--hot-ratio', type=float, default=0.8,
+                        help='fraction of updates and deletes on hot documents, default is 0.8')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, default is 1')
+    parser.add_argument('--target', choices=('fake', 'mongod'), default='fake',
+                        help='replay into a recording fake handler or a mongod, default is fake')
+    parser.add_argument('--mongod', default='localhost:27017',
+                        help='host:port of mongod for target mongod, database %s is dropped' % DBNAME)
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency of a request to fake handler')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    gen_args = (args.n, mix, args.namespaces, args.doc_size, args.hot_keys, args.hot_ratio, args.seed)
+
+    def new_handler():
+        if args.target == 'fake':
+            return RecordingHandler(args.latency_ms / 1000.0)
+        handler = MongoHandler(MongoConfig(unicode(args.mongod), '', '', '', False))
+        if not handler.connect():
+            raise Exception('connect to mongod failed: %s' % args.mongod)
+        handler.client().drop_database(DBNAME)
+        return handler
+
+    print('%d oplogs, mix %s, %d namespaces, %d bytes payload, %.0f%% of updates and deletes on %.1f%% keys, '
+          'target %s' % (args.n, args.mix, args.namespaces, args.doc_size, args.hot_ratio * 100,
+                         args.hot_keys * 100, args.target))
+
+    # oplogs are modified by replay, so generate a stream for each run
+    start_optime, oplogs = gen_oplogs(*gen_args)
+    handler = new_handler()
+    measure('MultiOplogReplayer', args.n, lambda: replay_with_replayer(oplogs, handler))
+    if isinstance(handler, RecordingHandler):
+        print('    %d requests: %s' % (handler.n_requests, ', '.join('%s %d' % item for item in handler.reqs.most_common())))
+
+    start_optime, oplogs = gen_oplogs(*gen_args)
+    handler = new_handler()
+    measure('MongoSyncer._replay_oplog', args.n, lambda: replay_with_syncer(start_optime, oplogs, handler))
+    if isinstance(handler, RecordingHandler):
+        print('    %d requests: %s' % (handler.n_requests, ', '.join('%s %d' % item for item in handler.reqs.most_common())))
+
+    print('peak rss %.1fMB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
+from gevent import monkey
+monkey.patch_all()
+
 import sys
+import time
 import pymongo
 from mongosync.command_options import CheckCommandOptions
+from mongosync.range_checksum import RangeChecker, dump_ranges
 
 
 def connect(uri):
@@ -49,6 +54,8 @@ if __name__ == '__main__':
     print('dbs    :  %s' % conf.dbs)
     print('src db :  %s' % conf.src_db)
     print('dst db :  %s' % conf.dst_db)
+    if conf.ranges:
+        print('ranges :  %d partitions, %d concurrency' % (conf.partitions, conf.concurrency))
     print('=' * 48)
 
     src_mc = connect(conf.src_uri)
@@ -70,32 +77,64 @@ if __name__ == '__main__':
 
     # check data
     data_pass = True
-    print('-' * 88)
-    print('%s%s%s%s' % ('RESULT'.ljust(8), 'COLL'.ljust(48), 'ORIGIN'.rjust(16), 'TARGET'.rjust(16)))
-    print('-' * 88)
-    for dbname in sorted(src_mc.database_names()):
-        if dbname in ignore_dbs:
-            continue
-        if dbname not in conf.dbs:
-            continue
-        for collname in sorted(src_mc[dbname].collection_names(include_system_collections=False)):
-            if collname in ignore_colls:
+    if conf.ranges:
+        colls = []
+        for dbname in sorted(src_mc.database_names()):
+            if dbname in ignore_dbs:
                 continue
-            if rename_db_mode:
-                assert dbname == conf.src_db
-                ddb = conf.dst_db
-            else:
-                ddb = dbname
-            src_coll_cnt = src_mc[dbname][collname].count()
-            dst_coll_cnt = dst_mc[ddb][collname].count()
-            if src_coll_cnt == dst_coll_cnt:
-                res = 'OK'
-                info('%s%s%s%s' % (res.ljust(8), (dbname + '.' + collname).ljust(48), str(src_coll_cnt).rjust(16), str(dst_coll_cnt).rjust(16)))
+            if dbname not in conf.dbs:
+                continue
+            for collname in sorted(src_mc[dbname].collection_names(include_system_collections=False)):
+                if collname in ignore_colls:
+                    continue
+                ddb = conf.dst_db if rename_db_mode else dbname
+                colls.append((dbname, collname, ddb))
+        t = time.time()
+        results = RangeChecker(src_mc, dst_mc, conf.partitions, conf.concurrency).check_colls(colls)
+        print('-' * 88)
+        print('%s%s%s%s' % ('RESULT'.ljust(8), 'COLL'.ljust(48), 'RANGES'.rjust(16), 'MISMATCHED'.rjust(16)))
+        print('-' * 88)
+        for dbname, collname, ddb in colls:
+            ns = dbname + '.' + collname
+            coll_results = [r for r in results if r['ns'] == ns]
+            n_mismatched = len([r for r in coll_results if not r['match']])
+            if n_mismatched == 0:
+                info('%s%s%s%s' % ('OK'.ljust(8), ns.ljust(48), str(len(coll_results)).rjust(16), str(n_mismatched).rjust(16)))
             else:
-                res = 'ERR'
                 data_pass = False
-                warn('%s%s%s%s' % (res.ljust(8), (dbname + '.' + collname).ljust(48), str(src_coll_cnt).rjust(16), str(dst_coll_cnt).rjust(16)))
-    print('-' * 96)
+                warn('%s%s%s%s' % ('ERR'.ljust(8), ns.ljust(48), str(len(coll_results)).rjust(16), str(n_mismatched).rjust(16)))
+        print('-' * 88)
+        mismatched = [r for r in results if not r['match']]
+        dump_ranges(mismatched, conf.output)
+        info('%d ranges checked in %.1fs, %d mismatched ranges written into %s' % (
+            len(results), time.time() - t, len(mismatched), conf.output))
+    else:
+        print('-' * 88)
+        print('%s%s%s%s' % ('RESULT'.ljust(8), 'COLL'.ljust(48), 'ORIGIN'.rjust(16), 'TARGET'.rjust(16)))
+        print('-' * 88)
+        for dbname in sorted(src_mc.database_names()):
+            if dbname in ignore_dbs:
+                continue
+            if dbname not in conf.dbs:
+                continue
+            for collname in sorted(src_mc[dbname].collection_names(include_system_collections=False)):
+                if collname in ignore_colls:
+                    continue
+                if rename_db_mode:
+                    assert dbname == conf.src_db
+                    ddb = conf.dst_db
+                else:
+                    ddb = dbname
+                src_coll_cnt = src_mc[dbname][collname].count()
+                dst_coll_cnt = dst_mc[ddb][collname].count()
+                if src_coll_cnt == dst_coll_cnt:
+                    res = 'OK'
+                    info('%s%s%s%s' % (res.ljust(8), (dbname + '.' + collname).ljust(48), str(src_coll_cnt).rjust(16), str(dst_coll_cnt).rjust(16)))
+                else:
+                    res = 'ERR'
+                    data_pass = False
+                    warn('%s%s%s%s' % (res.ljust(8), (dbname + '.' + collname).ljust(48), str(src_coll_cnt).rjust(16), str(dst_coll_cnt).rjust(16)))
+        print('-' * 96)
 
     # check index
     index_pass = True
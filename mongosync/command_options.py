@@ -2,9 +2,9 @@ import re
 import sys
 import argparse
 from bson.timestamp import Timestamp
-from mongosync.config import Config, CheckConfig
+from mongosync.config import Config, CheckConfig, RepairConfig
 from mongosync.config_file import ConfigFile
-from mongosync.mongo_utils import parse_hostportstr
+from mongosync.mongo_utils import parse_hostportstr, READ_PREFERENCE_MODES
 from mongosync.optime_logger import OptimeLogger
 
 
@@ -23,6 +23,7 @@ class CommandOptions(object):
         parser.add_argument('--src-authdb', nargs='?', required=False, help="src authentication database, default is 'admin'")
         parser.add_argument('--src-username', nargs='?', required=False, help='src username')
         parser.add_argument('--src-password', nargs='?', required=False, help='src password')
+        parser.add_argument('--src-read-preference', nargs='?', required=False, help="src read preference, default is 'primary'")
         parser.add_argument('--dst', nargs='?', required=False, help='destination should be hostportstr of a mongos or mongod instance')
         parser.add_argument('--dst-authdb', nargs='?', required=False, help="dst authentication database, default is 'admin', for MongoDB")
         parser.add_argument('--dst-username', nargs='?', required=False, help='dst username, for MongoDB')
@@ -30,6 +31,8 @@ class CommandOptions(object):
         parser.add_argument('--start-optime', type=str, nargs='?', required=False, help='timestamp in format second,<num>, indicates oplog based increment sync')
         parser.add_argument('--optime-logfile', nargs='?', required=False, help="optime log file path, use this as start optime if without '--start-optime'")
         parser.add_argument('--logfile', nargs='?', required=False, help='log file path')
+        parser.add_argument('--engine', nargs='?', choices=['gevent', 'pipeline'], required=False, help="initial sync engine for MongoDB, default is 'gevent'")
+        parser.add_argument('--metrics-port', type=int, nargs='?', required=False, help='port of metrics endpoint, disabled if 0')
 
         args = parser.parse_args()
 
@@ -43,6 +46,10 @@ class CommandOptions(object):
             conf.src_conf.username = args.src_username
         if args.src_password is not None:
             conf.src_conf.password = args.src_password
+        if args.src_read_preference is not None:
+            if args.src_read_preference not in READ_PREFERENCE_MODES:
+                raise RuntimeError('Bad read preference for src: "%s"' % args.src_read_preference)
+            conf.src_conf.read_preference = args.src_read_preference
         if args.dst is not None:
             conf.dst_conf.hosts = args.dst
         if args.dst_authdb is not None:
@@ -63,6 +70,10 @@ class CommandOptions(object):
                 conf.start_optime = optime_logger.read()
         if args.logfile is not None:
             conf.logfilepath = args.logfile
+        if args.engine is not None:
+            conf.engine = args.engine
+        if args.metrics_port is not None:
+            conf.metrics_port = args.metrics_port
 
         return conf
 
@@ -80,6 +91,10 @@ class CheckCommandOptions(object):
         parser.add_argument('--dbs', nargs='+', required=False, help='databases to check')
         parser.add_argument('--src-db', nargs='?', required=False, help="database to check in origin, work with '--dst-db', conflicts with '--dbs'")
         parser.add_argument('--dst-db', nargs='?', required=False, help="database to check in target, work with '--src-db', conflicts with '--dbs'")
+        parser.add_argument('--ranges', action='store_true', help='compare checksums of _id ranges instead of counts')
+        parser.add_argument('--partitions', type=int, default=16, help='_id ranges per collection with --ranges, default is 16')
+        parser.add_argument('--concurrency', type=int, default=16, help='ranges checked concurrently with --ranges, default is 16')
+        parser.add_argument('--output', nargs='?', default='mismatched_ranges.json', help='JSON file of mismatched ranges with --ranges, default is mismatched_ranges.json')
 
         args = vars(parser.parse_args())
 
@@ -92,6 +107,10 @@ class CheckCommandOptions(object):
             conf.src_db = args['src_db']
         if args['dst_db'] is not None:
             conf.dst_db = args['dst_db']
+        conf.ranges = args['ranges']
+        conf.partitions = args['partitions']
+        conf.concurrency = args['concurrency']
+        conf.output = args['output']
 
         if conf.dbs and (conf.src_db or conf.dst_db):
             print("Terminated, conflict command options found")
@@ -104,3 +123,38 @@ class CheckCommandOptions(object):
             sys.exit(1)
 
         return conf
+
+
+class RepairCommandOptions(object):
+    """ Repair command options.
+    """
+    @staticmethod
+    def parse():
+        """ Parse command options and generate config.
+        """
+        parser = argparse.ArgumentParser(description='Repair mismatched _id ranges found by check.py --ranges.')
+        parser.add_argument('-f', '--config', nargs='?', required=True, help='configuration file of sync, for source and destination')
+        parser.add_argument('--ranges', nargs='?', required=True, help='JSON file of mismatched ranges written by check.py --ranges')
+        parser.add_argument('--leaf-docs', type=int, default=1000, help='narrow ranges down to this many documents, then compare documents one by one, default is 1000')
+        parser.add_argument('--concurrency', type=int, default=8, help='ranges repaired concurrently, default is 8')
+        parser.add_argument('--rounds', type=int, default=5, help='rounds of copy and verify of a document, default is 5')
+        parser.add_argument('--settle', type=int, default=5, help='seconds to wait before verify if without optime log file, default is 5')
+        parser.add_argument('--optime-logfile', nargs='?', required=False, help='optime log file of the running sync, verify repaired documents after replay passes the source optime')
+        parser.add_argument('--dry-run', action='store_true', help='only log differing documents')
+        parser.add_argument('--logfile', nargs='?', required=False, help='log file path')
+
+        args = parser.parse_args()
+
+        conf = RepairConfig()
+        conf.sync_conf = ConfigFile.load(args.config)
+        conf.ranges_filepath = args.ranges
+        conf.leaf_docs = args.leaf_docs
+        conf.concurrency = args.concurrency
+        conf.rounds = args.rounds
+        conf.settle = args.settle
+        conf.dry_run = args.dry_run
+        if args.optime_logfile is not None:
+            conf.optime_logfilepath = args.optime_logfile
+        if args.logfile is not None:
+            conf.logfilepath = args.logfile
+        return conf
@@ -3,11 +3,15 @@ import time
 import datetime
 import exceptions
 import gevent
+from mongosync import metrics
 from mongosync.config import Config
 from mongosync.logger import Logger
-from mongosync.mongo_utils import get_optime
+from mongosync.memory import MemoryAccount
+from mongosync.mongo.handler import MemberUnreachable
+from mongosync.mongo_utils import get_optime, split_coll
 from mongosync.optime_logger import OptimeLogger
-from mongosync.progress_logger import LoggerThread
+from mongosync.progress_logger import ProgressLogger
+from mongosync.tracing import Tracer
 from pymongo import errors
 import pymongo
 from gevent import pool
@@ -50,16 +54,18 @@ class CommonSyncer(object):
             self._optime_logger = OptimeLogger(conf.optime_logfilepath)
         else:
             self._optime_logger = None
-        self._optime_log_interval = 10  # default 10s
+        self._optime_log_interval = 10  # default 10s, checkpoint is written on every call but logged periodically
         self._last_optime = None  # optime of the last oplog was applied
+        self._applied_optime = None  # optime that all oplogs before are applied, as checkpointed
         self._last_optime_logtime = time.time()
+        self._last_checkpoint_time = 0
 
         self._log_interval = 2  # default 2s
         self._last_logtime = time.time()  # use in oplog replay
 
         # for large collections
-        self._n_workers = 8  # multi-process
-        self._large_coll_docs = 1000000  # 100w
+        self._n_workers = conf.gevent_processes  # multi-process
+        self._large_coll_docs = conf.gevent_large_collection_docs
 
         self._initial_sync_start_optime = None
         self._initial_sync_end_optime = None
@@ -67,6 +73,12 @@ class CommonSyncer(object):
         self._stage = Stage.stopped
         self._oplog_batchsize = 1000
 
+        # documents buffered in memory
+        self._memory = MemoryAccount(conf.memory_budget_mb)
+        self._tracer = Tracer(conf.trace_sample_every)
+        self._last_memory_logtime = 0
+        metrics.REPLAY_LAG.labels().set_function(self._replay_lag)
+
     @property
     def from_to(self):
         return "%s => %s" % (self._conf.src_hostportstr, self._conf.dst_hostportstr)
@@ -90,11 +102,19 @@ class CommonSyncer(object):
             self._sync()
         except exceptions.KeyboardInterrupt:
             log.info('keyboard interrupt')
+        except MemberUnreachable as e:
+            log.error('%s' % e)
+            sys.exit(1)
 
     def _sync(self):
         """ Sync databases and oplog.
         """
-        if self._conf.start_optime:
+        checkpoint = self._optime_logger.read_checkpoint() if self._optime_logger else None
+        if checkpoint and checkpoint.optime != self._conf.start_optime:
+            checkpoint = None  # start optime is specified explicitly
+        if checkpoint and checkpoint.stage == Stage.initial_sync:
+            log.info('initial sync was not done, start over')
+        elif self._conf.start_optime:
             log.info("locating oplog, it will take a while")
             doc = self._src.client()['local']['oplog.rs'].find_one({'ts': {'$gte': self._conf.start_optime}})
             if not doc:
@@ -102,24 +122,33 @@ class CommonSyncer(object):
                 return
             start_optime = doc['ts']
             log.info('start timestamp is %s actually' % start_optime)
-            self._stage = Stage.oplog_sync
+            if checkpoint and checkpoint.stage == Stage.post_initial_sync:
+                # resume catching up oplogs of initial sync
+                log.info('resume stage: post_initial_sync until %s' % checkpoint.end_optime)
+                self._stage = Stage.post_initial_sync
+                self._initial_sync_end_optime = checkpoint.end_optime
+            else:
+                self._stage = Stage.oplog_sync
             self._replay_oplog(start_optime)
-        else:
-            # initial sync
-            log.info('step into stage: initial_sync')
-            self._initial_sync_start_optime = get_optime(self._src.client())
-            self._stage = Stage.initial_sync
-            self._initial_sync()
-
-            # markup post initial sync
-            log.info('step into stage: post_initial_sync')
-            self._stage = Stage.post_initial_sync
-            self._initial_sync_end_optime = get_optime(self._src.client())
-
-            # oplog sync
-            if self._optime_logger:
-                self._optime_logger.write(self._initial_sync_start_optime)
-            self._replay_oplog(self._initial_sync_start_optime)
+            return
+
+        # initial sync
+        log.info('step into stage: initial_sync')
+        self._initial_sync_start_optime = get_optime(self._src.client(), self_member=self._src.pinned)
+        self._stage = Stage.initial_sync
+        if self._optime_logger:
+            self._optime_logger.write(self._initial_sync_start_optime, self._stage)
+        self._initial_sync()
+
+        # markup post initial sync
+        log.info('step into stage: post_initial_sync')
+        self._stage = Stage.post_initial_sync
+        self._initial_sync_end_optime = get_optime(self._src.client(), self_member=self._src.pinned)
+
+        # oplog sync
+        if self._optime_logger:
+            self._optime_logger.write(self._initial_sync_start_optime, self._stage, self._initial_sync_end_optime)
+        self._replay_oplog(self._initial_sync_start_optime)
 
     def _collect_colls(self):
         """ Collect collections to sync.
@@ -140,48 +169,17 @@ class CommonSyncer(object):
 
     def _split_coll(self, namespace_tuple, n_partitions):
         """ Split a collection into n partitions.
-
         Return a list of split points.
-
-        splitPointCount = partitionCount - 1
-        splitPointCount = keyTotalCount / (keyCount + 1)
-        keyCount = maxChunkSize / (2 * avgObjSize)
-        =>
-        maxChunkSize = (keyTotalCount / (partionCount - 1) - 1) * 2 * avgObjSize
-
-        Note: maxChunkObjects is default 250000.
         """
-        if n_partitions <= 1:
-            raise RuntimeError('n_partitions need greater than 1, but %s' % n_partitions)
-
         dbname, collname = namespace_tuple
-        ns = '.'.join(namespace_tuple)
-        db = self._src.client()[dbname]
-        collstats = db.command('collstats', collname)
-
-        if 'avgObjSize' not in collstats:  # empty collection
-            return []
-
-        n_points = n_partitions - 1
-        max_chunk_size = ((collstats['count'] / (n_partitions - 1) - 1) * 2 * collstats['avgObjSize']) / 1024 / 1024
-
-        if max_chunk_size <= 0:
-            return []
-
         try:
-            res = db.command('splitVector', ns, keyPattern={'_id': 1}, maxSplitPoints=n_points,
-                             maxChunkSize=max_chunk_size, maxChunkObjects=collstats['count'])
+            return split_coll(self._src.client()[dbname], collname, n_partitions)
         except pymongo.errors.OperationFailure as e:
             if e.details.get('codeName') == u'Unauthorized':
-                log.warn("Can't run splitVector command on %s: consider to give clusterManager role to a user" % ns)
-                res = {'ok': 0}
-            else:
-                raise e
-
-        if res['ok'] != 1:
-            return []
-        else:
-            return [doc['_id'] for doc in res['splitKeys']]
+                log.warn("Can't run splitVector command on %s.%s: consider to give clusterManager role to a user" % (
+                    dbname, collname))
+                return []
+            raise e
 
     def _initial_sync(self):
         """ Initial sync.
@@ -190,6 +188,7 @@ class CommonSyncer(object):
         def classify(ns_tuple, large_colls, small_colls):
             """ Find out large and small collections.
             """
+            self._register_progress(ns_tuple)
             if self._is_large_collection(ns_tuple):
                 points = self._split_coll(ns_tuple, self._n_workers)
                 if points:
@@ -202,8 +201,10 @@ class CommonSyncer(object):
         large_colls = []
         small_colls = []
 
-        pool = gevent.pool.Pool(8)
         colls = self._collect_colls()
+        self._progress_logger = ProgressLogger(len(colls))
+
+        pool = gevent.pool.Pool(8)
         for ns in colls:
             dbname, collname = ns
             log.info('%d\t%s.%s' % (self._src.client()[dbname][collname].count(), dbname, collname))
@@ -216,12 +217,10 @@ class CommonSyncer(object):
         log.info('large collections: %s' % ['.'.join(ns) for ns, points in large_colls])
         log.info('small collections: %s' % ['.'.join(ns) for ns in small_colls])
 
-        # create progress logger
-        self._progress_logger = LoggerThread(len(colls))
         self._progress_logger.start()
 
         # small collections first
-        pool = gevent.pool.Pool(20)
+        pool = gevent.pool.Pool(self._conf.gevent_collections)
         for res in pool.imap(self._sync_collection, small_colls):
             if res is not None:
                 sys.exit(1)
@@ -230,6 +229,35 @@ class CommonSyncer(object):
         for ns, points in large_colls:
             self._sync_large_collection(ns, points)
 
+    def _register_progress(self, namespace_tuple):
+        """ Register collection to progress logger.
+        Counters are in shared memory, so it must be called before forking processes for large collections.
+        """
+        dbname, collname = namespace_tuple
+        collstats = self._src.client()[dbname].command('collstats', collname)
+        self._progress_logger.register('.'.join(namespace_tuple), collstats.get('count', 0),
+                                       collstats.get('avgObjSize', 0))
+
+    def _wait_memory(self):
+        """ Wait until documents buffered by all greenlets and processes are within the memory budget.
+        """
+        while self._memory.over_budget():
+            now = time.time()
+            if now - self._last_memory_logtime >= self._log_interval:
+                self._last_memory_logtime = now
+                log.warn('memory budget %.1fMB exceeded, %.1fMB buffered, wait for buffers to drain: %s' % (
+                    float(self._memory.budget) / 1024 / 1024,
+                    float(self._memory.total) / 1024 / 1024,
+                    self._memory.summary()))
+            gevent.sleep(0.1)
+
+    def _replay_lag(self):
+        """ Return seconds between now and the optime of the last applied oplog.
+        """
+        if self._stage not in (Stage.post_initial_sync, Stage.oplog_sync) or not self._last_optime:
+            return 0
+        return time.time() - self._last_optime.time
+
     def _sync_collection(self, namespace_tuple):
         """ Sync a collection until success.
         """
@@ -278,12 +306,15 @@ class CommonSyncer(object):
             self._last_logtime = now
 
     def _log_optime(self, optime):
-        """ Record optime periodically.
+        """ Record checkpoint after every applied batch, and log it periodically.
+        It must be called only if all oplogs before optime are applied.
         """
+        self._applied_optime = optime
         if not self._optime_logger:
             return
+        self._optime_logger.write(optime, self._stage, self._initial_sync_end_optime)
         now = time.time()
+        self._last_checkpoint_time = now
         if now - self._last_optime_logtime >= self._optime_log_interval:
-            self._optime_logger.write(optime)
             self._last_optime_logtime = now
             log.info("flush optime into file '%s': %s" % (self._optime_logger.filepath, optime))
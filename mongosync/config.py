@@ -11,20 +11,50 @@ class CheckConfig(object):
         self.dbs = []
         self.src_db = ''
         self.dst_db = ''
+        self.ranges = False
+        self.partitions = 16
+        self.concurrency = 16
+        self.output = 'mismatched_ranges.json'
+
+
+class RepairConfig(object):
+    def __init__(self):
+        self.sync_conf = None
+        self.ranges_filepath = ''
+        self.leaf_docs = 1000
+        self.concurrency = 8
+        self.rounds = 5
+        self.settle = 5
+        self.dry_run = False
+        self.optime_logfilepath = ''
+        self.logfilepath = ''
 
 
 class MongoConfig(object):
-    def __init__(self, hosts, authdb, username, password, ssl):
+    def __init__(self, hosts, authdb, username, password, ssl, read_preference='primary', read_preference_tags=None):
         self.hosts = hosts
         self.authdb = authdb
         self.username = username
         self.password = password
         self.ssl = ssl
+        self.read_preference = read_preference
+        self.read_preference_tags = read_preference_tags if read_preference_tags else []
 
 
 class EsConfig(object):
-    def __init__(self, hosts):
+    def __init__(self, hosts, bulk_size_mb=10, bulk_concurrency=2, bulk_max_retries=8,
+                 bulk_load=False, index_settings=None, index_mappings=None, max_num_segments=0, oplog_flushes=4,
+                 dead_letter_file='dead_letter.json'):
         self.hosts = hosts
+        self.bulk_size_mb = bulk_size_mb  # payload size of a bulk request
+        self.bulk_concurrency = bulk_concurrency  # bulk requests in flight per node
+        self.bulk_max_retries = bulk_max_retries  # retries of failed actions
+        self.bulk_load = bulk_load  # disable refresh and replicas during initial sync
+        self.index_settings = index_settings if index_settings else {}  # settings of created indices
+        self.index_mappings = index_mappings if index_mappings else {}  # mappings of created indices
+        self.max_num_segments = max_num_segments  # force merge after bulk load if greater than 0
+        self.oplog_flushes = oplog_flushes  # bulk writes of oplogs in flight
+        self.dead_letter_file = dead_letter_file  # permanently failed actions, not written if empty
 
 
 class Config(object):
@@ -40,13 +70,40 @@ class Config(object):
         # rename mapping
         self.dbmap = {}
 
-        # fields {'ns' : frozenset(['field0', 'field1'])}
+        # fields {'ns' : FieldProjection(['field0', 'field1'])}
         self.fieldmap = {}
 
+        # initial sync engine, 'gevent' or 'pipeline'
+        self.engine = 'gevent'
+        self.gevent_collections = 20
+        self.gevent_processes = 8
+        self.gevent_large_collection_docs = 1000000
+        self.gevent_batch_size = 5000
+        self.gevent_batches = 1
+        self.gevent_partition_batch_size = 100
+        self.gevent_partition_batches = 10
+        self.pipeline_readers = 8
+        self.pipeline_writers = 16
+        self.pipeline_queue_size = 64
+        self.pipeline_batch_size = 1000
+
+        # budget of documents buffered in memory, unlimited if 0
+        self.memory_budget_mb = 0
+
         self.start_optime = None
         self.optime_logfilepath = ''
         self.logfilepath = ''
 
+        # port of metrics endpoint, disabled if 0
+        self.metrics_port = 0
+        # trace every n-th oplog, disabled if 0
+        self.trace_sample_every = 1000
+
+        # documents verified in a round during oplog replay, disabled if 0
+        self.verify_sample_size = 0
+        self.verify_interval = 10
+        self.verify_read_budget = 100
+
     @property
     def src_hostportstr(self):
         return self.hostportstr(self.src_conf.hosts)
@@ -97,6 +154,7 @@ class Config(object):
         f('src authdb      :  %s' % self.src_conf.authdb)
         f('src username    :  %s' % self.src_conf.username)
         f('src password    :  %s' % self.src_conf.password)
+        f('src read pref   :  %s %s' % (self.src_conf.read_preference, self.src_conf.read_preference_tags))
         if isinstance(self.src_conf, str) or isinstance(self.src_conf.hosts, unicode):
             f('src db version  :  %s' % get_version(self.src_conf))
 
@@ -107,6 +165,12 @@ class Config(object):
                 f('dst username    :  %s' % self.dst_conf.username)
                 f('dst password    :  %s' % self.dst_conf.password)
                 f('dst db version  :  %s' % get_version(self.dst_conf))
+        elif isinstance(self.dst_conf, EsConfig):
+            f('dst bulk        :  %sMB, %d in flight per node, %d retries' % (
+                self.dst_conf.bulk_size_mb, self.dst_conf.bulk_concurrency, self.dst_conf.bulk_max_retries))
+            f('dst bulk load   :  %s' % self.dst_conf.bulk_load)
+            f('dst dead letter :  %s' % self.dst_conf.dead_letter_file)
+            f('dst settings    :  %s' % self.dst_conf.index_settings)
 
         # noinspection PyProtectedMember
         f('databases       :  %s' % ', '.join(self.data_filter._related_dbs))
@@ -115,8 +179,26 @@ class Config(object):
         f('db mapping      :  %s' % self.dbmap_str)
         f('fileds          :  %s' % self.fieldmap_str)
 
+        f('engine          :  %s' % self.engine)
+        if self.engine == 'gevent':
+            f('gevent          :  %d collections, %d processes for collections over %d docs' % (
+                self.gevent_collections, self.gevent_processes, self.gevent_large_collection_docs))
+            f('gevent batches  :  %d x %d docs, %d x %d docs per process' % (
+                self.gevent_batches, self.gevent_batch_size,
+                self.gevent_partition_batches, self.gevent_partition_batch_size))
+        if self.engine == 'pipeline':
+            f('pipeline        :  %d readers, %d writers, queue size %d, batch size %d' % (
+                self.pipeline_readers, self.pipeline_writers, self.pipeline_queue_size, self.pipeline_batch_size))
+        f('memory budget   :  %s' % ('%dMB' % self.memory_budget_mb if self.memory_budget_mb else 'unlimited'))
         f('start optime    :  %s' % self.start_optime)
         f('optime logfile  :  %s' % self.optime_logfilepath)
         f('log filepath    :  %s' % self.logfilepath)
+        f('metrics port    :  %s' % (self.metrics_port if self.metrics_port else 'disabled'))
+        f('trace oplogs    :  %s' % ('1 in %d' % self.trace_sample_every if self.trace_sample_every else 'disabled'))
+        if self.verify_sample_size:
+            f('verify          :  %d docs every %ds, budget %d reads/s' % (
+                self.verify_sample_size, self.verify_interval, self.verify_read_budget))
+        else:
+            f('verify          :  disabled')
         f('pymongo version :  %s' % pymongo.version)
         f('================================================')
@@ -1,7 +1,8 @@
 import toml
 from bson.timestamp import Timestamp
 from mongosync.config import Config, MongoConfig, EsConfig
-from mongosync.mongo_utils import gen_namespace
+from mongosync.doc_utils import FieldProjection
+from mongosync.mongo_utils import gen_namespace, READ_PREFERENCE_MODES
 
 
 class ConfigFile(object):
@@ -16,9 +17,13 @@ class ConfigFile(object):
                                     tml['src'].get('username', ''),
                                     tml['src'].get('password', ''),
                                     tml['src'].get('ssl', False),
+                                    tml['src'].get('read_preference', 'primary'),
+                                    tml['src'].get('read_preference_tags', []),
                                     )
+        if conf.src_conf.read_preference not in READ_PREFERENCE_MODES:
+            raise Exception('invalid src.read_preference: %s' % conf.src_conf.read_preference)
 
-        if type not in tml['dst'] or tml['dst']['type'] == 'mongo':
+        if 'type' not in tml['dst'] or tml['dst']['type'] == 'mongo':
             conf.dst_conf = MongoConfig(tml['dst']['hosts'],
                                         tml['dst'].get('authdb', 'admin'),
                                         tml['dst'].get('username', ''),
@@ -26,7 +31,17 @@ class ConfigFile(object):
                                         tml['dst'].get('ssl', False),
                                         )
         elif tml['dst']['type'] == 'es':
-            conf.dst_conf = EsConfig(tml['dst']['hosts'])
+            conf.dst_conf = EsConfig(tml['dst']['hosts'],
+                                     tml['dst'].get('bulk_size_mb', 10),
+                                     tml['dst'].get('bulk_concurrency', 2),
+                                     tml['dst'].get('bulk_max_retries', 8),
+                                     tml['dst'].get('bulk_load', False),
+                                     tml['dst'].get('index_settings', {}),
+                                     tml['dst'].get('index_mappings', {}),
+                                     tml['dst'].get('max_num_segments', 0),
+                                     tml['dst'].get('oplog_flushes', 4),
+                                     tml['dst'].get('dead_letter_file', 'dead_letter.json'),
+                                     )
         else:
             raise Exception('invalid dst.type')
 
@@ -68,17 +83,60 @@ class ConfigFile(object):
                             if fields:
                                 if ns in conf.fieldmap:
                                     raise Exception("duplicate collname in sync.dbs.colls: %s" % ns)
-                                conf.fieldmap[ns] = fields
+                                conf.fieldmap[ns] = FieldProjection(fields)
                         else:
                             raise Exception('invalid entry in sync.dbs.colls: %s' % collentry)
                 else:
                     # update coll filter
                     conf.data_filter.add_include_coll(gen_namespace(dbname, '*'))
 
+        if 'sync' in tml and 'engine' in tml['sync']:
+            if tml['sync']['engine'] not in ('gevent', 'pipeline'):
+                raise Exception('invalid sync.engine: %s' % tml['sync']['engine'])
+            conf.engine = tml['sync']['engine']
+
+        if 'sync' in tml and 'gevent' in tml['sync']:
+            gevent_conf = tml['sync']['gevent']
+            conf.gevent_collections = gevent_conf.get('collections', conf.gevent_collections)
+            conf.gevent_processes = gevent_conf.get('processes', conf.gevent_processes)
+            conf.gevent_large_collection_docs = gevent_conf.get('large_collection_docs',
+                                                                conf.gevent_large_collection_docs)
+            conf.gevent_batch_size = gevent_conf.get('batch_size', conf.gevent_batch_size)
+            conf.gevent_batches = gevent_conf.get('batches', conf.gevent_batches)
+            conf.gevent_partition_batch_size = gevent_conf.get('partition_batch_size',
+                                                               conf.gevent_partition_batch_size)
+            conf.gevent_partition_batches = gevent_conf.get('partition_batches', conf.gevent_partition_batches)
+
+        if 'sync' in tml and 'pipeline' in tml['sync']:
+            pipeline = tml['sync']['pipeline']
+            conf.pipeline_readers = pipeline.get('readers', conf.pipeline_readers)
+            conf.pipeline_writers = pipeline.get('writers', conf.pipeline_writers)
+            conf.pipeline_queue_size = pipeline.get('queue_size', conf.pipeline_queue_size)
+            conf.pipeline_batch_size = pipeline.get('batch_size', conf.pipeline_batch_size)
+
+        if 'sync' in tml and 'memory_budget_mb' in tml['sync']:
+            if tml['sync']['memory_budget_mb'] < 0:
+                raise Exception('invalid sync.memory_budget_mb: %s' % tml['sync']['memory_budget_mb'])
+            conf.memory_budget_mb = tml['sync']['memory_budget_mb']
+
         if 'sync' in tml and 'start_optime' in tml['sync']:
             conf.start_optime = Timestamp(tml['sync']['start_optime'], 0)
 
         if 'log' in tml and 'filepath' in tml['log']:
             conf.logfilepath = tml['log']['filepath']
 
+        if 'metrics' in tml and 'port' in tml['metrics']:
+            conf.metrics_port = tml['metrics']['port']
+
+        if 'metrics' in tml and 'trace_sample_every' in tml['metrics']:
+            conf.trace_sample_every = tml['metrics']['trace_sample_every']
+
+        if 'verify' in tml:
+            verify = tml['verify']
+            conf.verify_sample_size = verify.get('sample_size', conf.verify_sample_size)
+            conf.verify_interval = verify.get('interval', conf.verify_interval)
+            conf.verify_read_budget = verify.get('read_budget', conf.verify_read_budget)
+            if conf.verify_sample_size < 0 or conf.verify_interval <= 0 or conf.verify_read_budget < 0:
+                raise Exception('invalid verify: %s' % verify)
+
         return conf
@@ -34,6 +34,17 @@ def get_val_by_flat_keys(doc, key_list):
     return res
 
 
+def del_val_by_flat_keys(doc, key_list):
+    """ Delete value through flat keys from a nested document.
+    Do nothing if not found.
+    """
+    for key in key_list[:-1]:
+        doc = doc.get(key)
+        if not isinstance(doc, collections.Mapping):
+            return
+    doc.pop(key_list[-1], None)
+
+
 def gen_doc_with_fields(doc, include_fields):
     """ Generate document with the specfied fields.
     """
@@ -49,6 +60,127 @@ def gen_doc_with_fields(doc, include_fields):
     return res
 
 
+class FieldProjection(object):
+    """ Fields of a collection to sync, compiled into a path trie once.
+
+    A node of trie is a dict of key => child node, and a child node is True if the whole value is included.
+    e.g.:
+
+    ['a.b', 'a.c', 'd']
+
+    =>
+
+    { a: { b: True, c: True }, d: True }
+    """
+    _max_cached_keypaths = 10000
+
+    def __init__(self, fields):
+        self._fields = frozenset(fields)
+        self._trie = {}
+        for f in sorted(self._fields, key=len):
+            node = self._trie
+            keys = f.split('.')
+            for key in keys[:-1]:
+                child = node.setdefault(key, {})
+                if child is True:  # covered by a shorter field
+                    break
+                node = child
+            else:
+                node[keys[-1]] = True
+        self._keypaths = {}  # cache of resolved key paths in oplogs
+
+    def __iter__(self):
+        return iter(sorted(self._fields))
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, field):
+        return field in self._fields
+
+    def resolve(self, keypath):
+        """ Split a key path and find its node in trie, with cache.
+        Return a tuple (keys, node), node is None if excluded and True if the whole value is included.
+        """
+        res = self._keypaths.get(keypath)
+        if res is None:
+            keys = keypath.split('.')
+            node = self._trie
+            for key in keys:
+                node = node.get(key)
+                if node is None or node is True:
+                    break
+            res = (keys, node)
+            if len(self._keypaths) < self._max_cached_keypaths:
+                self._keypaths[keypath] = res
+        return res
+
+    def project(self, doc):
+        """ Generate document with the fields in one pass.
+        """
+        return _project(doc, self._trie)
+
+    def covers(self, keypath):
+        """ Check if a key path or part of its value is included.
+        """
+        return self.resolve(keypath)[1] is not None
+
+
+def _project(doc, trie):
+    res = {}
+    for key, node in trie.iteritems():
+        if key not in doc:
+            continue
+        val = doc[key]
+        if node is True:
+            res[key] = val
+        elif isinstance(val, collections.Mapping):
+            sub = _project(val, node)
+            if sub:
+                res[key] = sub
+    return res
+
+
+def set_to_nested(set_doc, projection=None):
+    """ Convert the flat keys and values of $set into a nested document in one pass.
+    Only the fields of projection are included if specified.
+    e.g.:
+
+    { a.b: 1, a.c: 2 }
+
+    =>
+
+    { a: { b: 1, c: 2 } }
+    """
+    res = {}
+    for keypath, val in set_doc.iteritems():
+        if projection is not None:
+            keys, node = projection.resolve(keypath)
+            if node is None:
+                continue
+            if node is not True:
+                # the key path is a prefix of some fields
+                if not isinstance(val, collections.Mapping):
+                    continue
+                val = _project(val, node)
+                if not val:
+                    continue
+        else:
+            keys = keypath.split('.')
+        node = res
+        for key in keys[:-1]:
+            child = node.get(key)
+            if not isinstance(child, collections.Mapping):
+                child = node[key] = {}
+            node = child
+        last = keys[-1]
+        if isinstance(val, collections.Mapping) and isinstance(node.get(last), collections.Mapping):
+            merge_doc(node[last], val)
+        else:
+            node[last] = val
+    return res
+
+
 def merge_doc(doc1, doc2):
     """ Merge doc2 into doc1.
     """
@@ -74,4 +206,17 @@ if __name__ == '__main__':
     assert gen_doc_with_fields(doc, ['a.b.c']) == doc1
     assert gen_doc_with_fields(doc, ['a.b.d']) == doc2
 
+    doc3 = {'a': {'b': {'c': 1, 'd': 2}}}
+    del_val_by_flat_keys(doc3, 'a.b.d'.split('.'))
+    del_val_by_flat_keys(doc3, 'a.x.y'.split('.'))
+    assert doc3 == doc1
+
+    proj = FieldProjection(['a.b.c', 'a.x', 'e', 'e.f'])
+    assert proj.project(doc) == doc1
+    assert proj.project({'a': {'b': 1, 'x': 2}, 'e': [1], 'g': 3}) == {'a': {'x': 2}, 'e': [1]}
+    assert proj.covers('a') and proj.covers('a.b') and proj.covers('e.f.g')
+    assert not proj.covers('a.y') and not proj.covers('g')
+    assert set_to_nested({'a.b.c': 1, 'a.b.d': 2}) == doc
+    assert set_to_nested({'a.b': {'c': 1, 'd': 2}, 'a.y': 1, 'e.f': 1}, proj) == {'a': {'b': {'c': 1}}, 'e': {'f': 1}}
+
     print('test cases all pass')
@@ -1 +0,0 @@
-raise ImportError('MODULE IS DEPRECATED: %s' % __name__)
@@ -0,0 +1,181 @@
+import collections
+from mongosync.doc_utils import merge_doc, del_val_by_flat_keys
+
+UPDATE_SCRIPT_ID = 'mongosync-update'
+
+# Stored script to apply a list of set and unset operations in order.
+# params.ops is a list of {'op': 'set' or 'unset', 'path': [key, ...], 'value': value}
+UPDATE_SCRIPT = """
+for (def op : params.ops) {
+  def node = ctx._source;
+  int last = op.path.size() - 1;
+  for (int i = 0; i < last && node != null; ++i) {
+    def child = node.get(op.path[i]);
+    if (!(child instanceof Map)) {
+      if (op.op == 'unset') {
+        child = null;
+      } else {
+        child = new HashMap();
+        node.put(op.path[i], child);
+      }
+    }
+    node = child;
+  }
+  if (node != null) {
+    if (op.op == 'unset') {
+      node.remove(op.path[last]);
+    } else {
+      node.put(op.path[last], op.value);
+    }
+  }
+}
+"""
+
+
+class ActionBuffer(object):
+    """ Buffer of Elasticsearch actions keyed by (index, type, _id).
+
+    Operations on the same document are folded:
+        - $set docs are merged
+        - an index followed by updates becomes a single index of the updated source
+        - any sequence ending in a delete becomes the delete
+        - updates with $unset become a single call of the stored script
+    """
+
+    def __init__(self):
+        # (index, type, _id) => ['index', source] or ['delete'] or ['update', steps]
+        # steps is a list of ['set', nested doc] or ['unset', [keypath, ...]]
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def keys(self):
+        return self._entries.keys()
+
+    def index(self, idxname, typename, id, source):
+        self._entries[(idxname, typename, id)] = ['index', source]
+
+    def delete(self, idxname, typename, id):
+        self._entries[(idxname, typename, id)] = ['delete']
+
+    def set(self, idxname, typename, id, doc):
+        """ Fold a $set converted to a nested doc.
+        """
+        key = (idxname, typename, id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = ['update', [['set', doc]]]
+        elif entry[0] == 'index':
+            merge_doc(entry[1], doc)
+        elif entry[0] == 'delete':
+            # update is upserted
+            self._entries[key] = ['index', doc]
+        else:
+            steps = entry[1]
+            if steps[-1][0] == 'set':
+                merge_doc(steps[-1][1], doc)
+            else:
+                steps.append(['set', doc])
+
+    def unset(self, idxname, typename, id, keypaths):
+        """ Fold a $unset with a list of key paths.
+        """
+        key = (idxname, typename, id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = ['update', [['unset', list(keypaths)]]]
+        elif entry[0] == 'index':
+            for keypath in keypaths:
+                del_val_by_flat_keys(entry[1], keypath.split('.'))
+        elif entry[0] == 'delete':
+            pass
+        else:
+            steps = entry[1]
+            if steps[-1][0] == 'unset':
+                steps[-1][1].extend(keypaths)
+            else:
+                steps.append(['unset', list(keypaths)])
+
+    def actions(self):
+        """ Generate actions for bulk write.
+        """
+        for (idxname, typename, id), entry in self._entries.iteritems():
+            if entry[0] == 'index':
+                yield {'_op_type': 'index', '_index': idxname, '_type': typename, '_id': id, '_source': entry[1]}
+            elif entry[0] == 'delete':
+                yield {'_op_type': 'delete', '_index': idxname, '_type': typename, '_id': id}
+            else:
+                steps = entry[1]
+                if len(steps) == 1 and steps[0][0] == 'set':
+                    yield {'_op_type': 'update',
+                           '_index': idxname,
+                           '_type': typename,
+                           '_id': id,
+                           '_retry_on_conflict': 3,
+                           'doc': steps[0][1],
+                           'doc_as_upsert': True}
+                else:
+                    action = {'_op_type': 'update',
+                              '_index': idxname,
+                              '_type': typename,
+                              '_id': id,
+                              '_retry_on_conflict': 3,
+                              'script': {'id': UPDATE_SCRIPT_ID, 'params': {'ops': gen_script_ops(steps)}}}
+                    if any(op == 'set' for op, _ in steps):
+                        # same as doc_as_upsert
+                        action['upsert'] = {}
+                        action['scripted_upsert'] = True
+                    yield action
+
+
+def gen_script_ops(steps):
+    """ Generate params of stored script from update steps.
+    """
+    def gen_set_ops(path, doc, ops):
+        for k, v in doc.iteritems():
+            if isinstance(v, collections.Mapping) and v:
+                gen_set_ops(path + [k], v, ops)
+            else:
+                ops.append({'op': 'set', 'path': path + [k], 'value': v})
+
+    ops = []
+    for op, arg in steps:
+        if op == 'set':
+            gen_set_ops([], arg, ops)
+        else:
+            for keypath in arg:
+                ops.append({'op': 'unset', 'path': keypath.split('.')})
+    return ops
+
+
+if __name__ == '__main__':
+    buf = ActionBuffer()
+    buf.index('i', 't', '1', {'a': 1, 'b': {'c': 1, 'd': 2}})
+    buf.set('i', 't', '1', {'b': {'c': 3}})
+    buf.unset('i', 't', '1', ['b.d'])
+    buf.set('i', 't', '2', {'a': 1})
+    buf.set('i', 't', '2', {'b': 2})
+    buf.set('i', 't', '4', {'a': 1})
+    buf.set('i', 't', '4', {'b': 2})
+    buf.unset('i', 't', '4', ['c'])
+    buf.set('i', 't', '3', {'a': 1})
+    buf.delete('i', 't', '3')
+    assert len(buf) == 4
+
+    actions = list(buf.actions())
+    assert len(actions) == 4
+    assert actions[0]['_op_type'] == 'index' and actions[0]['_source'] == {'a': 1, 'b': {'c': 3}}
+    assert actions[1]['_op_type'] == 'update' and actions[1]['doc'] == {'a': 1, 'b': 2}
+    assert actions[1]['_op_type'] == 'update' and 'script' not in actions[1]
+    assert actions[2]['_op_type'] == 'update' and actions[2]['script']['id'] == UPDATE_SCRIPT_ID
+    assert actions[2]['script']['params']['ops'] == [{'op': 'set', 'path': ['a'], 'value': 1},
+                                                     {'op': 'set', 'path': ['b'], 'value': 2},
+                                                     {'op': 'unset', 'path': ['c']}]
+    assert actions[2]['scripted_upsert'] is True
+    assert actions[3]['_op_type'] == 'delete' and actions[3]['_id'] == '3'
+
+    print('test cases all pass')
@@ -1,11 +1,38 @@
 import time
+import json
+import gevent
+import gevent.pool
 import elasticsearch
-import elasticsearch.helpers
+from mongosync import metrics
 from mongosync.config import EsConfig
+from mongosync.es.action_buffer import UPDATE_SCRIPT_ID, UPDATE_SCRIPT
+from mongosync.es.serializer import BsonSerializer
 from mongosync.logger import Logger
 
 log = Logger.get()
 
+# keys of action that belong to the action and metadata line of bulk request
+_META_KEYS = ('_index', '_type', '_id', '_parent', '_routing', 'routing', '_version', '_version_type',
+              '_retry_on_conflict', 'retry_on_conflict', 'pipeline')
+
+# status of bulk requests and items that could succeed on retry
+# 408 request timeout, 409 version conflict, 413 request too large, 429 queue full, 502/503/504 node unavailable
+_RETRYABLE_STATUS = frozenset([408, 409, 413, 429, 502, 503, 504])
+
+
+def expand_action(action):
+    """ Split an action into the action and metadata line and the optional source line.
+    """
+    data = action.copy()
+    op_type = data.pop('_op_type', 'index')
+    meta = {}
+    for key in _META_KEYS:
+        if key in data:
+            meta[key] = data.pop(key)
+    if op_type == 'delete':
+        return {op_type: meta}, None
+    return {op_type: meta}, data.get('_source', data)
+
 
 class EsHandler(object):
     def __init__(self, conf):
@@ -14,14 +41,30 @@ class EsHandler(object):
         self._conf = conf
         self._es = None
 
+        n_nodes = len(conf.hosts) if isinstance(conf.hosts, list) else 1
+        self._max_chunk_bytes = int(conf.bulk_size_mb * 1024 * 1024)
+        self._concurrency = max(conf.bulk_concurrency * n_nodes, 1)  # requests in flight
+        self._max_retries = conf.bulk_max_retries
+        self._initial_backoff = 0.1  # seconds
+        self._max_backoff = 30.0  # seconds
+        self._backoff = 0.0  # shared by all requests, raised on rejection and decayed on success
+        self._dead_letter_file = conf.dead_letter_file  # permanently failed actions
+        self._bulk_write_seconds = metrics.BULK_WRITE_SECONDS.labels('elasticsearch')
+        self._bulk_write_size = metrics.BULK_WRITE_SIZE.labels('elasticsearch')
+
     def __del__(self):
         self.close()
 
     def connect(self):
-        self._es = elasticsearch.Elasticsearch(self._conf.hosts, timeout=600)
-        return self._es.ping()
+        self._es = elasticsearch.Elasticsearch(self._conf.hosts, timeout=600, serializer=BsonSerializer())
+        if not self._es.ping():
+            return False
+        # stored script is compiled once and shared by all updates
+        self._es.put_script(id=UPDATE_SCRIPT_ID, body={'script': {'lang': 'painless', 'source': UPDATE_SCRIPT}})
+        return True
 
     def reconnect(self):
+        metrics.RECONNECTS.labels(str(self._conf.hosts)).inc()
         while True:
             res = self.connect()
             if not res:
@@ -36,7 +79,200 @@ class EsHandler(object):
         return self._es
 
     def bulk_write(self, actions):
+        """ Write actions with bulk requests cut by payload size, and keep several requests in flight.
+
+        The actions could be any iterable, requests are sent while iterating.
+        Return serialized items that are still not written after retries, resend them with rewrite().
+        """
+        serializer = self._es.transport.serializer
+
+        def gen_items():
+            for action in actions:
+                meta, source = expand_action(action)
+                if source is None:
+                    yield (serializer.dumps(meta),)
+                else:
+                    yield (serializer.dumps(meta), serializer.dumps(source))
+
+        return self._write_items(gen_items())
+
+    def rewrite(self, items):
+        """ Resend serialized items returned by bulk_write().
+        Return items that are still not written after retries.
+        """
+        return self._write_items(iter(items))
+
+    def _write_items(self, items):
+        pool = gevent.pool.Pool(self._concurrency)
+        pending = []
+
+        def send(chunk):
+            pending.extend(self._send_bulk(chunk))
+
+        try:
+            for chunk in _split_items(items, self._max_chunk_bytes):
+                # block here if requests in flight reach the limit
+                pool.spawn(send, chunk)
+        finally:
+            pool.join()
+        return pending
+
+    def _send_bulk(self, chunk):
+        """ Send a bulk request and handle the outcome of each item.
+
+        The chunk is a list of serialized items, an item is a tuple of lines of an action.
+        Items failed with a retryable status are resubmitted in smaller batches with adaptive backoff,
+        items failed permanently are written to the dead letter file, succeeded items are never resent.
+        Return items that are still not written after retries.
+        """
+        pending = []
+        batches = [(chunk, 0)]
+        while batches:
+            batch, n_retries = batches.pop()
+            if self._backoff > 0:
+                time.sleep(self._backoff)
+
+            retryable = self._try_bulk(batch)
+            if not retryable:
+                self._decay_backoff()
+                continue
+            if n_retries >= self._max_retries:
+                log.error('bulk write failed: %d actions still failed after %d retries' % (len(retryable), n_retries))
+                pending.extend(retryable)
+                continue
+
+            self._raise_backoff()
+            log.warn('%d/%d actions failed, retry in %.1fs' % (len(retryable), len(batch), self._backoff))
+            # the batch is halved on each retry
+            max_bytes = self._max_chunk_bytes >> (n_retries + 1)
+            for sub_batch in _split_items(retryable, max_bytes):
+                batches.append((sub_batch, n_retries + 1))
+        return pending
+
+    def _try_bulk(self, batch):
+        """ Send a bulk request once.
+        Return items failed with a retryable status.
+        """
         try:
-            elasticsearch.helpers.bulk(client=self._es, actions=actions)
-        except Exception as e:
-            log.error('bulk write failed: %s' % e)
+            t = time.time()
+            resp = self._es.bulk(body=''.join(line + '\n' for lines in batch for line in lines))
+            self._bulk_write_seconds.observe(time.time() - t)
+            self._bulk_write_size.observe(len(batch))
+        except elasticsearch.ConnectionError as e:
+            # including timeouts
+            log.warn('bulk request failed: %s' % e)
+            return batch
+        except elasticsearch.TransportError as e:
+            if e.status_code in _RETRYABLE_STATUS:
+                log.warn('bulk request failed: %s' % e)
+                return batch
+            log.error('bulk request failed: %s' % e)
+            for lines in batch:
+                self._write_dead_letter(lines, e.status_code, e.info)
+            return []
+
+        if not resp['errors']:
+            return []
+
+        retryable = []
+        for lines, item in zip(batch, resp['items']):
+            op_type, res = item.popitem()
+            if 'error' not in res:
+                continue
+            if res['status'] in _RETRYABLE_STATUS:
+                retryable.append(lines)
+            else:
+                log.error('bulk write failed: %s %s' % (op_type, res))
+                self._write_dead_letter(lines, res['status'], res['error'])
+        return retryable
+
+    def _write_dead_letter(self, lines, status, error):
+        """ Write a permanently failed action to the dead letter file as a line of JSON.
+        """
+        if not self._dead_letter_file:
+            return
+        # serializer of client returns strings as they are, so dump them with json
+        record = '{"time": %s, "status": %s, "error": %s, "action": %s, "source": %s}\n' % (
+            json.dumps(time.strftime('%Y-%m-%d %H:%M:%S')),
+            json.dumps(status),
+            json.dumps(error, default=str),
+            lines[0],
+            lines[1] if len(lines) > 1 else 'null')
+        with open(self._dead_letter_file, 'a') as f:
+            f.write(record)
+
+    def _raise_backoff(self):
+        self._backoff = min(max(self._backoff * 2, self._initial_backoff), self._max_backoff)
+
+    def _decay_backoff(self):
+        self._backoff = self._backoff / 2 if self._backoff >= self._initial_backoff else 0.0
+
+
+def _split_items(items, max_bytes):
+    """ Split serialized items into chunks by payload size, a chunk has one item at least.
+    """
+    chunk = []
+    n_bytes = 0
+    for lines in items:
+        item_bytes = sum(len(line) + 1 for line in lines)
+        if chunk and n_bytes + item_bytes > max_bytes:
+            yield chunk
+            chunk = []
+            n_bytes = 0
+        chunk.append(lines)
+        n_bytes += item_bytes
+    if chunk:
+        yield chunk
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    class FakeClient(object):
+        """ Fail items by status in turn, and record _id of written items.
+        """
+        def __init__(self, statuses):
+            self.transport = type('Transport', (object,), {'serializer': BsonSerializer()})()
+            self.statuses = statuses  # _id => statuses of attempts, succeed if run out
+            self.written = []
+
+        def bulk(self, body):
+            lines = body.splitlines()
+            items = []
+            i = 0
+            while i < len(lines):
+                meta = json.loads(lines[i])
+                op_type, info = meta.items()[0]
+                i += 1 if op_type == 'delete' else 2
+                statuses = self.statuses.get(info['_id'])
+                if statuses:
+                    status = statuses.pop(0)
+                    items.append({op_type: {'_id': info['_id'], 'status': status, 'error': {'type': 'x'}}})
+                else:
+                    self.written.append(info['_id'])
+                    items.append({op_type: {'_id': info['_id'], 'status': 200}})
+            return {'errors': any('error' in item.values()[0] for item in items), 'items': items}
+
+    assert expand_action({'_op_type': 'delete', '_index': 'i', '_id': '1'}) == ({'delete': {'_index': 'i', '_id': '1'}},
+                                                                                None)
+    assert expand_action({'_index': 'i', '_id': '1', '_source': {'a': 1}}) == ({'index': {'_index': 'i', '_id': '1'}},
+                                                                               {'a': 1})
+    assert [len(c) for c in _split_items([('x' * 9,)] * 5, 20)] == [2, 2, 1]
+    assert [len(c) for c in _split_items([('x' * 30,)] * 2, 20)] == [1, 1]
+
+    dead_letter_file = tempfile.mktemp()
+    handler = EsHandler(EsConfig('localhost:9200', bulk_max_retries=2, dead_letter_file=dead_letter_file))
+    handler._initial_backoff = 0.001
+    handler._es = FakeClient({'1': [429], '2': [400], '3': [503, 503, 503], '4': [429, 409]})
+    pending = handler.bulk_write([{'_index': 'i', '_type': 't', '_id': str(i), '_source': {'a': i}} for i in xrange(6)]
+                                 + [{'_op_type': 'delete', '_index': 'i', '_type': 't', '_id': '6'}])
+    assert sorted(handler._es.written) == ['0', '1', '4', '5', '6']
+    assert [json.loads(lines[0])['index']['_id'] for lines in pending] == ['3']
+    with open(dead_letter_file) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1 and records[0]['status'] == 400 and records[0]['source'] == {'a': 2}
+    os.remove(dead_letter_file)
+    assert handler.rewrite(pending) == [] and handler._es.written[-1] == '3'
+
+    print('test cases all pass')
@@ -0,0 +1,171 @@
+import base64
+import collections
+import datetime
+import decimal
+import json
+import uuid
+from bson.binary import Binary
+from bson.code import Code
+from bson.dbref import DBRef
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.son import SON
+from bson.timestamp import Timestamp
+from elasticsearch.exceptions import SerializationError
+
+try:
+    # faster if installed with C speedups
+    import simplejson as json_backend
+except ImportError:
+    json_backend = json
+
+# types that JSON encoder accepts as they are, pymongo decodes 64-bit integers as Int64
+_PLAIN_TYPES = frozenset([unicode, str, int, long, Int64, float, bool, type(None)])
+
+
+def _isoformat(data):
+    return data.isoformat()
+
+
+def _decimal128_to_float(data):
+    return float(data.to_decimal())
+
+
+def _binary_to_base64(data):
+    # same as the binary datatype of Elasticsearch
+    return base64.b64encode(data)
+
+
+def _timestamp_to_doc(data):
+    return {'t': data.time, 'i': data.inc}
+
+
+def _dbref_to_doc(data):
+    return {'collection': data.collection, 'id': _convert(data.id), 'database': data.database}
+
+
+# converters of BSON types by exact type
+_CONVERTERS = {
+    ObjectId: str,
+    datetime.datetime: _isoformat,
+    datetime.date: _isoformat,
+    datetime.time: _isoformat,
+    uuid.UUID: str,
+    Decimal128: _decimal128_to_float,
+    decimal.Decimal: float,
+    Binary: _binary_to_base64,
+    Timestamp: _timestamp_to_doc,
+    Regex: lambda data: data.pattern,
+    Code: unicode,
+    DBRef: _dbref_to_doc,
+    MinKey: lambda data: {'$minKey': 1},
+    MaxKey: lambda data: {'$maxKey': 1},
+}
+
+
+def _convert_doc(doc):
+    res = {}
+    for k, v in doc.iteritems():
+        if type(v) in _PLAIN_TYPES:
+            res[k] = v
+        else:
+            res[k] = _convert(v)
+    return res
+
+
+def _convert(data):
+    """ Convert BSON types into JSON types.
+    """
+    t = type(data)
+    if t in _PLAIN_TYPES:
+        return data
+    if t is dict or t is SON:
+        return _convert_doc(data)
+    if t is list or t is tuple:
+        return [v if type(v) in _PLAIN_TYPES else _convert(v) for v in data]
+    converter = _CONVERTERS.get(t)
+    if converter is not None:
+        return converter(data)
+    # subclasses
+    if isinstance(data, Binary):
+        return _binary_to_base64(data)
+    if isinstance(data, str):
+        return data
+    if isinstance(data, (int, long)):
+        return long(data)
+    if isinstance(data, float):
+        return float(data)
+    if isinstance(data, collections.Mapping):
+        return _convert_doc(data)
+    if isinstance(data, (list, tuple)):
+        return [_convert(v) for v in data]
+    for base, converter in _CONVERTERS.iteritems():
+        if isinstance(data, base):
+            return converter(data)
+    # unknown types, e.g. added by newer BSON, are indexed as text rather than failing the bulk
+    return unicode(data)
+
+
+class BsonSerializer(object):
+    """ JSON serializer of Elasticsearch client for documents decoded from BSON.
+
+    BSON types are converted in a single pass before encoding, and the C encoder of the JSON backend
+    is used for the whole document, instead of calling back per object.
+    Binary is a subclass of str in Python 2, so it has to be converted before encoding,
+    otherwise it is encoded as text.
+    """
+    mimetype = 'application/json'
+
+    def loads(self, s):
+        try:
+            return json_backend.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, basestring):
+            return data
+        try:
+            # ensure_ascii keeps the encoding in C and the output in bytes
+            return json_backend.dumps(_convert(data), separators=(',', ':'))
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+if __name__ == '__main__':
+    serializer = BsonSerializer()
+    oid = ObjectId('5e56c076b61867f68c7eb410')
+    doc = SON([('a', oid),
+               ('b', datetime.datetime(2020, 5, 29, 11, 32, 42, 183000)),
+               ('c', Decimal128('1.5')),
+               ('d', Binary('\xff\x00')),
+               ('e', [1, u'x', {'f': Binary('ab', 0)}]),
+               ('g', uuid.UUID('61616161-6161-6161-6161-616161616161')),
+               ('h', Timestamp(1, 2)),
+               ('i', u'\u4e2d'),
+               ('j', Int64(1 << 40)),
+               ('k', [MinKey(), MaxKey()]),
+               ('l', object)])
+    res = json.loads(serializer.dumps(doc))
+    assert res == {'a': '5e56c076b61867f68c7eb410',
+                   'b': '2020-05-29T11:32:42.183000',
+                   'c': 1.5,
+                   'd': '/wA=',
+                   'e': [1, 'x', {'f': 'YWI='}],
+                   'g': '61616161-6161-6161-6161-616161616161',
+                   'h': {'t': 1, 'i': 2},
+                   'i': u'\u4e2d',
+                   'j': 1 << 40,
+                   'k': [{'$minKey': 1}, {'$maxKey': 1}],
+                   'l': u"<type 'object'>"}
+    assert isinstance(serializer.dumps(doc), str)
+    assert serializer.dumps({'a': Int64(5)}) == '{"a":5}'
+    assert serializer.dumps('{"a":1}') == '{"a":1}'
+    assert serializer.loads('{"a":1}') == {'a': 1}
+
+    print('test cases all pass')
@@ -1,20 +1,38 @@
+import sys
 import time
+import collections
+import multiprocessing
 import gevent
+import gevent.pool
 import pymongo
 import bson
 from pymongo import errors
-import elasticsearch
-import elasticsearch.helpers
+from mongosync import metrics, profiler
 from mongosync.logger import Logger
 from mongosync.common_syncer import CommonSyncer
 from mongosync.config import MongoConfig, EsConfig
-from mongosync.doc_utils import gen_doc_with_fields, doc_flat_to_nested, merge_doc
+from mongosync.doc_utils import set_to_nested
 from mongosync.mongo_utils import parse_namespace, gen_namespace
 from mongosync.mongo.handler import MongoHandler
 from mongosync.es.handler import EsHandler
+from mongosync.es.action_buffer import ActionBuffer
 
 log = Logger.get()
 
+_PARTITION_LOG_INTERVAL = 10  # seconds between progress logs of a partition
+
+
+class BulkFlush(object):
+    """ A bulk write of buffered actions in flight.
+    """
+    def __init__(self, optime, keys, n_bytes=0):
+        self.optime = optime  # optime of the last oplog in the flush
+        self.keys = keys  # keys of documents in the flush
+        self.n_bytes = n_bytes  # bytes of documents in the flush
+        self.traces = []  # traces of sampled oplogs in the flush
+        self.done = False
+        self.greenlet = None
+
 
 class EsSyncer(CommonSyncer):
     """ Elasticsearch synchronizer.
@@ -35,31 +53,176 @@ class EsSyncer(CommonSyncer):
         if not self._dst.connect():
             raise Exception('connect to elasticsearch(dst) failed: %s' % self._conf.dst_hostportstr)
 
-        self._action_buf = []  # used to bulk write oplogs
-        self._last_bulk_optime = None
+        self._action_buf = ActionBuffer()  # used to bulk write oplogs, folded by document
+        self._last_bulk_optime = None  # all oplogs before it are written
+        self._ns_cache = {}  # ns => (index name, type name, field projection)
+        self._traces = []  # traces of sampled oplogs in action buffer
+
+        # flushes in flight, ordered by optime
+        self._flushes = collections.deque()
+        self._flush_pool = gevent.pool.Pool(self._conf.dst_conf.oplog_flushes)
+
+        metrics.BUFFER_DEPTH.labels('es_actions').set_function(lambda: len(self._action_buf))
+        metrics.BUFFER_DEPTH.labels('es_flushes').set_function(lambda: len(self._flushes))
 
     def _action_buf_full(self):
         return len(self._action_buf) >= 400
 
+    def _ns_info(self, ns):
+        """ Return index name, type name and field projection of namespace.
+        """
+        info = self._ns_cache.get(ns)
+        if info is None:
+            dbname, collname = parse_namespace(ns)
+            idxname, typename = self._conf.db_coll_mapping(dbname, collname)
+            info = (idxname, typename, self._conf.fieldmap.get(gen_namespace(dbname, collname)))
+            self._ns_cache[ns] = info
+        return info
+
+    def _flush(self, optime):
+        """ Write buffered actions in background.
+
+        A flush waits for flushes in flight that write the same documents, so that
+        operations on a document are applied in order.
+        Block if flushes in flight reach the limit.
+        """
+        keys = set(self._action_buf.keys())
+        for flush in list(self._flushes):
+            if not flush.done and not keys.isdisjoint(flush.keys):
+                flush.greenlet.join()
+        n_bytes = self._memory.release_buffer('es_actions')
+        self._memory.add_bytes('es_flushes', '', n_bytes)
+        flush = BulkFlush(optime, keys, n_bytes)
+        flush.traces = self._traces
+        self._traces = []
+        self._tracer.submit(flush.traces)
+        actions = list(self._action_buf.actions())
+        self._action_buf.clear()
+        self._flushes.append(flush)
+        flush.greenlet = self._flush_pool.spawn(self._write_flush, flush, actions)
+
+    def _write_flush(self, flush, actions):
+        """ Write actions until success, then commit optime.
+        """
+        self._bulk_write(actions, 'oplogs before %s' % flush.optime)
+        self._memory.release('es_flushes', '', flush.n_bytes)
+        self._tracer.ack(flush.traces)
+        flush.done = True
+        self._commit_optime()
+
+    def _bulk_write(self, actions, desc):
+        """ Bulk write actions until all of them are written or dead lettered.
+        Only the actions that still failed after retries of handler are resent.
+        """
+        pending = self._dst.bulk_write(actions)
+        backoff = 1
+        while pending:
+            log.error('bulk write of %d actions of %s failed, retry in %ds' % (len(pending), desc, backoff))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            pending = self._dst.rewrite(pending)
+
+    def _commit_optime(self):
+        """ Advance optime to the highest one that all flushes before it are done.
+        """
+        while self._flushes and self._flushes[0].done:
+            self._last_bulk_optime = self._flushes.popleft().optime
+        self._log_optime(self._last_bulk_optime)
+
+    def _wait_flushes(self):
+        """ Wait for all flushes in flight.
+        """
+        self._flush_pool.join()
+
     def _sync_database(self, dbname):
         """ Sync a database.
         """
         log.info("sync database '%s'" % dbname)
         # create index
-        idxname = self._conf.db_mapping(dbname)
+        self._create_index(self._conf.db_mapping(dbname))
+        self._sync_collections(dbname)
+
+    def _initial_sync(self):
+        """ Initial sync.
+
+        Create indices with configured settings and mappings first.
+        In bulk load mode, refresh and replicas are disabled while loading,
+        and restored before stepping into oplog replay, or if initial sync fails.
+        """
+        idxnames = sorted(set(self._conf.db_mapping(dbname) for dbname, _ in self._collect_colls()))
+        for idxname in idxnames:
+            self._create_index(idxname)
+
+        saved_settings = {}
+        try:
+            if self._conf.dst_conf.bulk_load:
+                for idxname in idxnames:
+                    saved_settings[idxname] = self._get_bulk_load_settings(idxname)
+                    log.info('disable refresh and replicas of index %s for bulk load' % idxname)
+                    self._dst.client().indices.put_settings(index=idxname,
+                                                            body={'index': {'refresh_interval': '-1',
+                                                                            'number_of_replicas': 0}})
+
+            CommonSyncer._initial_sync(self)
+        except:
+            # raise the original error even if restoring fails
+            exc_info = sys.exc_info()
+            for idxname in sorted(saved_settings):
+                try:
+                    self._restore_settings(idxname, saved_settings[idxname])
+                except Exception as e:
+                    log.error('restore settings of index %s failed: %s, restore them manually: %s' % (
+                        idxname, e, saved_settings[idxname]))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for idxname in sorted(saved_settings):
+            self._restore_settings(idxname, saved_settings[idxname])
+
+        if self._conf.dst_conf.bulk_load and self._conf.dst_conf.max_num_segments > 0:
+            for idxname in idxnames:
+                log.info('force merge index %s' % idxname)
+                self._dst.client().indices.forcemerge(index=idxname,
+                                                      max_num_segments=self._conf.dst_conf.max_num_segments)
+
+    def _create_index(self, idxname):
+        """ Create index with configured settings and mappings if not existed.
+        """
         if self._dst.client().indices.exists(index=idxname):
             log.info('index already existed: %s' % idxname)
-        else:
-            log.info('create index: %s' % idxname)
-            self._dst.client().indices.create(index=idxname)
-        self._sync_collections(dbname)
+            return
+        log.info('create index: %s' % idxname)
+        body = {}
+        if self._conf.dst_conf.index_settings:
+            body['settings'] = self._conf.dst_conf.index_settings
+        if self._conf.dst_conf.index_mappings:
+            body['mappings'] = self._conf.dst_conf.index_mappings
+        self._dst.client().indices.create(index=idxname, body=body)
+
+    def _restore_settings(self, idxname, settings):
+        """ Restore settings saved before bulk load, and refresh index.
+        """
+        log.info('restore settings of index %s: %s' % (idxname, settings))
+        self._dst.client().indices.put_settings(index=idxname, body={'index': settings})
+        self._dst.client().indices.refresh(index=idxname)
+
+    def _get_bulk_load_settings(self, idxname):
+        """ Get current refresh interval and replicas of index, None means default value.
+        """
+        res = self._dst.client().indices.get_settings(index=idxname)
+        # keyed by the concrete index name, which differs if idxname is an alias
+        if len(res) != 1:
+            raise Exception('%s resolves to %d indices: %s' % (idxname, len(res), ', '.join(res.keys())))
+        settings = res.values()[0]['settings']['index']
+        return {'refresh_interval': settings.get('refresh_interval'),
+                'number_of_replicas': settings.get('number_of_replicas')}
 
     def _sync_collection(self, namespace_tuple):
         """ Sync a collection until success.
         """
         src_dbname, src_collname = namespace_tuple[0], namespace_tuple[1]
         idxname, typename = self._conf.db_coll_mapping(src_dbname, src_collname)
-        fields = self._conf.fieldmap.get(gen_namespace(src_dbname, src_collname))
+        ns = gen_namespace(src_dbname, src_collname)
+
+        self._progress_logger.begin(ns)
 
         while True:
             try:
@@ -68,48 +231,121 @@ class EsSyncer(CommonSyncer):
                                                                            cursor_type=pymongo.cursor.CursorType.EXHAUST,
                                                                            no_cursor_timeout=True,
                                                                            modifiers={'$snapshot': True})
-                count = cursor.count()
-                if count == 0:
-                    log.info('    skip empty collection')
-                    return
-
-                n = 0
-                actions = []
-                actions_max = 20
-                groups = []
-                groups_max = 10
-
-                for doc in cursor:
-                    id = str(doc['_id'])
-                    del doc['_id']
-                    source = gen_doc_with_fields(doc, fields) if fields else doc
-                    if source:
-                        actions.append(
-                            {'_op_type': 'index', '_index': idxname, '_type': typename, '_id': id, '_source': source})
-                    if len(actions) == actions_max:
-                        groups.append(actions)
-                        actions = []
-                    if len(groups) == groups_max:
-                        threads = [gevent.spawn(self._dst.bulk_write, groups[i]) for i in xrange(groups_max)]
-                        gevent.joinall(threads, raise_error=True)
-                        groups = []
-
-                    n += 1
-                    if n % 1000 == 0:
-                        log.info(
-                            '    %s.%s %d/%d (%.2f%%)' % (src_dbname, src_collname, n, count, float(n) / count * 100))
-
-                if len(groups) > 0:
-                    threads = [gevent.spawn(self._dst.bulk_write, groups[i]) for i in xrange(len(groups))]
-                    gevent.joinall(threads, raise_error=True)
-                if len(actions) > 0:
-                    elasticsearch.helpers.bulk(client=self._dst.client(), actions=actions)
-
-                log.info('    %s.%s %d/%d (%.2f%%)' % (src_dbname, src_collname, n, count, float(n) / count * 100))
+                self._index_docs(namespace_tuple, cursor)
+                self._progress_logger.done(ns)
+                return
+            except pymongo.errors.AutoReconnect:
+                self._src.reconnect()
+
+    def _sync_large_collection(self, namespace_tuple, split_points):
+        """ Sync large collection with a reader process per partition.
+        """
+        dbname, collname = namespace_tuple
+        ns = gen_namespace(dbname, collname)
+
+        log.info('pending to sync %s with %d processes' % (ns, len(split_points) + 1))
+
+        self._progress_logger.begin(ns)
+
+        queries = []
+        lower_bound = None
+        for point in split_points:
+            if lower_bound is None:
+                queries.append({'_id': {'$lt': point}})
+            else:
+                queries.append({'_id': {'$gte': lower_bound, '$lt': point}})
+            lower_bound = point
+        queries.append({'_id': {'$gte': lower_bound}})
+
+        procs = []
+        for i, query in enumerate(queries):
+            p = multiprocessing.Process(target=self._sync_collection_with_query,
+                                        args=(namespace_tuple, query, i))
+            p.start()
+            procs.append(p)
+            log.info('start process %s with query %s' % (p.name, query))
+
+        for p in procs:
+            p.join()
+        failed = [p for p in procs if p.exitcode != 0]
+        if failed:
+            # the partitions are incomplete, so don't go on to oplog sync
+            raise Exception('%d processes syncing %s failed, exit codes %s' % (
+                len(failed), ns, [p.exitcode for p in failed]))
+
+        self._progress_logger.done(ns)
+
+    def _sync_collection_with_query(self, namespace_tuple, query, partition):
+        """ Sync a partition of collection with query.
+        """
+        self._src.reconnect()
+        self._dst.reconnect()
+
+        src_dbname, src_collname = namespace_tuple
+
+        while True:
+            try:
+                coll = self._src.client()[src_dbname][src_collname]
+                cursor = coll.find(filter=query,
+                                   cursor_type=pymongo.cursor.CursorType.EXHAUST,
+                                   no_cursor_timeout=True)
+                n_docs = self._index_docs(namespace_tuple, cursor, partition)
+                log.info('partition %d of %s.%s done, %d docs' % (partition, src_dbname, src_collname, n_docs))
                 return
             except pymongo.errors.AutoReconnect:
                 self._src.reconnect()
 
+    def _index_docs(self, namespace_tuple, cursor, partition=None):
+        """ Index documents from cursor.
+        Progress of a partition is logged periodically if partition is given.
+        Return count of documents.
+        """
+        src_dbname, src_collname = namespace_tuple
+        idxname, typename = self._conf.db_coll_mapping(src_dbname, src_collname)
+        ns = gen_namespace(src_dbname, src_collname)
+        fields = self._conf.fieldmap.get(ns)
+
+        counter = {'total': 0, 'n': 0}
+        start_time = time.time()
+        partition_progress = {'logtime': start_time}
+        avg_obj_size = self._progress_logger.avg_obj_size(ns)
+
+        def log_partition_progress():
+            now = time.time()
+            if now - partition_progress['logtime'] < _PARTITION_LOG_INTERVAL:
+                return
+            partition_progress['logtime'] = now
+            n = counter['total']
+            log.info('partition %d of %s: %d docs, %.2f MB, %.0f docs/s' % (
+                partition, ns, n, float(n * avg_obj_size) / 1024 / 1024, n / (now - start_time)))
+
+        def gen_actions():
+            for doc in cursor:
+                profiler.lap('sync_collection', 'fetch')
+                id = str(doc['_id'])
+                del doc['_id']
+                source = fields.project(doc) if fields else doc
+                profiler.lap('sync_collection', 'convert')
+                if source:
+                    yield {'_op_type': 'index', '_index': idxname, '_type': typename, '_id': id, '_source': source}
+                    # serialized and sent by handler
+                    profiler.lap('sync_collection', 'apply')
+
+                counter['total'] += 1
+                counter['n'] += 1
+                if counter['n'] == 1000:
+                    self._progress_logger.add(ns, counter['n'])
+                    counter['n'] = 0
+                    if partition is not None:
+                        log_partition_progress()
+
+        # bulk requests are cut by payload size and sent in parallel by handler
+        self._bulk_write(gen_actions(), 'documents of %s.%s' % (src_dbname, src_collname))
+
+        if counter['n'] > 0:
+            self._progress_logger.add(ns, counter['n'])
+        return counter['total']
+
     def _replay_oplog(self, oplog_start):
         """ Replay oplog.
         """
@@ -119,6 +355,9 @@ class EsSyncer(CommonSyncer):
         n_skip = 0
 
         while True:
+            # restart from the last optime that all oplogs before it are written
+            oplog_start = self._last_bulk_optime
+
             # try to get cursor until success
             try:
                 host, port = self._src.client().address
@@ -146,6 +385,7 @@ class EsSyncer(CommonSyncer):
 
                         oplog = cursor.next()
                         n_total += 1
+                        profiler.lap('replay_oplog', 'fetch')
 
                         if not valid_start_optime:
                             if oplog['ts'] == oplog_start:
@@ -156,79 +396,56 @@ class EsSyncer(CommonSyncer):
                                 return
 
                         # validate oplog
-                        if not self._conf.data_filter.valid_oplog(oplog):
+                        valid = self._conf.data_filter.valid_oplog(oplog)
+                        profiler.lap('replay_oplog', 'filter')
+                        if not valid:
                             n_skip += 1
                             self._last_optime = oplog['ts']
                             continue
 
                         op = oplog['op']
                         ns = oplog['ns']
+                        metrics.OPLOG_OPS.labels(ns, op).inc()
+                        trace = self._tracer.read(oplog)
+                        if trace:
+                            self._traces.append(trace)
+                        if op in ('i', 'u'):
+                            self._memory.add('es_actions', ns, oplog['o'])
 
                         if op == 'i':  # insert
-                            dbname, collname = parse_namespace(ns)
-                            idxname, typename = self._conf.db_coll_mapping(dbname, collname)
-                            fields = self._conf.fieldmap.get(gen_namespace(dbname, collname))
+                            idxname, typename, fields = self._ns_info(ns)
 
                             doc = oplog['o']
                             id = str(doc['_id'])
                             del doc['_id']
                             if fields:
-                                doc = gen_doc_with_fields(doc, fields)
+                                doc = fields.project(doc)
                             if doc:
-                                self._action_buf.append(
-                                    {'_op_type': 'index', '_index': idxname, '_type': typename, '_id': id,
-                                     '_source': doc})
+                                self._action_buf.index(idxname, typename, id, doc)
 
                         elif op == 'u':  # update
-                            dbname, collname = parse_namespace(ns)
-                            idxname, typename = self._conf.db_coll_mapping(dbname, collname)
-                            fields = self._conf.fieldmap.get(gen_namespace(dbname, collname))
+                            idxname, typename, fields = self._ns_info(ns)
 
                             id = str(oplog['o2']['_id'])
 
                             if '$set' in oplog['o']:
-                                doc = {}
-                                for k, v in oplog['o']['$set'].iteritems():
-                                    if not fields or k in fields:
-                                        sub_doc = doc_flat_to_nested(k.split('.'), v)
-                                        merge_doc(doc, sub_doc)
+                                doc = set_to_nested(oplog['o']['$set'], fields)
                                 if doc:
-                                    self._action_buf.append({'_op_type': 'update',
-                                                             '_index': idxname,
-                                                             '_type': typename,
-                                                             '_id': id,
-                                                             '_retry_on_conflict': 3,
-                                                             'doc': doc,
-                                                             'doc_as_upsert': True})
+                                    self._action_buf.set(idxname, typename, id, doc)
 
                             if '$unset' in oplog['o']:
-                                script_statements = []
-                                for keypath in oplog['o']['$unset'].iterkeys():
-                                    if not fields or keypath in fields:
-                                        pos = keypath.rfind('.')
-                                        if pos >= 0:
-                                            script_statements.append(
-                                                'ctx._source.%s.remove("%s")' % (keypath[:pos], keypath[pos + 1:]))
-                                        else:
-                                            script_statements.append('ctx._source.remove("%s")' % keypath)
-                                if script_statements:
-                                    doc = {'script': '; '.join(script_statements)}
-                                    self._action_buf.append({'_op_type': 'update',
-                                                             '_index': idxname,
-                                                             '_type': typename,
-                                                             '_id': id,
-                                                             '_retry_on_conflict': 3,
-                                                             'script': doc['script']})
+                                keypaths = [keypath for keypath in oplog['o']['$unset'].iterkeys()
+                                            if not fields or fields.covers(keypath)]
+                                if keypaths:
+                                    self._action_buf.unset(idxname, typename, id, keypaths)
 
                             if '$set' not in oplog['o'] and '$unset' not in oplog['o']:
                                 log.warn('unexpect oplog: %s', oplog['o'])
 
                         elif op == 'd':  # delete
-                            dbname, collname = parse_namespace(ns)
-                            idxname, typename = self._conf.db_coll_mapping(dbname, collname)
+                            idxname, typename, _ = self._ns_info(ns)
                             id = str(oplog['o']['_id'])
-                            self._action_buf.append(
-                                {'_op_type': 'delete', '_index': idxname, '_type': typename, '_id': id})
+                            self._action_buf.delete(idxname, typename, id)
 
                         elif op == 'c':  # command
                             dbname, _ = parse_namespace(ns)
@@ -239,6 +456,10 @@ class EsSyncer(CommonSyncer):
                                 pass
                                 log.warn('you should implement document type deletion.')
                             if 'dropDatabase' in oplog['o']:
+                                # apply buffered actions first
+                                if len(self._action_buf) > 0:
+                                    self._flush(self._last_optime)
+                                self._wait_flushes()
                                 # delete index
                                 self._dst.client().indices.delete(index=idxname)
 
@@ -247,32 +468,38 @@ class EsSyncer(CommonSyncer):
                         else:
                             log.error('invalid optype: %s' % oplog)
 
+                        profiler.lap('replay_oplog', 'convert')
+
                         # flush
-                        if self._action_buf_full():
-                            self._dst.bulk_write(self._action_buf)
-                            self._action_buf = []
-                            self._last_bulk_optime = oplog['ts']
-                            self._log_optime(self._last_bulk_optime)
+                        if self._action_buf_full() or self._memory.over_budget():
+                            self._flush(oplog['ts'])
+                            if self._memory.over_budget():
+                                # flushes in flight hold too many documents
+                                self._wait_flushes()
+                        profiler.lap('replay_oplog', 'apply')
 
                         self._last_optime = oplog['ts']
                         self._log_progress()
+                        profiler.lap('replay_oplog', 'checkpoint')
                     except StopIteration as e:
                         # flush
                         if len(self._action_buf) > 0:
-                            self._dst.bulk_write(self._action_buf)
-                            self._action_buf = []
-                            self._last_bulk_optime = self._last_optime
+                            self._flush(self._last_optime)
                         self._log_optime(self._last_bulk_optime)
                         self._log_progress('latest')
                         time.sleep(0.1)
+                        profiler.lap('replay_oplog', 'idle')
                     except pymongo.errors.AutoReconnect as e:
                         log.error(e)
+                        # oplogs in buffer will be read again
+                        self._wait_flushes()
+                        self._action_buf.clear()
+                        self._memory.release_buffer('es_actions')
+                        self._traces = []
                         self._src.reconnect()
                         break
-                    except elasticsearch.helpers.BulkIndexError as e:
-                        log.error(e)
-                        self._action_buf = []
             except IndexError as e:
                 log.error(e)
                 log.error('%s not found, terminate' % oplog_start)
                 return
+
@@ -1,6 +1,187 @@
+import os
 import sys
+import time
+import atexit
+import collections
 import logging
 import logging.handlers
+import multiprocessing.util
+from gevent import monkey
+
+# a real thread even if patched by gevent, so that file I/O never blocks the event loop
+_start_new_thread = monkey.get_original('thread', 'start_new_thread')
+_allocate_lock = monkey.get_original('thread', 'allocate_lock')
+_get_ident = monkey.get_original('thread', 'get_ident')
+_sleep = monkey.get_original('time', 'sleep')
+
+# argument types that are safe to format later on another thread
+_IMMUTABLE_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
+class _RLock(object):
+    """ Reentrant lock of real threads.
+    Locks of patched threading are gevent locks, which must not be shared by threads.
+    """
+    def __init__(self):
+        self._block = _allocate_lock()
+        self._owner = None
+        self._count = 0
+
+    def acquire(self, blocking=1):
+        me = _get_ident()
+        if self._owner == me:
+            self._count += 1
+            return True
+        if not self._block.acquire(blocking):
+            return False
+        self._owner = me
+        self._count = 1
+        return True
+
+    def release(self):
+        if self._owner != _get_ident():
+            raise RuntimeError('cannot release un-acquired lock')
+        self._count -= 1
+        if self._count == 0:
+            self._owner = None
+            self._block.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RateLimiter(object):
+    """ Suppress records of the same message template beyond burst in an interval, and count them.
+    """
+    def __init__(self, burst=50, interval=10):
+        self._burst = burst
+        self._interval = interval
+        self._windows = {}  # (levelno, msg) => [start time, count]
+
+    def allow(self, record):
+        key = (record.levelno, record.msg)
+        window = self._windows.get(key)
+        if window is None:
+            self._windows[key] = [record.created, 1]
+            return True
+        window[1] += 1
+        return window[1] <= self._burst
+
+    def summaries(self, now, all_windows=False):
+        """ Return records summarizing templates suppressed in the ended intervals, or in all if all_windows.
+        """
+        records = []
+        for key, window in self._windows.items():
+            if now - window[0] < self._interval and not all_windows:
+                continue
+            del self._windows[key]
+            n_suppressed = window[1] - self._burst
+            if n_suppressed > 0:
+                levelno, msg = key
+                records.append(logging.LogRecord(
+                    _LOGGER_NAME, levelno, __file__, 0,
+                    'suppressed %d similar messages in %.0fs: %s', (n_suppressed, now - window[0], msg), None))
+        return records
+
+
+class AsyncHandler(logging.Handler):
+    """ Hand records over to a background thread that writes them through target handler.
+
+    Records are formatted on the background thread, unless they have arguments that could be
+    changed by the caller later, which are formatted before handing over.
+    Repeated message templates are rate limited.
+    The thread is restarted lazily in forked processes. At exit it is stopped,
+    and the rest of the queue is written on the exiting thread.
+    """
+    def __init__(self, target, rate_limiter=None, poll_interval=0.05):
+        logging.Handler.__init__(self)
+        self._target = target
+        # target is used by the background thread and by the main thread at exit
+        self._target.lock = _RLock()
+        self._rate_limiter = rate_limiter
+        self._poll_interval = poll_interval
+        self._q = collections.deque()  # append and popleft are thread safe
+        self._pid = None  # process of the running thread
+        self._running = None  # held by the running thread
+        self._stopped = False
+
+    def emit(self, record):
+        if self._rate_limiter and not self._rate_limiter.allow(record):
+            return
+        if record.args and not (isinstance(record.args, tuple) and
+                                all(type(arg) in _IMMUTABLE_TYPES for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # traceback is not available later
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self._stopped:
+            self._target.handle(record)
+            return
+        self._q.append(record)
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._running = _allocate_lock()
+            self._running.acquire()
+            _start_new_thread(self._run, ())
+
+    def _run(self):
+        pid = os.getpid()
+        try:
+            while self._pid == pid:
+                if not self.drain():
+                    _sleep(self._poll_interval)
+        finally:
+            self._running.release()
+
+    def stop(self):
+        """ Stop the thread, then write the rest on the calling thread.
+        """
+        self._stopped = True
+        if self._pid == os.getpid():
+            self._pid = None
+            # wait for the thread to finish the record in hand
+            self._running.acquire()
+        self.flush()
+
+    def drain(self, all_summaries=False):
+        """ Write all queued records.
+        Return True if any record is written.
+        """
+        written = False
+        if self._rate_limiter:
+            for record in self._rate_limiter.summaries(time.time(), all_summaries):
+                self._q.append(record)
+        while True:
+            try:
+                record = self._q.popleft()
+            except IndexError:
+                # drained, maybe by another thread at exit
+                return written
+            self._target.handle(record)
+            written = True
+
+    def after_fork(self):
+        """ Drop records queued before fork, which are written by parent,
+        and drain the queue at exit, since processes of multiprocessing exit without atexit handlers.
+        """
+        self._q.clear()
+        multiprocessing.util.Finalize(None, self.stop, exitpriority=0)
+
+    def flush(self):
+        self.drain(all_summaries=True)
+        self._target.flush()
+
+    def close(self):
+        self.flush()
+        self._target.close()
+        logging.Handler.close(self)
+
+
+_LOGGER_NAME = 'py-mongo-sync'
 
 
 class Logger(object):
@@ -9,23 +190,68 @@ class Logger(object):
     @staticmethod
     def init(filepath):
         """ Init logger.
+        Records are written by a background thread.
         """
-        logger = logging.getLogger('py-mongo-sync')
+        logger = logging.getLogger(_LOGGER_NAME)
         logger.setLevel(logging.INFO)
         formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
         if filepath:
             handler_log = logging.handlers.RotatingFileHandler(filepath, mode='a', maxBytes=1024*1024*100, backupCount=3)
             handler_log.setFormatter(formatter)
             handler_log.setLevel(logging.INFO)
-            logger.addHandler(handler_log)
+            handler = AsyncHandler(handler_log, RateLimiter())
         else:
             handler_stdout = logging.StreamHandler(sys.stdout)
             handler_stdout.setFormatter(formatter)
             handler_stdout.setLevel(logging.INFO)
-            logger.addHandler(handler_stdout)
+            handler = AsyncHandler(handler_stdout, RateLimiter())
+        logger.addHandler(handler)
+        atexit.register(handler.stop)
+        multiprocessing.util.register_after_fork(handler, AsyncHandler.after_fork)
 
     @staticmethod
     def get():
         """ Get logger.
         """
-        return logging.getLogger('py-mongo-sync')
+        return logging.getLogger(_LOGGER_NAME)
+
+
+if __name__ == '__main__':
+    import tempfile
+    filepath = tempfile.mktemp()
+    Logger.init(filepath)
+    log = Logger.get()
+    doc = {'a': 1}
+    log.info('doc: %s', doc)
+    doc['a'] = 2
+    for i in xrange(100):
+        log.info('ignore duplicate key error: %s', i)
+    handler = log.handlers[0]
+    _sleep(0.2)
+    with open(filepath) as f:
+        lines = f.readlines()
+    assert "doc: {'a': 1}" in lines[0]
+    assert len(lines) == 51
+
+    handler._rate_limiter._windows[(logging.INFO, 'ignore duplicate key error: %s')][0] -= 10
+    handler.drain()
+    with open(filepath) as f:
+        assert 'suppressed 50 similar messages in 10s: ignore duplicate key error: %s' in f.readlines()[-1]
+
+    lock = handler._target.lock
+    with lock:
+        with lock:
+            _start_new_thread(lambda: (lock.acquire(), log.info('from thread'), lock.release()), ())
+            _sleep(0.1)
+            assert not lock._block.acquire(0)
+    _sleep(0.2)
+    with open(filepath) as f:
+        assert 'from thread' in f.readlines()[-1]
+
+    p = multiprocessing.Process(target=lambda: log.info('from child'))
+    p.start()
+    p.join()
+    with open(filepath) as f:
+        assert 'from child' in f.readlines()[-1]
+    os.remove(filepath)
+    print('test cases all pass')
@@ -0,0 +1,218 @@
+import os
+import gc
+import sys
+import time
+import signal
+import resource
+import collections
+import multiprocessing
+import bson
+from bson.raw_bson import RawBSONDocument
+from mongosync import metrics
+from mongosync.logger import Logger
+
+try:
+    # available in Python 3.4+ or Python 2 patched for pytracemalloc
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = Logger.get()
+
+_PAGE_SIZE = resource.getpagesize()
+
+# decoded documents of a namespace are encoded to measure one in every _SAMPLE_EVERY
+_SAMPLE_EVERY = 64
+
+
+def doc_size(doc):
+    """ Return BSON size of document.
+    """
+    if isinstance(doc, RawBSONDocument):
+        return len(doc.raw)
+    try:
+        return len(bson.BSON.encode(doc))
+    except Exception:
+        return sys.getsizeof(doc)
+
+
+def rss():
+    """ Return resident set size of current process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except IOError:
+        # peak instead of current if procfs is unavailable
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryAccount(object):
+    """ Bytes of documents held by buffers, per buffer and namespace.
+
+    Sizes are measured by BSON size, and only if a budget is set, otherwise it costs nothing.
+    Raw documents are measured by their bytes. Decoded ones are estimated by the average size
+    of sampled ones in the same buffer and namespace, so that they are not encoded twice.
+    The total is in shared memory, so that the budget is shared by the processes forked after its creation.
+    Readers should check over_budget() and write or wait for buffered documents if it's True.
+    """
+    def __init__(self, budget_mb=0):
+        self._budget = int(budget_mb * 1024 * 1024)
+        self.enabled = self._budget > 0
+        self._total = multiprocessing.Value('l', 0) if self.enabled else None
+        self._bytes = collections.defaultdict(int)  # (buffer, ns) => bytes of current process
+        self._samples = {}  # (buffer, ns) => [documents added, documents sampled, bytes sampled]
+
+    def add(self, buffer, ns, doc):
+        """ Account a document held by buffer.
+        Return its size.
+        """
+        if not self.enabled:
+            return 0
+        if isinstance(doc, RawBSONDocument):
+            n = len(doc.raw)
+        else:
+            samples = self._samples.get((buffer, ns))
+            if samples is None:
+                samples = self._samples[(buffer, ns)] = [0, 0, 0]
+            if samples[0] % _SAMPLE_EVERY == 0:
+                samples[1] += 1
+                samples[2] += doc_size(doc)
+            samples[0] += 1
+            n = samples[2] / samples[1]
+        self.add_bytes(buffer, ns, n)
+        return n
+
+    def add_bytes(self, buffer, ns, n):
+        if not self.enabled or n == 0:
+            return
+        key = (buffer, ns)
+        if key not in self._bytes:
+            metrics.BUFFER_BYTES.labels(buffer, ns).set_function(lambda: self._bytes.get(key, 0))
+        self._bytes[key] += n
+        with self._total.get_lock():
+            self._total.value += n
+
+    def release(self, buffer, ns, n):
+        """ Release bytes of documents released by buffer.
+        """
+        if not self.enabled or n == 0:
+            return
+        self._bytes[(buffer, ns)] -= n
+        with self._total.get_lock():
+            self._total.value -= n
+
+    def release_buffer(self, buffer):
+        """ Release all documents of buffer.
+        Return bytes released.
+        """
+        if not self.enabled:
+            return 0
+        n = 0
+        for key in self._bytes.keys():
+            if key[0] == buffer and self._bytes[key]:
+                n += self._bytes[key]
+                self._bytes[key] = 0
+        with self._total.get_lock():
+            self._total.value -= n
+        return n
+
+    def over_budget(self):
+        return self.enabled and self._total.value > self._budget
+
+    @property
+    def total(self):
+        return self._total.value if self.enabled else 0
+
+    @property
+    def budget(self):
+        return self._budget
+
+    def summary(self):
+        """ Return bytes of buffers and namespaces in descending order.
+        """
+        items = sorted(((n, buffer, ns) for (buffer, ns), n in self._bytes.iteritems() if n), reverse=True)
+        return ', '.join('%s %s %.1fMB' % (buffer, ns, float(n) / 1024 / 1024) for n, buffer, ns in items)
+
+
+_output_dir = '.'
+_last_snapshot = None
+
+
+def dump_snapshot():
+    """ Dump memory usage into file.
+
+    If tracemalloc is available, the first dump starts tracing, and the later ones write top allocations
+    and the differences from the previous dump.
+    Otherwise objects tracked by gc are counted and sized by type.
+    Return filepath.
+    """
+    global _last_snapshot
+    filepath = os.path.join(_output_dir, 'mongosync-memory-%d-%s.txt' % (os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+    with open(filepath, 'w') as f:
+        f.write('rss: %.1fMB\n\n' % (float(rss()) / 1024 / 1024))
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(16)
+                f.write('tracemalloc started, dump again later to see allocations\n\n')
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                f.write('top allocations:\n')
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write('%s\n' % stat)
+                if _last_snapshot is not None:
+                    f.write('\ndifferences from the previous dump:\n')
+                    for stat in snapshot.compare_to(_last_snapshot, 'lineno')[:50]:
+                        f.write('%s\n' % stat)
+                _last_snapshot = snapshot
+                f.write('\n')
+
+        counts = collections.Counter()
+        sizes = collections.Counter()
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] += 1
+            sizes[name] += sys.getsizeof(obj, 0)
+        f.write('objects tracked by gc, by type:\n')
+        for name, size in sizes.most_common(50):
+            f.write('%10d objects %10.1fMB %s\n' % (counts[name], float(size) / 1024 / 1024, name))
+    log.info('dump memory usage into %s' % filepath)
+    return filepath
+
+
+def install(signum=signal.SIGUSR1, output_dir='.'):
+    """ Dump memory usage on signal, and write files into output_dir.
+    """
+    global _output_dir
+    _output_dir = output_dir
+    signal.signal(signum, lambda s, f: dump_snapshot())
+    metrics.RSS_BYTES.labels().set_function(rss)
+
+
+if __name__ == '__main__':
+    account = MemoryAccount(0)
+    assert account.add('b', 'db.coll', {'a': 1}) == 0
+    assert not account.over_budget()
+
+    account = MemoryAccount(1.0 / 1024)  # 1KB
+    doc = {'a': 'x' * 500}
+    n = account.add('b', 'db.coll', doc)
+    assert n == doc_size(doc) and account.total == n
+    assert not account.over_budget()
+    account.add('b', 'db.coll1', doc)
+    account.add('c', 'db.coll', doc)
+    assert account.over_budget()
+    assert account.release_buffer('b') == 2 * n
+    account.release('c', 'db.coll', n)
+    assert account.total == 0 and not account.over_budget()
+    raw = RawBSONDocument(bson.BSON.encode({'a': 'x' * 100}))
+    assert account.add('r', 'db.coll', raw) == len(raw.raw)
+    # estimated by the sampled one until the next sample
+    assert account.add('b', 'db.coll', {'a': 'x' * 200}) == n
+    account.release_buffer('r')
+    account.release_buffer('b')
+    assert rss() > 0
+
+    _output_dir = '/tmp'
+    os.remove(dump_snapshot())
+    print('test cases all pass')
@@ -0,0 +1,303 @@
+import bisect
+import math
+import multiprocessing
+import multiprocessing.util
+import gevent.pywsgi
+from mongosync import profiler
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+
+class _LocalValue(object):
+    """ Value of a metric series owned by the current process.
+    """
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, n):
+        self.value += n
+
+
+class _SharedValue(object):
+    """ Value of a metric series in shared memory.
+    It is updated by the processes forked after its creation.
+    """
+    def __init__(self):
+        self._value = multiprocessing.Value('d', 0.0)
+
+    @property
+    def value(self):
+        return self._value.value
+
+    @value.setter
+    def value(self, v):
+        self._value.value = v
+
+    def inc(self, n):
+        with self._value.get_lock():
+            self._value.value += n
+
+
+class Metric(object):
+    """ Base of metrics with labels.
+
+    A series is created on the first call of labels() with the label values, keep the returned series
+    to avoid looking it up on hot paths.
+    """
+    type = None
+
+    def __init__(self, name, doc, labelnames=(), shared=False):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.shared = shared
+        self._series = {}  # label values => series
+        _registry.append(self)
+
+    def labels(self, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise Exception('%s expects labels %s' % (self.name, self.labelnames))
+            series = self._series[labelvalues] = self._new_series()
+        return series
+
+    def _new_series(self):
+        raise NotImplementedError('you should implement %s._new_series' % self.__class__.__name__)
+
+    def expose(self):
+        """ Return lines in Prometheus text format.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s %s' % (self.name, self.type)]
+        for labelvalues, series in sorted(self._series.items()):
+            lines.extend(series.expose(self.name, zip(self.labelnames, labelvalues)))
+        return lines
+
+
+class _CounterSeries(object):
+    def __init__(self, shared):
+        self._value = _SharedValue() if shared else _LocalValue()
+
+    def inc(self, n=1):
+        self._value.inc(n)
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def expose(self, name, labels):
+        return ['%s%s %s' % (name, _format_labels(labels), _format_value(self._value.value))]
+
+
+class Counter(Metric):
+    """ Monotonically increasing value.
+    """
+    type = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries(self.shared)
+
+
+class _GaugeSeries(object):
+    def __init__(self, shared):
+        self._value = _SharedValue() if shared else _LocalValue()
+        self._func = None
+
+    def set(self, value):
+        self._value.value = value
+
+    def set_function(self, func):
+        """ Get value from func on exposing, so that it costs nothing to keep up to date.
+        """
+        self._func = func
+
+    @property
+    def value(self):
+        return self._func() if self._func else self._value.value
+
+    def expose(self, name, labels):
+        return ['%s%s %s' % (name, _format_labels(labels), _format_value(self.value))]
+
+
+class Gauge(Metric):
+    """ Value that goes up and down.
+    """
+    type = 'gauge'
+
+    def _new_series(self):
+        return _GaugeSeries(self.shared)
+
+
+class _HistogramSeries(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def expose(self, name, labels):
+        lines = []
+        n = 0
+        for bound, count in zip(self._buckets + ['+Inf'], self._counts):
+            n += count
+            le = bound if isinstance(bound, str) else _format_value(bound)
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels + [('le', le)]), n))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(self._sum)))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), n))
+        return lines
+
+
+class Histogram(Metric):
+    """ Distribution of values in cumulative buckets.
+    Only observed in the current process.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=()):
+        Metric.__init__(self, name, doc, labelnames)
+        self._buckets = sorted(buckets)
+
+    def _new_series(self):
+        return _HistogramSeries(self._buckets)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _format_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value):
+        return '%d' % value
+    return repr(float(value))
+
+
+_registry = []
+
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+REPLICATION_LATENCY_BUCKETS = LATENCY_BUCKETS + [300, 900, 3600]
+SIZE_BUCKETS = [1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+OPLOG_OPS = Counter('mongosync_oplog_ops_total', 'Oplog entries applied.', ('ns', 'op'))
+BULK_WRITE_SECONDS = Histogram('mongosync_bulk_write_seconds', 'Latency of bulk writes to destination.',
+                               ('dst',), LATENCY_BUCKETS)
+BULK_WRITE_SIZE = Histogram('mongosync_bulk_write_size', 'Operations in a bulk write to destination.',
+                            ('dst',), SIZE_BUCKETS)
+REPLICATION_LATENCY = Histogram('mongosync_replication_latency_seconds',
+                                'Latency of sampled oplogs by stage: fetch, batch, apply and total.',
+                                ('ns', 'stage'), REPLICATION_LATENCY_BUCKETS)
+REPLAY_LAG = Gauge('mongosync_replay_lag_seconds', 'Seconds between now and the optime of the last applied oplog.')
+BUFFER_DEPTH = Gauge('mongosync_buffer_depth', 'Entries buffered in memory.', ('buffer',))
+RECONNECTS = Counter('mongosync_reconnects_total', 'Reconnections to source or destination.', ('host',))
+BUFFER_BYTES = Gauge('mongosync_buffer_bytes', 'BSON bytes of documents held by buffers, if memory budget is set.',
+                     ('buffer', 'ns'))
+RSS_BYTES = Gauge('mongosync_rss_bytes', 'Resident set size of process.')
+INITIAL_SYNC_DOCS = Counter('mongosync_initial_sync_docs_total', 'Documents copied by initial sync.',
+                            ('ns',), shared=True)
+INITIAL_SYNC_BYTES = Counter('mongosync_initial_sync_bytes_total',
+                             'Bytes copied by initial sync, estimated by average object size.',
+                             ('ns',), shared=True)
+INITIAL_SYNC_TOTAL_DOCS = Gauge('mongosync_initial_sync_total_docs', 'Documents to copy by initial sync.', ('ns',))
+INITIAL_SYNC_DOCS_RATE = Gauge('mongosync_initial_sync_docs_per_second',
+                               'Documents copied per second by initial sync in the recent minute, ns is * for overall.',
+                               ('ns',))
+INITIAL_SYNC_BYTES_RATE = Gauge('mongosync_initial_sync_bytes_per_second',
+                                'Bytes copied per second by initial sync in the recent minute, ns is * for overall.',
+                                ('ns',))
+INITIAL_SYNC_ETA = Gauge('mongosync_initial_sync_eta_seconds',
+                         'Estimated seconds to finish initial sync, -1 if unknown, ns is * for overall.', ('ns',))
+VERIFY_DOCS = Counter('mongosync_verify_docs_total',
+                      'Sampled documents verified during oplog replay by result: match, mismatch or inconclusive.',
+                      ('ns', 'result'))
+VERIFY_MISMATCH_RATIO = Gauge('mongosync_verify_mismatch_ratio',
+                              'Ratio of mismatched documents in the last verify round, inconclusive ones excluded.')
+
+
+def expose():
+    """ Return all metrics in Prometheus text format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+_LOCAL_ADDRS = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+
+def _app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path in ('/profiler/start', '/profiler/stop'):
+        # the server is unauthenticated, state changing paths are served to local POST only
+        if environ.get('REMOTE_ADDR') not in _LOCAL_ADDRS:
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return ['forbidden\n']
+        if environ['REQUEST_METHOD'] != 'POST':
+            start_response('405 Method Not Allowed', [('Content-Type', 'text/plain'), ('Allow', 'POST')])
+            return ['method not allowed\n']
+    if path == '/metrics':
+        body = expose()
+    elif path == '/profiler/start':
+        profiler.enable()
+        body = 'profiler on\n'
+    elif path == '/profiler/stop':
+        body = profiler.disable() + '\n'
+    else:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['not found\n']
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def start_server(port):
+    """ Serve metrics on http://0.0.0.0:port/metrics in background.
+    The profiler is switched by POST to /profiler/start and /profiler/stop from localhost as well.
+    """
+    server = gevent.pywsgi.WSGIServer(('0.0.0.0', port), _app, log=None)
+    server.start()
+    # processes forked for large collections should not serve
+    multiprocessing.util.register_after_fork(server, lambda s: s.close())
+    log.info('serve metrics on port %d' % port)
+    return server
+
+
+if __name__ == '__main__':
+    OPLOG_OPS.labels('db.coll', 'i').inc()
+    OPLOG_OPS.labels('db.coll', 'i').inc(2)
+    BULK_WRITE_SECONDS.labels('mongodb').observe(0.003)
+    BULK_WRITE_SECONDS.labels('mongodb').observe(100)
+    REPLAY_LAG.labels().set_function(lambda: 1.5)
+    INITIAL_SYNC_DOCS.labels('db.coll').inc(10)
+    p = multiprocessing.Process(target=lambda: INITIAL_SYNC_DOCS.labels('db.coll').inc(5))
+    p.start()
+    p.join()
+    text = expose()
+    assert 'mongosync_oplog_ops_total{ns="db.coll",op="i"} 3\n' in text
+    assert 'mongosync_bulk_write_seconds_bucket{dst="mongodb",le="0.005"} 1\n' in text
+    assert 'mongosync_bulk_write_seconds_bucket{dst="mongodb",le="+Inf"} 2\n' in text
+    assert 'mongosync_bulk_write_seconds_count{dst="mongodb"} 2\n' in text
+    assert 'mongosync_replay_lag_seconds 1.5\n' in text
+    assert 'mongosync_initial_sync_docs_total{ns="db.coll"} 15\n' in text
+    assert _format_labels([('a', 'x"y')]) == '{a="x\\"y"}'
+    def request(method, path, addr):
+        status = []
+        _app({'PATH_INFO': path, 'REQUEST_METHOD': method, 'REMOTE_ADDR': addr},
+             lambda s, headers: status.append(s))
+        return status[0]
+    assert request('GET', '/metrics', '10.0.0.1') == '200 OK'
+    assert request('POST', '/profiler/stop', '10.0.0.1') == '403 Forbidden'
+    assert request('GET', '/profiler/stop', '127.0.0.1') == '405 Method Not Allowed'
+    assert request('POST', '/profiler/stop', '127.0.0.1') == '200 OK'
+    assert [_format_value(v) for v in (float('inf'), float('-inf'), float('nan'), 3.0, 0.5)] == [
+        '+Inf', '-Inf', 'NaN', '3', '0.5']
+    print('test cases all pass')
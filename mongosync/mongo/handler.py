@@ -1,36 +1,68 @@
+import os
 import sys
 import time
 import pymongo
 import bson
 from pymongo import errors
 
-from mongosync import mongo_utils
+from mongosync import mongo_utils, metrics
 from mongosync.config import MongoConfig
 from mongosync.logger import Logger
 
 log = Logger.get()
 
 
+class MemberUnreachable(SystemExit):
+    """ The pinned member is unreachable, and the sync must terminate.
+    It is a SystemExit, so retry loops don't catch it, and gevent raises it in the main greenlet
+    if it is raised in another greenlet. A forked process exits with code 1 by it.
+    """
+
+
 class MongoHandler(object):
     def __init__(self, conf):
         if not isinstance(conf, MongoConfig):
             raise Exception('expect MongoConfig')
         self._conf = conf
         self._mc = None
+        self._pid = None  # process that the client belongs to
+        self._read_preference = mongo_utils.get_read_preference(conf.read_preference, conf.read_preference_tags)
+        self._member = None  # (host, port) of the pinned member if not read from primary
+        self._bulk_write_seconds = metrics.BULK_WRITE_SECONDS.labels('mongodb')
+        self._bulk_write_size = metrics.BULK_WRITE_SIZE.labels('mongodb')
 
     def __del__(self):
         self.close()
 
+    @property
+    def pinned(self):
+        """ Return True if all reads go to a pinned member.
+        """
+        return self._conf.read_preference != 'primary'
+
     def connect(self):
         """ Connect to server.
+
+        If read preference is not primary, select a member once and connect to it directly,
+        so that optimes and data are always read from the same member.
         """
         try:
             if isinstance(self._conf.hosts, unicode):
                 host, port = mongo_utils.parse_hostportstr(self._conf.hosts)
-                self._mc = mongo_utils.connect(host, port, ssl=self._conf.ssl,
-                                               authdb=self._conf.authdb,
-                                               username=self._conf.username,
-                                               password=self._conf.password)
+                kwargs = {'ssl': self._conf.ssl,
+                          'authdb': self._conf.authdb,
+                          'username': self._conf.username,
+                          'password': self._conf.password}
+                if self.pinned:
+                    if self._member is None:
+                        self._member = mongo_utils.select_member(host, port, self._read_preference, **kwargs)
+                        log.info('pin to member %s:%d with read preference %s' % (
+                            self._member[0], self._member[1], self._read_preference))
+                    host, port = self._member
+                    self._mc = mongo_utils.get_client(host, port, direct=True, **kwargs)
+                else:
+                    self._mc = mongo_utils.get_client(host, port, **kwargs)
+                self._pid = os.getpid()
                 self._mc.admin.command('ismaster')
                 return True
             else:
@@ -41,23 +73,34 @@ class MongoHandler(object):
 
     def reconnect(self):
         """ Try to reconnect until success.
+
+        The client is kept and the driver rediscovers the primary by server selection.
+        A new client is only got in a forked process.
+        If the pinned member is unreachable after several failures, raise MemberUnreachable to terminate,
+        since reading from another member breaks the consistency of initial sync and oplog tailing.
         """
+        metrics.RECONNECTS.labels(self._conf.hosts).inc()
+        n_failures = 0
         while True:
             try:
-                self.close()
-                self.connect()
+                if self._mc is None or self._pid != os.getpid():
+                    self.connect()
                 self.client().admin.command('ismaster')
                 return
             except Exception as e:
                 log.error('reconnect failed: %s' % e)
+                n_failures += 1
+                if self._member and n_failures >= 10:
+                    raise MemberUnreachable('pinned member %s:%d is unreachable, terminate, '
+                                            'restart to select a member and resume from the checkpoint'
+                                            % self._member)
                 time.sleep(1)
 
     def close(self):
         """ Close connection.
+        The client is owned by the connection registry, so just drop it.
         """
-        if self._mc:
-            self._mc.close()
-            self._mc = None
+        self._mc = None
 
     def client(self):
         return self._mc
@@ -80,17 +123,20 @@ class MongoHandler(object):
         #     log.info('Process %d ops on %s.%s' % (len(reqs), dbname, collname))
         while True:
             try:
+                t = time.time()
                 self._mc[dbname][collname].bulk_write(reqs,
                                                       ordered=ordered,
                                                       bypass_document_validation=False)
+                self._bulk_write_seconds.observe(time.time() - t)
+                self._bulk_write_size.observe(len(reqs))
                 if print_log:
-                    log.info('Processed %d ops on %s.%s' % (len(reqs), dbname, collname))
+                    log.info('Processed %d ops on %s.%s', len(reqs), dbname, collname)
                 return
             except pymongo.errors.AutoReconnect as e:
                 log.error('%s' % e)
                 self.reconnect()
             except Exception as e:
-                log.error('bulk write failed: %s, retry one by one' % e)
+                log.error('bulk write failed: %s, retry one by one', e)
                 # retry to write one by one
                 for req in reqs:
                     while True:
@@ -104,6 +150,8 @@ class MongoHandler(object):
                                 self._mc[dbname][collname].update_one(req._filter, req._doc, upsert=req._upsert)
                             elif isinstance(req, pymongo.DeleteOne):
                                 self._mc[dbname][collname].delete_one(req._filter)
+                            elif isinstance(req, pymongo.DeleteMany):
+                                self._mc[dbname][collname].delete_many(req._filter)
                             else:
                                 log.error('invalid req: %s' % req)
                                 sys.exit(1)
@@ -114,18 +162,65 @@ class MongoHandler(object):
                             continue
                         except pymongo.errors.DuplicateKeyError as e:
                             if ignore_duplicate_key_error:
-                                log.info('ignore duplicate key error: %s: %s' % (e, req))
+                                log.info('ignore duplicate key error: %s: %s', e, req)
                                 break
                             else:
-                                log.error('%s: %s' % (e, req))
+                                log.error('%s: %s', e, req)
                                 sys.exit(1)
                         except Exception as e:
                             # generally it's an odd oplog that program cannot process
                             # so abort it and bugfix
-                            log.error('%s when executing %s on %s.%s' % (e, req, dbname, collname))
+                            log.error('%s when executing %s on %s.%s', e, req, dbname, collname)
                             sys.exit(1)
                 if print_log:
-                    log.info('Processed %d ops on %s.%s, one by one' % (len(reqs), dbname, collname))
+                    log.info('Processed %d ops on %s.%s, one by one', len(reqs), dbname, collname)
+
+    def bulk_insert(self, dbname, collname, reqs, print_log=False):
+        """ Bulk write InsertOne requests unordered until success.
+        The requests that failed of duplicate key errors are retried as upserts,
+        others are retried by bulk_write, which aborts if they fail again.
+        If the outcome of each request is unknown, all are retried as upserts.
+        """
+        while True:
+            try:
+                t = time.time()
+                self._mc[dbname][collname].bulk_write(reqs, ordered=False, bypass_document_validation=False)
+                self._bulk_write_seconds.observe(time.time() - t)
+                self._bulk_write_size.observe(len(reqs))
+                if print_log:
+                    log.info('Processed %d inserts on %s.%s', len(reqs), dbname, collname)
+                return
+            except pymongo.errors.AutoReconnect as e:
+                log.error('%s' % e)
+                self.reconnect()
+            except pymongo.errors.BulkWriteError as e:
+                if e.details.get('writeConcernErrors'):
+                    log.error('bulk insert failed: %s, retry as upserts', e.details['writeConcernErrors'])
+                    self.bulk_write(dbname, collname, [_to_upsert(req) for req in reqs], ordered=False,
+                                    print_log=print_log)
+                    return
+                upserts = []
+                failures = []
+                for err in e.details['writeErrors']:
+                    req = reqs[err['index']]
+                    if err['code'] == 11000:
+                        upserts.append(_to_upsert(req))
+                    else:
+                        log.error('insert failed: %s', err.get('errmsg'))
+                        failures.append(req)
+                if upserts:
+                    self.bulk_write(dbname, collname, upserts, ordered=False)
+                if failures:
+                    self.bulk_write(dbname, collname, failures, ordered=False)
+                if print_log:
+                    log.info('Processed %d inserts on %s.%s, %d upserts on conflict',
+                             len(reqs), dbname, collname, len(upserts))
+                return
+            except Exception as e:
+                log.error('bulk insert failed: %s, retry as upserts', e)
+                self.bulk_write(dbname, collname, [_to_upsert(req) for req in reqs], ordered=False,
+                                print_log=print_log)
+                return
 
     # UpdateOne({
     #     '_id': ObjectId('5e56c076b61867f68c7eb410')
@@ -183,7 +278,7 @@ class MongoHandler(object):
                     try:
                         self._mc[dbname].command(oplog['o'])
                     except pymongo.errors.OperationFailure as e:
-                        log.info('%s: %s' % (e, oplog))
+                        log.info('%s: %s', e, oplog)
                 elif op == 'n':  # no-op
                     pass
                 else:
@@ -194,10 +289,10 @@ class MongoHandler(object):
                 continue
             except pymongo.errors.DuplicateKeyError as e:
                 if ignore_duplicate_key_error:
-                    log.info('ignore duplicate key error: %s :%s' % (e, oplog))
+                    log.info('ignore duplicate key error: %s :%s', e, oplog)
                     break
                 else:
-                    log.error('%s: %s' % (e, oplog))
+                    log.error('%s: %s', e, oplog)
                     sys.exit(1)
             except pymongo.errors.WriteError as e:
                 log.error('%s' % e)
@@ -229,3 +324,9 @@ class MongoHandler(object):
                     if not res.inserted_id:
                         log.error('replay update failed: insert new document failed:', new_doc)
                         sys.exit(1)
+
+
+def _to_upsert(req):
+    """ Convert InsertOne into ReplaceOne upserting by _id, which is idempotent.
+    """
+    return pymongo.ReplaceOne({'_id': req._doc['_id']}, req._doc, upsert=True)
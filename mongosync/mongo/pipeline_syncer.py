@@ -0,0 +1,170 @@
+import time
+import gevent
+import gevent.pool
+import gevent.queue
+import pymongo
+from pymongo import errors
+from mongosync import profiler
+from mongosync.mongo_utils import RAW_CODEC_OPTIONS
+from mongosync.logger import Logger
+from mongosync.mongo.syncer import MongoSyncer
+
+log = Logger.get()
+
+
+class TaskStats(object):
+    """ Statistics of a reader or writer task.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.n_docs = 0
+        self.n_batches = 0
+        self.blocked_secs = 0.0  # time spent waiting on the queue
+        self.start_time = time.time()
+
+    def __str__(self):
+        time_used = time.time() - self.start_time
+        return '%s: %d docs in %d batches, %.1fs used, %.1fs blocked on queue' % (
+            self.name, self.n_docs, self.n_batches, time_used, self.blocked_secs)
+
+
+class PipelineMongoSyncer(MongoSyncer):
+    """ MongoDB synchronizer with a pipelined initial sync.
+
+    A collection is copied in a single process by range reader greenlets and bulk writer greenlets,
+    which are connected by a bounded queue. Large collections are split into one range per reader
+    instead of being copied by multiple processes.
+    """
+
+    def __init__(self, conf):
+        MongoSyncer.__init__(self, conf)
+        self._n_readers = conf.pipeline_readers
+        self._n_writers = conf.pipeline_writers
+        self._queue_size = conf.pipeline_queue_size
+        self._batch_size = conf.pipeline_batch_size
+        # large collections are split into a range per reader
+        self._n_workers = self._n_readers
+
+    def _sync_collection(self, namespace_tuple):
+        """ Sync a collection until success.
+        """
+        # create indexes first
+        self._create_index(namespace_tuple)
+
+        ns = '.'.join(namespace_tuple)
+        self._progress_logger.begin(ns)
+        self._run_pipeline(namespace_tuple, [None])
+        self._progress_logger.done(ns)
+
+    def _sync_large_collection(self, namespace_tuple, split_points):
+        """ Sync large collection.
+        """
+        # create indexes first
+        self._create_index(namespace_tuple)
+
+        ns = '.'.join(namespace_tuple)
+        self._progress_logger.begin(ns)
+
+        queries = []
+        lower_bound = None
+        for point in split_points:
+            if lower_bound is None:
+                queries.append({'_id': {'$lt': point}})
+            else:
+                queries.append({'_id': {'$gte': lower_bound, '$lt': point}})
+            lower_bound = point
+        queries.append({'_id': {'$gte': lower_bound}})
+
+        log.info('pending to sync %s with %d range readers' % (ns, len(queries)))
+        self._run_pipeline(namespace_tuple, queries)
+        self._progress_logger.done(ns)
+
+    def _run_pipeline(self, namespace_tuple, queries):
+        """ Copy documents matched by queries through reader and writer greenlets.
+        """
+        src_dbname, src_collname = namespace_tuple
+        dst_dbname, dst_collname = self._conf.db_coll_mapping(src_dbname, src_collname)
+        ns = '.'.join(namespace_tuple)
+
+        q = gevent.queue.Queue(maxsize=self._queue_size)
+        n_writers = min(self._n_writers, self._queue_size)
+
+        def read(query, stats):
+            n_bytes = 0  # bytes of documents not queued yet
+            while True:
+                try:
+                    cursor = self._src.client()[src_dbname][src_collname].with_options(
+                        codec_options=RAW_CODEC_OPTIONS).find(
+                        filter=query,
+                        cursor_type=pymongo.cursor.CursorType.EXHAUST,
+                        no_cursor_timeout=True)
+                    reqs = []
+                    for doc in cursor:
+                        profiler.lap('sync_collection', 'fetch')
+                        reqs.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+                        n_bytes += self._memory.add('initial_sync', ns, doc)
+                        profiler.lap('sync_collection', 'convert')
+                        over_budget = self._memory.over_budget()
+                        if len(reqs) == self._batch_size or over_budget:
+                            put(reqs, n_bytes, stats)
+                            reqs = []
+                            n_bytes = 0
+                            if over_budget:
+                                # queued documents are released by writers
+                                self._wait_memory()
+                            profiler.lap('sync_collection', 'queue')
+                    if reqs:
+                        put(reqs, n_bytes, stats)
+                        n_bytes = 0
+                    log.info('[%s] %s' % (ns, stats))
+                    return
+                except pymongo.errors.AutoReconnect:
+                    # documents are upserted, so just read the range again
+                    self._memory.release('initial_sync', ns, n_bytes)
+                    n_bytes = 0
+                    self._src.reconnect()
+
+        def put(reqs, n_bytes, stats):
+            t = time.time()
+            q.put((reqs, n_bytes))
+            stats.blocked_secs += time.time() - t
+            stats.n_docs += len(reqs)
+            stats.n_batches += 1
+
+        def write(stats):
+            while True:
+                t = time.time()
+                item = q.get()
+                stats.blocked_secs += time.time() - t
+                if item is None:
+                    log.info('[%s] %s' % (ns, stats))
+                    return
+                reqs, n_bytes = item
+                profiler.lap('sync_collection', 'queue')
+                self._dst.bulk_write(dst_dbname, dst_collname, reqs, ordered=False, ignore_duplicate_key_error=True)
+                self._memory.release('initial_sync', ns, n_bytes)
+                profiler.lap('sync_collection', 'apply')
+                self._progress_logger.add(ns, len(reqs))
+                stats.n_docs += len(reqs)
+                stats.n_batches += 1
+
+        reader_stats = [TaskStats('reader-%d %s' % (i, query)) for i, query in enumerate(queries)]
+        writer_stats = [TaskStats('writer-%d' % i) for i in xrange(n_writers)]
+
+        def close():
+            # writers exit on sentinels after queued batches are written
+            readers.join()
+            for _ in writers:
+                q.put(None)
+
+        writers = [gevent.spawn(write, stats) for stats in writer_stats]
+        readers = gevent.pool.Pool(self._n_readers)
+        tasks = [readers.spawn(read, query, stats) for query, stats in zip(queries, reader_stats)]
+        tasks.extend(writers)
+        tasks.append(gevent.spawn(close))
+        try:
+            # the first failure of a reader or writer is raised at once, and the others are killed,
+            # otherwise writers would wait for sentinels or readers would wait for a full queue forever
+            gevent.joinall(tasks, raise_error=True)
+        finally:
+            gevent.killall(tasks)
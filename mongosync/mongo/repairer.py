@@ -0,0 +1,159 @@
+import os
+import time
+import gevent
+import gevent.pool
+import pymongo
+from mongosync.logger import Logger
+from mongosync.mongo_utils import get_optime, parse_namespace
+from mongosync.optime_logger import OptimeLogger
+from mongosync.range_checksum import checksum_both, differ, id_key, range_query, RAW_CODEC_OPTIONS
+
+log = Logger.get()
+
+
+class RangeRepairer(object):
+    """ Repair mismatched _id ranges found by range checksums.
+
+    A mismatched range is split at the median _id of source recursively, and only halves
+    that still mismatch are narrowed, until a range has no more than leaf_docs documents.
+    Documents of a leaf range are compared one by one, and the differing ones are copied from source
+    by bulk upserts, as initial sync does, or deleted if not on source.
+
+    Oplog replay may be running, and a copy might overwrite a newer change applied by replay meanwhile.
+    So repaired documents are verified again after replay passes the source optime read before copying,
+    or after settle seconds if there is no optime log file, and copied again if still different.
+    """
+    def __init__(self, src, dst, leaf_docs=1000, concurrency=8, rounds=5, settle=5, optime_logfilepath='',
+                 dry_run=False):
+        self._src = src
+        self._dst = dst
+        self._leaf_docs = leaf_docs
+        self._pool = gevent.pool.Pool(concurrency)
+        self._rounds = rounds
+        self._settle = settle
+        self._optime_logger = None
+        if optime_logfilepath and os.path.exists(optime_logfilepath):
+            self._optime_logger = OptimeLogger(optime_logfilepath)
+        self._dry_run = dry_run
+        self.stats = {'ranges': 0, 'narrowed': 0, 'leaves': 0, 'upserted': 0, 'deleted': 0, 'unresolved': 0}
+
+    def repair(self, results):
+        """ Repair mismatched ranges in results of RangeChecker.
+        """
+        greenlets = [self._pool.spawn(self.repair_range, r['ns'], r['dst_ns'], r['lower'], r['upper'])
+                     for r in results if not r['match']]
+        gevent.joinall(greenlets, raise_error=True)
+        log.info('repair done: %s' % ', '.join('%s %d' % (k, self.stats[k]) for k in sorted(self.stats)))
+        return self.stats
+
+    def repair_range(self, src_ns, dst_ns, lower, upper):
+        """ Repair a mismatched range.
+        """
+        self.stats['ranges'] += 1
+        src_coll = self._src_coll(src_ns)
+        dst_coll = self._dst_coll(dst_ns)
+        query = range_query(lower, upper)
+        n_src = src_coll.count(query)
+        n_dst = dst_coll.count(query)
+        if max(n_src, n_dst) > self._leaf_docs:
+            if n_src > 0:
+                mid = self._median(src_coll, query, n_src)
+            else:
+                mid = self._median(dst_coll, query, n_dst)
+            if mid is not None and mid != lower:
+                self.stats['narrowed'] += 1
+                for sub_lower, sub_upper in ((lower, mid), (mid, upper)):
+                    src_res, dst_res = checksum_both(src_coll, dst_coll, sub_lower, sub_upper)
+                    if src_res != dst_res:
+                        self.repair_range(src_ns, dst_ns, sub_lower, sub_upper)
+                return
+        self.stats['leaves'] += 1
+        self._repair_leaf(src_ns, dst_ns, query)
+
+    def _repair_leaf(self, src_ns, dst_ns, query):
+        """ Find out differing documents in range and repair them.
+        """
+        src_docs = {}
+        for doc in self._src_coll(src_ns).find(query):
+            src_docs[id_key(doc['_id'])] = doc
+        ids = []
+        for doc in self._dst_coll(dst_ns).find(query):
+            key = id_key(doc['_id'])
+            src_doc = src_docs.pop(key, None)
+            if differ(src_doc, doc):
+                ids.append(doc['_id'])
+        ids.extend(doc['_id'] for doc in src_docs.itervalues())
+        if not ids:
+            return
+        log.info('%d documents differ in %s %s' % (len(ids), src_ns, query))
+        if self._dry_run:
+            return
+        self._copy(src_ns, dst_ns, ids)
+
+    def _copy(self, src_ns, dst_ns, ids):
+        """ Copy documents of ids from source, verify and copy again until the same.
+        """
+        dst_dbname, dst_collname = parse_namespace(dst_ns)
+        for i in xrange(self._rounds):
+            optime = get_optime(self._src.client(), self._src.pinned) if self._optime_logger else None
+            src_docs = self._find(self._src_coll(src_ns), ids)
+            reqs = []
+            for _id in ids:
+                doc = src_docs.get(id_key(_id))
+                if doc is not None:
+                    reqs.append(pymongo.ReplaceOne({'_id': _id}, doc, upsert=True))
+                    self.stats['upserted'] += 1
+                else:
+                    reqs.append(pymongo.DeleteOne({'_id': _id}))
+                    self.stats['deleted'] += 1
+            self._dst.bulk_write(dst_dbname, dst_collname, reqs, ordered=False, ignore_duplicate_key_error=True)
+
+            self._wait_replay(optime)
+            src_docs = self._find(self._src_coll(src_ns), ids)
+            dst_docs = self._find(self._dst_coll(dst_ns), ids)
+            ids = [_id for _id in ids if differ(src_docs.get(id_key(_id)), dst_docs.get(id_key(_id)))]
+            if not ids:
+                return
+            log.info('%d documents still differ in %s after round %d' % (len(ids), dst_ns, i + 1))
+        self.stats['unresolved'] += len(ids)
+        log.warn('%d documents unresolved in %s: %s' % (len(ids), dst_ns, ids[:10]))
+
+    def _wait_replay(self, optime):
+        """ Wait until replay passes optime, or settle seconds if unknown.
+        """
+        if optime is None:
+            time.sleep(self._settle)
+            return
+        deadline = time.time() + max(self._settle, 60)
+        while time.time() < deadline:
+            # checkpoint is only written when all oplogs before are applied
+            replayed = self._optime_logger.read()
+            if replayed is not None and replayed >= optime:
+                return
+            time.sleep(1)
+        log.warn('replay not passed %s in %ds, verify anyway' % (optime, max(self._settle, 60)))
+
+    def _find(self, coll, ids):
+        """ Return documents of ids by key of _id.
+        """
+        docs = {}
+        for i in xrange(0, len(ids), self._leaf_docs):
+            for doc in coll.find({'_id': {'$in': ids[i:i + self._leaf_docs]}}):
+                docs[id_key(doc['_id'])] = doc
+        return docs
+
+    @staticmethod
+    def _median(coll, query, n):
+        """ Return the median _id in range, None if empty.
+        """
+        for doc in coll.find(query, {'_id': 1}, sort=[('_id', pymongo.ASCENDING)]).skip(n / 2).limit(1):
+            return doc['_id']
+        return None
+
+    def _src_coll(self, ns):
+        dbname, collname = parse_namespace(ns)
+        return self._src.client()[dbname][collname].with_options(codec_options=RAW_CODEC_OPTIONS)
+
+    def _dst_coll(self, ns):
+        dbname, collname = parse_namespace(ns)
+        return self._dst.client()[dbname][collname].with_options(codec_options=RAW_CODEC_OPTIONS)
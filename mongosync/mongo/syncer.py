@@ -5,11 +5,12 @@ import hashlib
 import gevent
 import pymongo
 from pymongo import errors
-from mongosync import mongo_utils
+from mongosync import mongo_utils, metrics, profiler
 from mongosync.logger import Logger
 from mongosync.config import MongoConfig
 from mongosync.common_syncer import CommonSyncer, Stage
 from mongosync.mongo.handler import MongoHandler
+from mongosync.mongo.verifier import SampledVerifier
 from mongosync.multi_oplog_replayer import MultiOplogReplayer
 
 log = Logger.get()
@@ -32,7 +33,16 @@ class MongoSyncer(CommonSyncer):
         self._dst = MongoHandler(self._conf.dst_conf)
         if not self._dst.connect():
             raise RuntimeError('connect to mongodb(dst) failed: %s' % self._conf.dst.hosts)
-        self._multi_oplog_replayer = MultiOplogReplayer(self._dst, 10)
+        self._multi_oplog_replayer = MultiOplogReplayer(self._dst, 10, memory=self._memory,
+                                                        tracer=self._tracer)
+        metrics.BUFFER_DEPTH.labels('oplog_replayer').set_function(self._multi_oplog_replayer.count)
+        self._verifier = None
+        if conf.verify_sample_size > 0:
+            self._verifier = SampledVerifier(self._src, self._dst, conf, self._collect_colls,
+                                             sample_size=conf.verify_sample_size,
+                                             interval=conf.verify_interval,
+                                             read_budget=conf.verify_read_budget)
+        self._verifier_greenlet = None
 
     def _create_index(self, namespace_tuple):
         """ Create indexes.
@@ -98,12 +108,15 @@ class MongoSyncer(CommonSyncer):
         dst_dbname, dst_collname = self._conf.db_coll_mapping(src_dbname, src_collname)
         src_ns = '%s.%s' % (src_dbname, src_collname)
 
-        total = self._src.client()[src_dbname][src_collname].count()
-        self._progress_logger.register(src_ns, total)
+        self._progress_logger.begin(src_ns)
 
+        n_bytes = 0
         while True:
             try:
-                cursor = self._src.client()[src_dbname][src_collname].find(
+                # raw documents are measured and written without encoding again
+                coll = self._src.client()[src_dbname][src_collname].with_options(
+                    codec_options=mongo_utils.RAW_CODEC_OPTIONS)
+                cursor = coll.find(
                     filter=None,
                     cursor_type=pymongo.cursor.CursorType.EXHAUST,
                     no_cursor_timeout=True,
@@ -111,38 +124,48 @@ class MongoSyncer(CommonSyncer):
                 )
 
                 reqs = []
-                reqs_max = 5000
+                reqs_max = self._conf.gevent_batch_size
                 groups = []
-                groups_max = 1
-                n = 0
+                groups_max = self._conf.gevent_batches
+                n_bytes = 0  # bytes of buffered documents
 
                 for doc in cursor:
+                    profiler.lap('sync_collection', 'fetch')
                     reqs.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
-                    if len(reqs) == reqs_max:
+                    n_bytes += self._memory.add('initial_sync', src_ns, doc)
+                    profiler.lap('sync_collection', 'convert')
+                    over_budget = self._memory.over_budget()
+                    if len(reqs) == reqs_max or over_budget:
                         groups.append(reqs)
                         reqs = []
-                    if len(groups) == groups_max:
+                    if len(groups) == groups_max or over_budget:
                         threads = [
                             gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False,
-                                         ignore_duplicate_key_error=True) for i in xrange(groups_max)]
+                                         ignore_duplicate_key_error=True) for i in xrange(len(groups))]
                         gevent.joinall(threads, raise_error=True)
+                        self._progress_logger.add(src_ns, sum(len(reqs) for reqs in groups))
                         groups = []
-
-                    n += 1
-                    if n % 100000 == 0:
-                        self._progress_logger.add(src_ns, n)
-                        n = 0
+                        self._memory.release('initial_sync', src_ns, n_bytes)
+                        n_bytes = 0
+                        profiler.lap('sync_collection', 'apply')
+                        if over_budget:
+                            self._wait_memory()
 
                 if len(groups) > 0:
                     threads = [gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False,
                                             ignore_duplicate_key_error=True) for i in xrange(len(groups))]
                     gevent.joinall(threads, raise_error=True)
+                    self._progress_logger.add(src_ns, sum(len(reqs) for reqs in groups))
                 if len(reqs) > 0:
                     self._dst.bulk_write(dst_dbname, dst_collname, reqs, ordered=False, ignore_duplicate_key_error=True)
+                    self._progress_logger.add(src_ns, len(reqs))
+                self._memory.release('initial_sync', src_ns, n_bytes)
 
-                self._progress_logger.add(src_ns, n, done=True)
+                self._progress_logger.done(src_ns)
                 return
             except pymongo.errors.AutoReconnect:
+                # documents in buffer will be read again
+                self._memory.release('initial_sync', src_ns, n_bytes)
                 self._src.reconnect()
 
     def _sync_large_collection(self, namespace_tuple, split_points):
@@ -156,15 +179,7 @@ class MongoSyncer(CommonSyncer):
 
         log.info('pending to sync %s with %d processes' % (ns, len(split_points) + 1))
 
-        coll = self._src.client()[dbname][collname]
-        total = coll.count()
-        self._progress_logger.register(ns, total)
-
-        prog_q = multiprocessing.Queue()
-        res_q = multiprocessing.Queue()
-
-        proc_logging = multiprocessing.Process(target=logging_progress, args=(ns, total, prog_q))
-        proc_logging.start()
+        self._progress_logger.begin(ns)
 
         queries = []
         lower_bound = None
@@ -179,25 +194,22 @@ class MongoSyncer(CommonSyncer):
         procs = []
         for query in queries:
             p = multiprocessing.Process(target=self._sync_collection_with_query,
-                                        args=(namespace_tuple, query, prog_q, res_q))
+                                        args=(namespace_tuple, query))
             p.start()
             procs.append(p)
             log.info('start process %s with query %s' % (p.name, query))
 
         for p in procs:
             p.join()
+        failed = [p for p in procs if p.exitcode != 0]
+        if failed:
+            # the partitions are incomplete, so don't go on to oplog sync
+            raise Exception('%d processes syncing %s failed, exit codes %s' % (
+                len(failed), ns, [p.exitcode for p in failed]))
 
-        n_docs = 0
-        for p in procs:
-            n_docs += res_q.get()
-        self._progress_logger.add(ns, n_docs, done=True)
-
-        prog_q.put(True)
-        prog_q.close()
-        prog_q.join_thread()
-        proc_logging.join()
+        self._progress_logger.done(ns)
 
-    def _sync_collection_with_query(self, namespace_tuple, query, prog_q, res_q):
+    def _sync_collection_with_query(self, namespace_tuple, query):
         """ Sync collection with query.
         """
         self._src.reconnect()
@@ -205,63 +217,95 @@ class MongoSyncer(CommonSyncer):
 
         src_dbname, src_collname = namespace_tuple
         dst_dbname, dst_collname = self._conf.db_coll_mapping(src_dbname, src_collname)
+        src_ns = '%s.%s' % (src_dbname, src_collname)
 
+        n_bytes = 0
         while True:
             try:
-                cursor = self._src.client()[src_dbname][src_collname].find(filter=query,
-                                                                           cursor_type=pymongo.cursor.CursorType.EXHAUST,
-                                                                           no_cursor_timeout=True,
-                                                                           # snapshot cause blocking, maybe bug
-                                                                           # modifiers={'$snapshot': True}
-                                                                           )
-                total = 0
-                n = 0
+                coll = self._src.client()[src_dbname][src_collname].with_options(
+                    codec_options=mongo_utils.RAW_CODEC_OPTIONS)
+                cursor = coll.find(filter=query,
+                                   cursor_type=pymongo.cursor.CursorType.EXHAUST,
+                                   no_cursor_timeout=True,
+                                   # snapshot cause blocking, maybe bug
+                                   # modifiers={'$snapshot': True}
+                                   )
                 reqs = []
-                reqs_max = 100
+                reqs_max = self._conf.gevent_partition_batch_size
                 groups = []
-                groups_max = 10
+                groups_max = self._conf.gevent_partition_batches
+                n_bytes = 0  # bytes of buffered documents
 
                 for doc in cursor:
+                    profiler.lap('sync_collection', 'fetch')
                     reqs.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
-                    if len(reqs) == reqs_max:
+                    n_bytes += self._memory.add('initial_sync', src_ns, doc)
+                    profiler.lap('sync_collection', 'convert')
+                    over_budget = self._memory.over_budget()
+                    if len(reqs) == reqs_max or over_budget:
                         groups.append(reqs)
                         reqs = []
-                    if len(groups) == groups_max:
+                    if len(groups) == groups_max or over_budget:
                         threads = [
                             gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False,
-                                         ignore_duplicate_key_error=True) for i in xrange(groups_max)]
+                                         ignore_duplicate_key_error=True) for i in xrange(len(groups))]
                         gevent.joinall(threads, raise_error=True)
+                        self._progress_logger.add(src_ns, sum(len(reqs) for reqs in groups))
                         groups = []
-
-                    n += 1
-                    total += 1
-                    if n % 10000 == 0:
-                        prog_q.put(n)
-                        n = 0
+                        self._memory.release('initial_sync', src_ns, n_bytes)
+                        n_bytes = 0
+                        profiler.lap('sync_collection', 'apply')
+                        if over_budget:
+                            self._wait_memory()
 
                 if len(groups) > 0:
                     threads = [gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False,
                                             ignore_duplicate_key_error=True) for i in xrange(len(groups))]
                     gevent.joinall(threads, raise_error=True)
+                    self._progress_logger.add(src_ns, sum(len(reqs) for reqs in groups))
                 if len(reqs) > 0:
                     self._dst.bulk_write(dst_dbname, dst_collname, reqs, ordered=False, ignore_duplicate_key_error=True)
-
-                if n > 0:
-                    prog_q.put(n)
-                res_q.put(total)
-
-                prog_q.close()
-                prog_q.join_thread()
-                res_q.close()
-                res_q.join_thread()
+                    self._progress_logger.add(src_ns, len(reqs))
+                self._memory.release('initial_sync', src_ns, n_bytes)
                 return
             except pymongo.errors.AutoReconnect:
+                # documents in buffer will be read again
+                self._memory.release('initial_sync', src_ns, n_bytes)
                 self._src.reconnect()
 
+    def _apply_oplog(self, oplog, trace, **kwargs):
+        """ Apply a single oplog, and trace it if sampled.
+        """
+        if trace:
+            self._tracer.submit([trace])
+        self._dst.apply_oplog(oplog, **kwargs)
+        if trace:
+            self._tracer.ack([trace])
+
+    def _verified_optime(self):
+        """ Return the optime that all oplogs before are applied in oplog_sync stage, else None,
+        since documents diverge until oplogs of initial sync are caught up.
+        """
+        return self._applied_optime if self._stage == Stage.oplog_sync else None
+
+    def _skip_oplog(self, oplog):
+        """ Move past a no-op or filtered oplog.
+
+        The optime only advances if no oplog is buffered unapplied before it,
+        so that a checkpoint never skips buffered oplogs.
+        Return True if a checkpoint is due, at most once a second, since each costs a sync to disk.
+        """
+        if self._multi_oplog_replayer and self._multi_oplog_replayer.count() > 0:
+            return False
+        self._last_optime = oplog['ts']
+        return time.time() - self._last_checkpoint_time >= 1
+
     def _replay_oplog(self, start_optime):
         """ Replay oplog.
         """
         self._last_optime = start_optime
+        if self._verifier and not self._verifier_greenlet:
+            self._verifier_greenlet = gevent.spawn(self._verifier.run, self._verified_optime)
 
         n_total = 0
         n_skip = 0
@@ -272,7 +316,7 @@ class MongoSyncer(CommonSyncer):
                 need_log = False
                 host, port = self._src.client().address
                 log.info('try to sync oplog from %s on %s:%d' % (self._last_optime, host, port))
-                cursor = self._src.tail_oplog(start_optime)
+                cursor = self._src.tail_oplog(self._last_optime)
             except IndexError as e:
                 log.error(e)
                 log.error('%s not found, terminate' % self._last_optime)
@@ -288,13 +332,16 @@ class MongoSyncer(CommonSyncer):
                         self._log_optime(self._last_optime)
                         self._log_progress()
                         need_log = False
+                    profiler.lap('replay_oplog', 'checkpoint')
 
                     if not cursor.alive:
                         log.error('cursor is dead')
                         raise pymongo.errors.AutoReconnect
 
                     oplog = cursor.next()
+                    trace = self._tracer.read(oplog)
                     n_total += 1
+                    profiler.lap('replay_oplog', 'fetch')
 
                     # check start optime once
                     if not start_optime_valid:
@@ -306,41 +353,47 @@ class MongoSyncer(CommonSyncer):
                             return
 
                     if oplog['op'] == 'n':  # no-op
-                        self._last_optime = oplog['ts']
-                        need_log = True
+                        need_log = self._skip_oplog(oplog) or need_log
                         continue
 
                     # validate oplog
-                    if not self._conf.data_filter.valid_oplog(oplog):
+                    valid = self._conf.data_filter.valid_oplog(oplog)
+                    profiler.lap('replay_oplog', 'filter')
+                    if not valid:
                         n_skip += 1
-                        self._last_optime = oplog['ts']
-                        need_log = True
+                        need_log = self._skip_oplog(oplog) or need_log
                         continue
 
+                    metrics.OPLOG_OPS.labels(oplog['ns'], oplog['op']).inc()
+                    if self._verifier:
+                        self._verifier.record(oplog)
+
                     dbname, collname = mongo_utils.parse_namespace(oplog['ns'])
                     dst_dbname, dst_collname = self._conf.db_coll_mapping(dbname, collname)
                     if dst_dbname != dbname or dst_collname != collname:
                         oplog['ns'] = '%s.%s' % (dst_dbname, dst_collname)
+                    profiler.lap('replay_oplog', 'convert')
 
                     if self._stage == Stage.post_initial_sync:
                         if self._multi_oplog_replayer:
                             if mongo_utils.is_command(oplog):
                                 self._multi_oplog_replayer.apply(ignore_duplicate_key_error=True, print_log=True)
                                 self._multi_oplog_replayer.clear()
-                                self._dst.apply_oplog(oplog)
+                                self._apply_oplog(oplog, trace)
                                 self._last_optime = oplog['ts']
                                 need_log = True
                             else:
-                                self._multi_oplog_replayer.push(oplog)
+                                self._multi_oplog_replayer.push(oplog, trace)
                                 if oplog['ts'] == self._initial_sync_end_optime \
                                         or self._multi_oplog_replayer.count() >= self._oplog_batchsize \
+                                        or self._memory.over_budget() \
                                         or time.time() - self._multi_oplog_replayer._last_apply_time > 3:
                                     self._multi_oplog_replayer.apply(ignore_duplicate_key_error=True, print_log=True)
                                     self._multi_oplog_replayer.clear()
                                     self._last_optime = oplog['ts']
                                     need_log = True
                         else:
-                            self._dst.apply_oplog(oplog, ignore_duplicate_key_error=True, print_log=True)
+                            self._apply_oplog(oplog, trace, ignore_duplicate_key_error=True, print_log=True)
                             self._last_optime = oplog['ts']
                             need_log = True
 
@@ -350,30 +403,33 @@ class MongoSyncer(CommonSyncer):
                     else:
                         if self._multi_oplog_replayer:
                             if mongo_utils.is_command(oplog):
-                                self._multi_oplog_replayer.apply()
+                                self._multi_oplog_replayer.apply(plain_insert=True)
                                 self._multi_oplog_replayer.clear()
-                                self._dst.apply_oplog(oplog)
+                                self._apply_oplog(oplog, trace)
                                 self._last_optime = oplog['ts']
                                 need_log = True
                             else:
-                                self._multi_oplog_replayer.push(oplog)
-                                if self._multi_oplog_replayer.count() >= self._oplog_batchsize:
-                                    self._multi_oplog_replayer.apply()
+                                self._multi_oplog_replayer.push(oplog, trace)
+                                if self._multi_oplog_replayer.count() >= self._oplog_batchsize \
+                                        or self._memory.over_budget():
+                                    self._multi_oplog_replayer.apply(plain_insert=True)
                                     self._multi_oplog_replayer.clear()
                                     self._last_optime = oplog['ts']
                                     need_log = True
                         else:
-                            self._dst.apply_oplog(oplog)
+                            self._apply_oplog(oplog, trace)
                             self._last_optime = oplog['ts']
                             need_log = True
+                    profiler.lap('replay_oplog', 'apply')
                 except StopIteration as e:
                     if self._multi_oplog_replayer and self._multi_oplog_replayer.count() > 0:
-                        self._multi_oplog_replayer.apply()
+                        self._multi_oplog_replayer.apply(plain_insert=self._stage == Stage.oplog_sync)
                         self._multi_oplog_replayer.clear()
                         self._last_optime = self._multi_oplog_replayer.last_optime()
                         need_log = True
                     # no more oplogs, wait a moment
                     time.sleep(0.1)
+                    profiler.lap('replay_oplog', 'idle')
                     self._log_optime(self._last_optime)
                     self._log_progress('latest')
                 except pymongo.errors.DuplicateKeyError as e:
@@ -382,24 +438,10 @@ class MongoSyncer(CommonSyncer):
                         log.error('terminate')
                         return
                     else:
-                        log.error('ignore duplicate key error: %s' % e)
+                        log.error('ignore duplicate key error: %s', e)
                         continue
                 except pymongo.errors.AutoReconnect as e:
                     log.error(e)
                     self._src.reconnect()
                     break
 
-
-def logging_progress(ns, total, prog_q):
-    curr = 0
-    while True:
-        m = prog_q.get()
-        if isinstance(m, bool):
-            return
-        curr += m
-        s = '\t%s\t%d/%d\t[%.2f%%]' % (
-            ns,
-            curr,
-            total,
-            float(curr) / total * 100 if total > 0 else float(curr + 1) / (total + 1) * 100)
-        log.info(s)
@@ -0,0 +1,181 @@
+import time
+import random
+import collections
+import gevent
+from mongosync import metrics
+from mongosync.logger import Logger
+from mongosync.mongo_utils import get_optime, gen_namespace, parse_namespace
+from mongosync.range_checksum import differ, id_key, RAW_CODEC_OPTIONS
+
+log = Logger.get()
+
+MATCH = 'match'
+MISMATCH = 'mismatch'
+INCONCLUSIVE = 'inconclusive'
+
+
+class SampledVerifier(object):
+    """ Verify a sample of documents continuously during oplog replay.
+
+    Every round samples recently replayed _ids and random _ids of synced collections,
+    and compares documents of source and destination by BSON bytes:
+      - read documents on source, then the source optime
+      - wait until replay passes the optime, then read documents on destination
+      - documents that differ are checked again the same way, a document is mismatched if it still differs
+        while unchanged on source, or inconclusive if changed on source meanwhile
+
+    Documents read per second on both sides stay within read budget on average,
+    by stretching the interval between rounds.
+    """
+    def __init__(self, src, dst, conf, colls_func, sample_size=100, interval=10, read_budget=100, max_wait=60):
+        self._src = src
+        self._dst = dst
+        self._conf = conf
+        self._colls_func = colls_func
+        self._colls = []
+        self._colls_time = 0
+        self._sample_size = sample_size
+        self._interval = interval
+        self._read_budget = read_budget
+        self._max_wait = max_wait
+        self._recent = collections.deque(maxlen=sample_size)  # (ns, _id) of recently replayed oplogs
+        self._n_reads = 0
+        self._mismatch_ratio = metrics.VERIFY_MISMATCH_RATIO.labels()
+
+    def record(self, oplog):
+        """ Record _id of a replayed oplog.
+        """
+        op = oplog['op']
+        if op == 'u':
+            self._recent.append((oplog['ns'], oplog['o2']['_id']))
+        elif op in ('i', 'd') and '_id' in oplog['o']:
+            self._recent.append((oplog['ns'], oplog['o']['_id']))
+
+    def run(self, replayed_optime_func):
+        """ Verify rounds forever.
+        replayed_optime_func returns the optime replayed, or None if not ready to verify.
+        """
+        while True:
+            wait = self._interval
+            if replayed_optime_func() is not None:
+                self._n_reads = 0
+                try:
+                    self.verify_round(replayed_optime_func)
+                except Exception as e:
+                    log.error('verify round failed: %s' % e)
+                if self._read_budget > 0:
+                    wait = max(wait, float(self._n_reads) / self._read_budget)
+            gevent.sleep(wait)
+
+    def verify_round(self, replayed_optime_func):
+        """ Verify a sample, return {(ns, _id key): result}.
+        """
+        recent = list(self._recent)[-(self._sample_size / 2 or 1):]
+        self._recent.clear()
+        samples = collections.OrderedDict()  # (ns, _id key) => _id
+        for ns, _id in recent:
+            samples[(ns, id_key(_id))] = _id
+        for ns, _id in self._sample_random(self._sample_size - len(samples)):
+            samples[(ns, id_key(_id))] = _id
+        if not samples:
+            return {}
+
+        results = {}
+        docs = self._read_consistent(samples, replayed_optime_func)
+        if docs is None:
+            return {}
+        src_docs, dst_docs = docs
+        candidates = collections.OrderedDict()
+        for key, _id in samples.iteritems():
+            if differ(src_docs.get(key), dst_docs.get(key)):
+                candidates[key] = _id
+            else:
+                results[key] = MATCH
+
+        if candidates:
+            docs = self._read_consistent(candidates, replayed_optime_func)
+            if docs is None:
+                for key in candidates:
+                    results[key] = INCONCLUSIVE
+            else:
+                src_docs2, dst_docs2 = docs
+                for key in candidates:
+                    if differ(src_docs.get(key), src_docs2.get(key)):
+                        results[key] = INCONCLUSIVE
+                    elif differ(src_docs2.get(key), dst_docs2.get(key)):
+                        results[key] = MISMATCH
+                    else:
+                        results[key] = MATCH
+
+        self._report(samples, results, len(recent))
+        return results
+
+    def _sample_random(self, n):
+        """ Return n random (ns, _id) of synced collections.
+        """
+        if n <= 0:
+            return []
+        if time.time() - self._colls_time > 600:
+            self._colls = self._colls_func()
+            self._colls_time = time.time()
+        if not self._colls:
+            return []
+        counts = collections.Counter(random.choice(self._colls) for _ in xrange(n))
+        samples = []
+        for (dbname, collname), size in counts.iteritems():
+            cursor = self._src.client()[dbname][collname].aggregate([{'$sample': {'size': size}},
+                                                                     {'$project': {'_id': 1}}])
+            for doc in cursor:
+                samples.append((gen_namespace(dbname, collname), doc['_id']))
+            self._n_reads += size
+        return samples
+
+    def _read_consistent(self, samples, replayed_optime_func):
+        """ Read documents on source, and on destination after replay passes the source optime.
+        Return (source documents, destination documents) by (ns, _id key), or None if replay lags too much.
+        """
+        ids = collections.defaultdict(list)  # ns => _ids
+        for (ns, _), _id in samples.iteritems():
+            ids[ns].append(_id)
+        src_docs = {}
+        for ns, ns_ids in ids.iteritems():
+            dbname, collname = parse_namespace(ns)
+            src_docs.update(self._find(self._src.client()[dbname][collname], ns, ns_ids))
+
+        optime = get_optime(self._src.client(), self._src.pinned)
+        deadline = time.time() + self._max_wait
+        while True:
+            replayed = replayed_optime_func()
+            if replayed is not None and replayed >= optime:
+                break
+            if time.time() > deadline:
+                log.warn('verify skipped: replay not passed %s in %ds' % (optime, self._max_wait))
+                return None
+            gevent.sleep(0.5)
+
+        dst_docs = {}
+        for ns, ns_ids in ids.iteritems():
+            dbname, collname = self._conf.db_coll_mapping(*parse_namespace(ns))
+            dst_docs.update(self._find(self._dst.client()[dbname][collname], ns, ns_ids))
+        return src_docs, dst_docs
+
+    def _find(self, coll, ns, ids):
+        docs = {}
+        cursor = coll.with_options(codec_options=RAW_CODEC_OPTIONS).find({'_id': {'$in': ids}})
+        for doc in cursor:
+            docs[(ns, id_key(doc['_id']))] = doc
+        self._n_reads += len(ids)
+        return docs
+
+    def _report(self, samples, results, n_recent):
+        counts = collections.Counter(results.itervalues())
+        for (ns, key), result in results.iteritems():
+            metrics.VERIFY_DOCS.labels(ns, result).inc()
+        n_compared = counts[MATCH] + counts[MISMATCH]
+        self._mismatch_ratio.set(float(counts[MISMATCH]) / n_compared if n_compared else 0)
+        log.info('verify %d documents (%d recent, %d random): %d matched, %d mismatched, %d inconclusive, %d reads' % (
+            len(samples), n_recent, len(samples) - n_recent, counts[MATCH], counts[MISMATCH], counts[INCONCLUSIVE],
+            self._n_reads))
+        mismatched = [(ns, samples[(ns, key)]) for (ns, key), result in results.iteritems() if result == MISMATCH]
+        for ns, _id in mismatched[:10]:
+            log.warn('mismatched document in %s: _id %r' % (ns, _id))
@@ -1,6 +1,25 @@
+import os
 import pymongo
 import bson
 from pymongo import errors
+from pymongo import read_preferences
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+READ_PREFERENCE_MODES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
+# documents are decoded lazily, and written as they are without encoding again
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+# connection registry, topology is discovered once and clients are shared in a process
+_replset_names = {}  # (host, port) => replica set name
+_clients = {}  # (pid, host, port, options) => client
 
 
 def gen_uri(hosts, username=None, password=None, authdb='admin'):
@@ -48,12 +67,15 @@ def connect(host, port, **kwargs):
         authdb = admin
         read_preference = PRIMARY
         w = 1
+
+    Connect to the specified member only if direct is True.
     """
     authdb = kwargs.get('authdb', 'admin')  # default authdb is 'admin'
     username = kwargs.get('username', '')
     password = kwargs.get('password', '')
     w = kwargs.get('w', 1)
-    replset_name = get_replica_set_name(host, port, **kwargs)
+    read_preference = kwargs.get('read_preference') or read_preferences.ReadPreference.PRIMARY
+    replset_name = '' if kwargs.get('direct') else get_replica_set_name(host, port, **kwargs)
     if replset_name:
         mc = pymongo.MongoClient(host=host,
                                  port=port, ssl=kwargs['ssl'],
@@ -61,7 +83,7 @@ def connect(host, port, **kwargs):
                                  connect=True,
                                  serverSelectionTimeoutMS=3000,
                                  replicaSet=replset_name,
-                                 read_preference=pymongo.read_preferences.ReadPreference.PRIMARY,
+                                 read_preference=read_preference,
                                  w=w)
     else:
         mc = pymongo.MongoClient(host,
@@ -76,34 +98,60 @@ def connect(host, port, **kwargs):
     return mc
 
 
+def get_client(host, port, **kwargs):
+    """ Get a shared client from registry, connect if not existed.
+
+    Clients are not shared across processes, since MongoClient is not fork-safe.
+    The arguments are the same as connect().
+    """
+    key = (os.getpid(), host, port,
+           kwargs.get('direct', False),
+           repr(kwargs.get('read_preference')),
+           kwargs.get('ssl'),
+           kwargs.get('authdb', 'admin'),
+           kwargs.get('username', ''),
+           kwargs.get('w', 1))
+    mc = _clients.get(key)
+    if mc is None:
+        mc = connect(host, port, **kwargs)
+        _clients[key] = mc
+    return mc
+
+
+def release_client(mc):
+    """ Remove a client from registry and close it.
+    """
+    for key, val in _clients.items():
+        if val is mc:
+            del _clients[key]
+    mc.close()
+
+
 def get_version(arg):
     """ Get version.
     """
     host, port = parse_hostportstr(arg.hosts)
-    with pymongo.MongoClient(host, port, ssl=arg.ssl, connect=True, serverSelectionTimeoutMS=3000) as mc:
-        return mc.server_info()['version']
+    mc = get_client(host, port, ssl=arg.ssl, authdb=arg.authdb, username=arg.username, password=arg.password)
+    return mc.server_info()['version']
 
 
 def get_replica_set_name(host, port, **kwargs):
     """ Get replica set name.
     Return a empty string if it's not a replica set.
     Raise exception if execute failed.
+
+    The result is cached, so only the first call creates a temporary connection.
     """
+    if (host, port) in _replset_names:
+        return _replset_names[(host, port)]
+    # isMaster requires no authentication
+    mc = pymongo.MongoClient(host, port, ssl=kwargs['ssl'], connect=True, serverSelectionTimeoutMS=3000)
     try:
-        username = kwargs.get('username', '')
-        password = kwargs.get('password', '')
-        authdb = kwargs.get('authdb', 'admin')
-        mc = pymongo.MongoClient(host, port, ssl=kwargs['ssl'], connect=True, serverSelectionTimeoutMS=3000)
-        if username and password and authdb:
-            mc[authdb].authenticate(username, password)
-        status = mc.admin.command({'replSetGetStatus': 1})
+        res = mc.admin.command('ismaster')
+    finally:
         mc.close()
-        if status['ok'] == 1:
-            return status['set']
-        else:
-            return ''
-    except pymongo.errors.OperationFailure:
-        return ''
+    _replset_names[(host, port)] = res.get('setName', '')
+    return _replset_names[(host, port)]
 
 
 def get_primary(host, port, **kwargs):
@@ -132,8 +180,33 @@ def get_primary(host, port, **kwargs):
         raise Exception('get_primary %s' % e)
 
 
-def get_optime(mc):
+def get_read_preference(mode, tags=None):
+    """ Generate read preference with mode name and tag sets.
+    """
+    if mode not in READ_PREFERENCE_MODES:
+        raise Exception('invalid read preference: %s' % mode)
+    if mode == 'primary':
+        if tags:
+            raise Exception('read preference tags conflict with primary')
+        return read_preferences.Primary()
+    return READ_PREFERENCE_MODES[mode](tag_sets=tags if tags else None)
+
+
+def select_member(host, port, read_preference, **kwargs):
+    """ Select a member of replica set with the read preference.
+    Return host and port of the member.
+    """
+    mc = get_client(host, port, read_preference=read_preference, **kwargs)
+    # the server that served the query is the one selected by driver
+    cursor = mc['local']['oplog.rs'].find({}, {'ts': 1}).limit(1)
+    for _ in cursor:
+        pass
+    return cursor.address
+
+
+def get_optime(mc, self_member=False):
     """ Get optime of primary in the replica set.
+    Get optime of the connected member instead if self_member is True.
 
     Changed in version 3.2.
     If using protocolVersion: 1, optime returns a document that contains:
@@ -149,13 +222,18 @@ def get_optime(mc):
     if not members:
         raise Exception('no member in replica set')
     for member in rs_status['members']:
-        role = member.get('stateStr')
-        if role == 'PRIMARY':
+        if self_member:
+            matched = member.get('self', False)
+        else:
+            matched = member.get('stateStr') == 'PRIMARY'
+        if matched:
             optime = member.get('optime')
             if isinstance(optime, dict) and 'ts' in optime:  # for MongoDB v3.2
                 return optime['ts']
             else:
                 return optime
+    if self_member:
+        raise Exception('self not found in replica set')
     raise Exception('no primary in replica set')
 
 
@@ -186,6 +264,42 @@ def gen_namespace(dbname, collname):
     return '%s.%s' % (dbname, collname)
 
 
+def split_coll(db, collname, n_partitions):
+    """ Split a collection into n partitions by _id.
+
+    Return a list of split points.
+
+    splitPointCount = partitionCount - 1
+    splitPointCount = keyTotalCount / (keyCount + 1)
+    keyCount = maxChunkSize / (2 * avgObjSize)
+    =>
+    maxChunkSize = (keyTotalCount / (partionCount - 1) - 1) * 2 * avgObjSize
+
+    Note: maxChunkObjects is default 250000.
+    """
+    if n_partitions <= 1:
+        raise RuntimeError('n_partitions need greater than 1, but %s' % n_partitions)
+
+    collstats = db.command('collstats', collname)
+
+    if 'avgObjSize' not in collstats:  # empty collection
+        return []
+
+    n_points = n_partitions - 1
+    max_chunk_size = ((collstats['count'] / (n_partitions - 1) - 1) * 2 * collstats['avgObjSize']) / 1024 / 1024
+
+    if max_chunk_size <= 0:
+        return []
+
+    res = db.command('splitVector', gen_namespace(db.name, collname), keyPattern={'_id': 1}, maxSplitPoints=n_points,
+                     maxChunkSize=max_chunk_size, maxChunkObjects=collstats['count'])
+
+    if res['ok'] != 1:
+        return []
+    else:
+        return [doc['_id'] for doc in res['splitKeys']]
+
+
 def parse_hostportstr(hostportstr):
     """ Parse hostportstr like 'xxx.xxx.xxx.xxx:xxx'
     """
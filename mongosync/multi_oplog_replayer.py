@@ -4,12 +4,21 @@ import pymongo
 import gevent
 import mmh3
 import mongo_utils
+from mongosync import profiler
+from mongosync.memory import MemoryAccount
+from mongosync.tracing import Tracer
 from mongosync.mongo.syncer import MongoHandler
 from mongosync.logger import Logger
 
 log = Logger.get()
 
 
+class _Insert(pymongo.operations.ReplaceOne):
+    """ Upsert converted from an insert oplog, which could be rewritten as InsertOne.
+    """
+    pass
+
+
 class OplogVector(object):
     """ A set of oplogs with same namespace.
     """
@@ -18,17 +27,20 @@ class OplogVector(object):
         self._dbname = dbname
         self._collname = collname
         self._oplogs = []
+        self._traces = []
 
 
 class MultiOplogReplayer(object):
     """ Concurrent oplog replayer for MongoDB.
     """
 
-    def __init__(self, mongo_handler, n_writers=10, batch_size=40):
+    def __init__(self, mongo_handler, n_writers=10, batch_size=40, memory=None, tracer=None):
         """
         Parameter:
           - n_writers: maximum coroutine count
           - batch_size: maximum oplog count in a batch, 40 is empiric value
+          - memory: MemoryAccount of the documents in oplogs
+          - tracer: Tracer of the sampled oplogs
         """
         assert isinstance(mongo_handler, MongoHandler)
         assert n_writers > 0
@@ -40,25 +52,37 @@ class MultiOplogReplayer(object):
         self._count = 0
         self._last_optime = None
         self._last_apply_time = time.time()
+        self._memory = memory or MemoryAccount()
+        self._tracer = tracer or Tracer(0)
+        self._traces = {}  # ns => traces of sampled oplogs
 
     def clear(self):
         """ Clear oplogs.
         """
         self._map.clear()
+        self._traces.clear()
         self._count = 0
+        self._memory.release_buffer('oplog_replayer')
 
-    def push(self, oplog):
+    def push(self, oplog, trace=None):
         """ Push oplog and group by namespace.
         """
         ns = oplog['ns']
         if ns not in self._map:
             self._map[ns] = []
         self._map[ns].append(oplog)
+        self._memory.add('oplog_replayer', ns, oplog['o'])
+        if trace:
+            self._traces.setdefault(ns, []).append(trace)
         self._count += 1
         self._last_optime = oplog['ts']
 
-    def apply(self, ignore_duplicate_key_error=False, print_log=False):
+    def apply(self, ignore_duplicate_key_error=False, print_log=False, plain_insert=False):
         """ Apply oplogs.
+
+        Parameter:
+          - plain_insert: write runs of inserts with unordered InsertOne and upsert only on conflict,
+                          it's safe once stage oplog_sync is reached
         """
         oplog_vecs = []
         for ns, oplogs in self._map.iteritems():
@@ -70,7 +94,9 @@ class MultiOplogReplayer(object):
                 op = self.__convert(oplog)
                 assert op is not None
                 vec._oplogs.append(op)
+            vec._traces = self._traces.get(ns, [])
             oplog_vecs.append(vec)
+            profiler.lap('replay_oplog', 'convert')
             # else:
             #     vecs = [OplogVector(dbname, collname) for i in xrange(n)]
             #     for oplog in oplogs:
@@ -82,17 +108,34 @@ class MultiOplogReplayer(object):
             #         vecs[m % n]._oplogs.append(op)
             #     oplog_vecs.extend(vecs)
         # start_time = time.time()
+        for traces in self._traces.itervalues():
+            self._tracer.submit(traces)
         for vec in oplog_vecs:
             if vec._oplogs:
-                self._pool.spawn(self._mongo_handler.bulk_write,
-                                 vec._dbname,
-                                 vec._collname,
-                                 vec._oplogs,
-                                 ignore_duplicate_key_error=ignore_duplicate_key_error, print_log=print_log)
-        self._pool.join()
+                self._pool.spawn(self._apply_vector,
+                                 vec,
+                                 ignore_duplicate_key_error=ignore_duplicate_key_error,
+                                 print_log=print_log,
+                                 plain_insert=plain_insert)
+        # a failed vector must not be taken as applied
+        self._pool.join(raise_error=True)
         # log.info('Apply takes %f seconds' % (time.time() - start_time))
         self._last_apply_time = time.time()
 
+    def _apply_vector(self, vec, ignore_duplicate_key_error=False, print_log=False, plain_insert=False):
+        """ Apply operations of a namespace in order.
+        """
+        for reqs, is_plain_insert in self.__optimize(vec._oplogs, plain_insert):
+            if is_plain_insert:
+                self._mongo_handler.bulk_insert(vec._dbname, vec._collname, reqs, print_log=print_log)
+            else:
+                self._mongo_handler.bulk_write(vec._dbname,
+                                               vec._collname,
+                                               reqs,
+                                               ignore_duplicate_key_error=ignore_duplicate_key_error,
+                                               print_log=print_log)
+        self._tracer.ack(vec._traces)
+
     def count(self):
         """ Return count of oplogs.
         """
@@ -123,13 +166,54 @@ class MultiOplogReplayer(object):
             else:
                 return pymongo.operations.ReplaceOne({'_id': oplog['o2']['_id']}, oplog['o'], upsert=True)
         elif op == 'i':
-            return pymongo.operations.ReplaceOne({'_id': oplog['o']['_id']}, oplog['o'], upsert=True)
+            return _Insert({'_id': oplog['o']['_id']}, oplog['o'], upsert=True)
         elif op == 'd':
             return pymongo.operations.DeleteOne({'_id': oplog['o']['_id']})
         else:
             log.error('invaid op: %s' % oplog)
             return None
 
+    @staticmethod
+    def __optimize(reqs, plain_insert):
+        """ Rewrite operations to reduce statements executed by server.
+
+        - a run of DeleteOne is merged into a DeleteMany with '$in'
+        - a run of inserts is written with InsertOne in a separate unordered batch if plain_insert is True
+
+        Return a list of tuple (reqs, is_plain_insert), which should be applied in order.
+        """
+        segments = []
+        reqs_curr = []
+        i = 0
+        n = len(reqs)
+        while i < n:
+            req = reqs[i]
+            if isinstance(req, pymongo.operations.DeleteOne):
+                j = i
+                while j < n and isinstance(reqs[j], pymongo.operations.DeleteOne):
+                    j += 1
+                if j - i > 1:
+                    ids = [r._filter['_id'] for r in reqs[i:j]]
+                    reqs_curr.append(pymongo.operations.DeleteMany({'_id': {'$in': ids}}))
+                else:
+                    reqs_curr.append(req)
+                i = j
+            elif plain_insert and isinstance(req, _Insert):
+                j = i
+                while j < n and isinstance(reqs[j], _Insert):
+                    j += 1
+                if reqs_curr:
+                    segments.append((reqs_curr, False))
+                    reqs_curr = []
+                segments.append(([pymongo.operations.InsertOne(r._doc) for r in reqs[i:j]], True))
+                i = j
+            else:
+                reqs_curr.append(req)
+                i += 1
+        if reqs_curr:
+            segments.append((reqs_curr, False))
+        return segments
+
     def __hash(self, oid):
         """ Hash ObjectID with murmurhash3.
         """
@@ -1,10 +1,50 @@
 import os
+import mmap
 import struct
+import zlib
+import collections
 from bson.timestamp import Timestamp
 
+# A checkpoint is kept in two slots written alternately, so that a torn write never breaks the last one.
+# slot: magic, sequence, optime, stage, initial sync end optime, crc32 of the previous fields
+_MAGIC = 'MSCP'
+_SLOT = struct.Struct('<4sQIIIII')
+_CRC = struct.Struct('<I')
+_SLOT_SIZE = 64
+_FILE_SIZE = _SLOT_SIZE * 2
+_LEGACY_FILE_SIZE = 8  # optime only
+
+Checkpoint = collections.namedtuple('Checkpoint', ['seq', 'optime', 'stage', 'end_optime'])
+
+
+def _pack_slot(seq, optime, stage, end_optime):
+    if end_optime is None:
+        end_optime = Timestamp(0, 0)
+    data = _SLOT.pack(_MAGIC, seq, optime.time, optime.inc, stage, end_optime.time, end_optime.inc)
+    return data + _CRC.pack(zlib.crc32(data) & 0xffffffff)
+
+
+def _unpack_slot(buf):
+    """ Return checkpoint if the slot is valid else None.
+    """
+    data = buf[:_SLOT.size]
+    crc = _CRC.unpack(buf[_SLOT.size:_SLOT.size + _CRC.size])[0]
+    if zlib.crc32(data) & 0xffffffff != crc:
+        return None
+    magic, seq, time, inc, stage, end_time, end_inc = _SLOT.unpack(data)
+    if magic != _MAGIC:
+        return None
+    end_optime = Timestamp(end_time, end_inc) if end_time or end_inc else None
+    return Checkpoint(seq, Timestamp(time, inc), stage, end_optime)
+
 
 class OptimeLogger(object):
-    """ Record optime in file.
+    """ Record checkpoint in file.
+
+    The file is memory mapped and synced to disk on every write, which costs about one page write.
+    A checkpoint contains the optime, the stage and the end optime of initial sync.
+    A file of the legacy format that only contains an 8-byte optime is still readable,
+    and converted on the first write.
     """
     def __init__(self, filepath):
         assert filepath
@@ -14,30 +54,69 @@ class OptimeLogger(object):
         assert os.path.isfile(filepath)
         self._filepath = filepath
         self._fd = open(filepath, 'rb+')
+        self._mm = None
+        self._last = None  # the last checkpoint written
 
     def __del__(self):
+        if self._mm:
+            self._mm.close()
         self._fd.close()
 
-    def write(self, optime):
-        """ Write optime.
+    def write(self, optime, stage=0, end_optime=None):
+        """ Write checkpoint into the older slot and sync it to disk.
         """
-        self._fd.seek(0, os.SEEK_SET)
-        time_data = struct.pack('I', optime.time)
-        inc_data = struct.pack('I', optime.inc)
-        self._fd.write(time_data)
-        self._fd.write(inc_data)
-        self._fd.flush()
+        if self._mm is None:
+            self._open_map()
+        seq = self._last.seq + 1 if self._last else 1
+        checkpoint = Checkpoint(seq, optime, stage, end_optime)
+        if self._last and self._last[1:] == checkpoint[1:]:
+            return
+        offset = (seq % 2) * _SLOT_SIZE
+        data = _pack_slot(*checkpoint)
+        self._mm[offset:offset + len(data)] = data
+        self._mm.flush()
+        self._last = checkpoint
 
     def read(self):
         """ Read optime.
         Return optime if OK else None.
         """
-        if self.filesize != 8:
-            return None
+        checkpoint = self.read_checkpoint()
+        return checkpoint.optime if checkpoint else None
+
+    def read_checkpoint(self):
+        """ Read the latest valid checkpoint.
+        Return checkpoint if OK else None.
+        """
+        filesize = self.filesize
         self._fd.seek(0, os.SEEK_SET)
-        time = struct.unpack('I', self._fd.read(4))[0]
-        inc = struct.unpack('I', self._fd.read(4))[0]
-        return Timestamp(time, inc)
+        if filesize == _LEGACY_FILE_SIZE:
+            time = struct.unpack('I', self._fd.read(4))[0]
+            inc = struct.unpack('I', self._fd.read(4))[0]
+            return Checkpoint(0, Timestamp(time, inc), 0, None)
+        if filesize != _FILE_SIZE:
+            return None
+        buf = self._fd.read(_FILE_SIZE)
+        checkpoints = [cp for cp in (_unpack_slot(buf[:_SLOT_SIZE]), _unpack_slot(buf[_SLOT_SIZE:])) if cp]
+        if not checkpoints:
+            return None
+        return max(checkpoints, key=lambda cp: cp.seq)
+
+    def _open_map(self):
+        """ Map the file, initialize it with the existing checkpoint if not in the current format.
+        """
+        self._last = self.read_checkpoint()
+        if self.filesize != _FILE_SIZE:
+            buf = bytearray(_FILE_SIZE)
+            if self._last:
+                data = _pack_slot(*self._last)
+                buf[:len(data)] = data
+            self._fd.seek(0, os.SEEK_SET)
+            self._fd.write(buf)
+            self._fd.truncate(_FILE_SIZE)
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+        self._mm = mmap.mmap(self._fd.fileno(), _FILE_SIZE)
 
     @property
     def filesize(self):
@@ -54,25 +133,48 @@ class OptimeLogger(object):
 
 
 if __name__ == '__main__':
+    for filepath in ('optimelog.tmp.0', 'optimelog.tmp.1', 'optimelog.tmp.emtpy', 'optimelog.tmp.legacy'):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
     optime_logger = OptimeLogger('optimelog.tmp.0')
     optime_logger.write(Timestamp(0, 1))
     optime = optime_logger.read()
     assert optime is not None
     assert optime.time == 0
     assert optime.inc == 1
-    assert optime_logger.filesize == 8
+    assert optime_logger.filesize == _FILE_SIZE
 
     optime_logger = OptimeLogger('optimelog.tmp.1')
     optime_logger.write(Timestamp(4294967295, 2))
+    optime_logger.write(Timestamp(4294967295, 3), 2, Timestamp(4294967295, 5))
     optime_logger = OptimeLogger('optimelog.tmp.1')
-    optime = optime_logger.read()
-    assert optime is not None
-    assert optime.time == 4294967295
-    assert optime.inc == 2
-    assert optime_logger.filesize == 8
+    checkpoint = optime_logger.read_checkpoint()
+    assert checkpoint.optime == Timestamp(4294967295, 3)
+    assert checkpoint.stage == 2
+    assert checkpoint.end_optime == Timestamp(4294967295, 5)
+
+    # torn write of the newer slot falls back to the older one
+    with open('optimelog.tmp.1', 'rb+') as f:
+        f.seek(0)
+        f.write('\xff')
+    optime_logger = OptimeLogger('optimelog.tmp.1')
+    checkpoint = optime_logger.read_checkpoint()
+    assert checkpoint.seq == 1 and checkpoint.optime == Timestamp(4294967295, 2)
+    optime_logger.write(Timestamp(4294967295, 6))
+    assert optime_logger.read_checkpoint().seq == 2
+    assert optime_logger.read() == Timestamp(4294967295, 6)
 
     optime_logger = OptimeLogger('optimelog.tmp.emtpy')
     optime = optime_logger.read()
     assert optime is None
     assert optime_logger.filesize == 0
+
+    with open('optimelog.tmp.legacy', 'wb') as f:
+        f.write(struct.pack('I', 7) + struct.pack('I', 8))
+    optime_logger = OptimeLogger('optimelog.tmp.legacy')
+    assert optime_logger.read() == Timestamp(7, 8)
+    optime_logger.write(Timestamp(7, 9))
+    assert optime_logger.filesize == _FILE_SIZE
+    assert optime_logger.read() == Timestamp(7, 9)
     print('test pass')
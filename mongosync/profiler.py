@@ -0,0 +1,134 @@
+import os
+import time
+import signal
+import weakref
+import collections
+import greenlet
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+_interval = 0.005  # seconds of CPU time between samples
+_output_dir = '.'
+_enabled = False
+_start_time = None
+_samples = collections.Counter()  # collapsed stack => count
+_phases = collections.defaultdict(collections.Counter)  # timer name => phase => seconds
+_last_laps = weakref.WeakKeyDictionary()  # greenlet => timer name => time of the last lap
+
+
+def lap(name, phase):
+    """ Add the time since the last lap of the timer in current greenlet to the phase.
+
+    e.g.:
+
+    lap('replay_oplog', 'fetch')
+    lap('replay_oplog', 'filter')
+
+    It does nothing if the profiler is off.
+    """
+    if not _enabled:
+        return
+    now = time.time()
+    laps = _last_laps.get(greenlet.getcurrent())
+    if laps is None:
+        laps = _last_laps[greenlet.getcurrent()] = {}
+    last = laps.get(name)
+    if last is not None:
+        _phases[name][phase] += now - last
+    laps[name] = now
+
+
+def _sample(signum, frame):
+    """ Record the stack of the running greenlet.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%d:%s' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    stack.append('main' if greenlet.getcurrent().parent is None else 'greenlet')
+    stack.reverse()
+    _samples[';'.join(stack)] += 1
+
+
+def enable():
+    """ Start sampling and phase timers.
+    """
+    global _enabled, _start_time
+    if _enabled:
+        return
+    _samples.clear()
+    _phases.clear()
+    _last_laps.clear()
+    _start_time = time.time()
+    signal.signal(signal.SIGPROF, _sample)
+    # restart interrupted system calls
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, _interval, _interval)
+    _enabled = True
+    log.info('profiler on, sample every %.3fs of CPU time' % _interval)
+
+
+def disable():
+    """ Stop sampling, write collapsed stacks into file and log phase timers.
+    Return the summary.
+    """
+    global _enabled
+    if not _enabled:
+        return 'profiler is off'
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    signal.signal(signal.SIGPROF, signal.SIG_IGN)
+    _enabled = False
+
+    filepath = os.path.join(_output_dir, 'mongosync-profile-%d-%s.collapsed' % (
+        os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(_start_time))))
+    with open(filepath, 'w') as f:
+        for stack, count in _samples.most_common():
+            f.write('%s %d\n' % (stack, count))
+
+    lines = ['profiler off, %d samples in %.1fs written into %s' % (
+        sum(_samples.itervalues()), time.time() - _start_time, filepath)]
+    for name, phases in sorted(_phases.iteritems()):
+        total = sum(phases.itervalues())
+        lines.append('%s: %s' % (name, ', '.join('%s %.3fs (%.1f%%)' % (phase, secs, secs / total * 100 if total else 0)
+                                                 for phase, secs in phases.most_common())))
+    summary = '\n'.join(lines)
+    for line in lines:
+        log.info(line)
+    return summary
+
+
+def toggle():
+    """ Switch the profiler on or off.
+    """
+    if _enabled:
+        return disable()
+    enable()
+    return 'profiler on'
+
+
+def install(signum=signal.SIGUSR2, output_dir='.'):
+    """ Toggle the profiler on signal, and write files into output_dir.
+    """
+    global _output_dir
+    _output_dir = output_dir
+    signal.signal(signum, lambda s, f: toggle())
+
+
+if __name__ == '__main__':
+    _output_dir = '/tmp'
+    lap('test', 'a')
+    assert not _phases
+    enable()
+    lap('test', 'a')
+    n = 0
+    t = time.time()
+    while time.time() - t < 0.2:
+        n += 1
+    lap('test', 'b')
+    summary = disable()
+    assert _phases['test']['b'] > 0.1 and 'a' not in _phases['test']
+    assert sum(_samples.itervalues()) > 0
+    assert 'test: b' in summary
+    print('test cases all pass')
@@ -1,142 +1,185 @@
 import sys
 import time
-import multiprocessing
+import datetime
+import collections
 import threading
-import Queue
+from mongosync import metrics
 from mongosync.logger import Logger
 
 log = Logger.get()
 
 
-class Message(object):
-    """ Progress change message.
-    """
-    def __init__(self, ns, cnt, done):
-        self.ns = ns
-        self.cnt = cnt
-        self.done = done
-
-
 class Progress(object):
-    """ Progress attibutes.
+    """ Progress of a collection.
+
+    Documents are counted into series of shared metrics, so that processes forked after registration
+    count into the same place without messages.
     """
-    def __init__(self, ns, total):
+    def __init__(self, ns, total, avg_obj_size):
         self.ns = ns
-        self.curr = 0
         self.total = total
-        self.start_time = time.time()
-        self.done = False
+        self.avg_obj_size = avg_obj_size
+        self.docs = metrics.INITIAL_SYNC_DOCS.labels(ns)
+        self.bytes = metrics.INITIAL_SYNC_BYTES.labels(ns)
+        self.start_time = None
+        self.end_time = None
+        self.samples = collections.deque()  # (time, docs, bytes) in rate window
 
+    @property
+    def started(self):
+        return self.start_time is not None
 
-class LoggerThread(threading.Thread):
-    """ Logger thread.
-    """
-    def __init__(self, n_colls, **kwargs):
-        self._n_colls = n_colls
-        self._q = Queue.Queue()
-        self._ns_map = {}
-        super(LoggerThread, self).__init__(**kwargs)
+    @property
+    def done(self):
+        return self.end_time is not None
 
-    def run(self):
-        n_colls_done = 0
-        while n_colls_done < self._n_colls:
-            m = self._q.get()
-            if m.ns not in self._ns_map:
-                raise Exception('missing namespace: %s' % m.ns)
-            self._ns_map[m.ns].curr += m.cnt
-            prog = self._ns_map[m.ns]
-            s = '\t%s\t%d/%d\t[%.2f%%]' % (
-                    prog.ns,
-                    prog.curr,
-                    prog.total,
-                    float(prog.curr)/prog.total*100 if prog.total > 0 else float(prog.curr+1)/(prog.total+1)*100)
-
-            if not m.done:
-                log.info(s)
-            else:
-                log.info('[ OK ] ' + s)
-                n_colls_done += 1
-                time_used = time.time() - prog.start_time
-                sys.stdout.write('\r\33[K')
-                sys.stdout.write('\r[\033[32m OK \033[0m]\t[%d/%d]\t%s\t%d/%d\t%.1fs\n' % (n_colls_done, self._n_colls, m.ns, prog.curr, prog.total, time_used))
-                sys.stdout.flush()
-                del self._ns_map[m.ns]
-
-            # s = ''
-            # for ns, prog in self._ns_map.iteritems():
-            #     s += '|| %s  %d/%d  %.1f%% ' % (ns, prog.curr, prog.total, float(prog.curr)/prog.total*100)
-            # if len(s) > 0:
-            #     s += '||'
-            #     sys.stdout.write('\r%s' % s)
-            #     sys.stdout.flush()
 
-        log.info('ProgressLogger thread %s exit' % threading.currentThread().name)
+class ProgressLogger(threading.Thread):
+    """ Log docs/s, bytes/s and ETA of initial sync for each collection and overall.
 
-    def register(self, ns, total):
+    Rates are measured over the recent window, and also exposed as metrics.
+    Bytes are estimated by average object size of collection.
+    """
+    def __init__(self, n_colls, interval=10, window=60, **kwargs):
+        super(ProgressLogger, self).__init__(**kwargs)
+        self.daemon = True
+        self._n_colls = n_colls
+        self._interval = interval
+        self._window = window
+        self._progress = collections.OrderedDict()  # ns => progress
+        self._samples = collections.deque()  # overall (time, docs, bytes) in rate window
+        self._start_time = time.time()
+        self._n_colls_done = 0
+
+    def register(self, ns, total, avg_obj_size=0):
         """ Register collection.
+        It must be called before forking processes that sync the collection.
         """
-        if ns in self._ns_map:
+        if ns in self._progress:
             raise Exception('duplicate collection %s' % ns)
-        self._ns_map[ns] = Progress(ns, total)
+        self._progress[ns] = Progress(ns, total, avg_obj_size)
+        metrics.INITIAL_SYNC_TOTAL_DOCS.labels(ns).set(total)
 
-    def add(self, ns, count, done=False):
-        """ Update progress.
+    def avg_obj_size(self, ns):
+        """ Return average object size of collection, 0 if unknown.
         """
-        self._q.put(Message(ns, count, done))
+        return self._progress[ns].avg_obj_size
 
+    def begin(self, ns):
+        """ Mark collection started.
+        """
+        self._progress[ns].start_time = time.time()
 
-class LoggerProcess(multiprocessing.Process):
-    """ Logger progress.
-    """
-    def __init__(self, n_colls, **kwargs):
-        self._n_colls = n_colls
-        self._q = multiprocessing.Queue()
-        self._ns_map = multiprocessing.Manager().dict()
-        super(LoggerProcess, self).__init__(**kwargs)
+    def add(self, ns, n_docs):
+        """ Count documents copied.
+        """
+        prog = self._progress[ns]
+        prog.docs.inc(n_docs)
+        if prog.avg_obj_size:
+            prog.bytes.inc(n_docs * prog.avg_obj_size)
 
-    def run(self):
-        n_colls_done = 0
-        while n_colls_done < self._n_colls:
-            m = self._q.get()
-            if m.ns not in self._ns_map:
-                raise Exception('missing namespace: %s' % m.ns)
-            self._ns_map[m.ns].curr += m.cnt
-            prog = self._ns_map[m.ns]
-            s = '\t%s\t%d/%d\t[%.2f%%]' % (
-                    prog.ns,
-                    prog.curr,
-                    prog.total,
-                    float(prog.curr)/prog.total*100 if prog.total > 0 else float(prog.curr+1)/(prog.total+1)*100)
-
-            if not m.done:
-                log.info(s)
-            else:
-                log.info('[ OK ] ' + s)
-                n_colls_done += 1
-                time_used = time.time() - prog.start_time
-                sys.stdout.write('\r\33[K')
-                sys.stdout.write('\r[\033[32m OK \033[0m]\t[%d/%d]\t%s\t%d/%d\t%.1fs\n' % (n_colls_done, self._n_colls, m.ns, prog.curr, prog.total, time_used))
-                sys.stdout.flush()
-                del self._ns_map[m.ns]
-
-            # s = ''
-            # for ns, prog in self._ns_map.iteritems():
-            #     s += '|| %s  %d/%d  %.1f%% ' % (ns, prog.curr, prog.total, float(prog.curr)/prog.total*100)
-            # if len(s) > 0:
-            #     s += '||'
-            #     sys.stdout.write('\r%s' % s)
-            #     sys.stdout.flush()
-
-        log.info('ProgressLogger process %s exit' % multiprocessing.current_process().name)
-
-    def register(self, ns, total):
-        """ Register collection.
+    def done(self, ns):
+        """ Mark collection done.
         """
-        if ns in self._ns_map:
-            raise Exception('duplicate collection %s' % ns)
-        self._ns_map[ns] = Progress(ns, total)
+        prog = self._progress[ns]
+        prog.end_time = time.time()
+        self._n_colls_done += 1
+        docs = prog.docs.value
+        time_used = prog.end_time - prog.start_time if prog.started else 0
+        log.info('[ OK ] \t%s\t%d/%d\t%.1fs\t%.0f docs/s' % (
+            ns, docs, prog.total, time_used, docs / time_used if time_used > 0 else 0))
+        sys.stdout.write('\r\33[K')
+        sys.stdout.write('\r[\033[32m OK \033[0m]\t[%d/%d]\t%s\t%d/%d\t%.1fs\n' % (
+            self._n_colls_done, self._n_colls, ns, docs, prog.total, time_used))
+        sys.stdout.flush()
+        self._set_metrics(ns, 0, 0, 0)
 
-    def add(self, ns, count, done=False):
-        """ Update progress.
+    def run(self):
+        while self._n_colls_done < self._n_colls:
+            time.sleep(self._interval)
+            self.report()
+        log.info('ProgressLogger thread %s exit' % threading.currentThread().name)
+
+    def report(self):
+        """ Sample counters, log and expose rates and ETA.
+        """
+        now = time.time()
+        total_docs = 0
+        total_bytes = 0
+        n_remaining = 0
+        for ns, prog in self._progress.iteritems():
+            docs = prog.docs.value
+            bytes = prog.bytes.value
+            total_docs += docs
+            total_bytes += bytes
+            if prog.done:
+                continue
+            n_remaining += max(prog.total - docs, 0)
+            if not prog.started:
+                continue
+            docs_rate, bytes_rate = self._sample(prog.samples, now, docs, bytes)
+            eta = max(prog.total - docs, 0) / docs_rate if docs_rate > 0 else None
+            self._set_metrics(ns, docs_rate, bytes_rate, eta)
+            log.info('\t%s\t%d/%d\t[%.2f%%]\t%.0f docs/s\t%.2f MB/s\tETA %s' % (
+                ns, docs, prog.total, _percent(docs, prog.total), docs_rate, bytes_rate / 1024 / 1024,
+                _format_eta(eta)))
+
+        total = sum(prog.total for prog in self._progress.itervalues())
+        docs_rate, bytes_rate = self._sample(self._samples, now, total_docs, total_bytes)
+        eta = n_remaining / docs_rate if docs_rate > 0 else None
+        self._set_metrics('*', docs_rate, bytes_rate, eta)
+        log.info('overall\t[%d/%d] collections\t%d/%d\t[%.2f%%]\t%.0f docs/s\t%.2f MB/s\tETA %s\t%.1fs elapsed' % (
+            self._n_colls_done, self._n_colls, total_docs, total, _percent(total_docs, total),
+            docs_rate, bytes_rate / 1024 / 1024, _format_eta(eta), now - self._start_time))
+
+    def _sample(self, samples, now, docs, bytes):
+        """ Add sample and return docs/s and bytes/s over the window.
         """
-        self._q.put(Message(ns, count, done))
+        samples.append((now, docs, bytes))
+        # keep the newest sample out of window as the base
+        while len(samples) > 2 and samples[1][0] <= now - self._window:
+            samples.popleft()
+        t0, docs0, bytes0 = samples[0]
+        if now <= t0:
+            return 0.0, 0.0
+        return (docs - docs0) / (now - t0), (bytes - bytes0) / (now - t0)
+
+    @staticmethod
+    def _set_metrics(ns, docs_rate, bytes_rate, eta):
+        metrics.INITIAL_SYNC_DOCS_RATE.labels(ns).set(docs_rate)
+        metrics.INITIAL_SYNC_BYTES_RATE.labels(ns).set(bytes_rate)
+        metrics.INITIAL_SYNC_ETA.labels(ns).set(eta if eta is not None else -1)
+
+
+def _percent(curr, total):
+    return float(curr) / total * 100 if total > 0 else 100.0
+
+
+def _format_eta(eta):
+    if eta is None:
+        return '-'
+    return str(datetime.timedelta(seconds=int(eta)))
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    progress_logger = ProgressLogger(2, interval=0.1)
+    progress_logger.register('db.coll0', 100, 10)
+    progress_logger.register('db.coll1', 50)
+    progress_logger.begin('db.coll0')
+    progress_logger.report()
+    p = multiprocessing.Process(target=progress_logger.add, args=('db.coll0', 40))
+    p.start()
+    p.join()
+    time.sleep(0.1)
+    progress_logger.report()
+    assert progress_logger._progress['db.coll0'].docs.value == 40
+    assert progress_logger._progress['db.coll0'].bytes.value == 400
+    assert metrics.INITIAL_SYNC_DOCS_RATE.labels('db.coll0').value > 0
+    assert 0 < metrics.INITIAL_SYNC_ETA.labels('db.coll0').value < 1
+    assert 'db.coll1' not in metrics.INITIAL_SYNC_ETA._series
+    progress_logger.add('db.coll0', 60)
+    progress_logger.done('db.coll0')
+    assert metrics.INITIAL_SYNC_ETA.labels('db.coll0').value == 0
+    assert _format_eta(3725.5) == '1:02:05'
+    print('test cases all pass')
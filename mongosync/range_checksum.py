@@ -0,0 +1,150 @@
+import hashlib
+import bson
+import gevent
+import gevent.pool
+import pymongo
+from bson import json_util
+from mongosync.mongo_utils import split_coll, gen_namespace, RAW_CODEC_OPTIONS
+
+
+def id_key(_id):
+    """ Return hashable key of _id, which might be a document.
+    """
+    return bson.BSON.encode({'_id': _id})
+
+
+def differ(doc0, doc1):
+    """ Check if raw documents differ, either might be None if not found.
+    """
+    if doc0 is None or doc1 is None:
+        return doc0 is not doc1
+    return doc0.raw != doc1.raw
+
+
+def gen_ranges(split_points):
+    """ Generate _id ranges [lower, upper) by split points, None for unbounded.
+    """
+    bounds = [None] + list(split_points) + [None]
+    return [(bounds[i], bounds[i + 1]) for i in xrange(len(bounds) - 1)]
+
+
+def range_query(lower, upper):
+    """ Generate query of _id range [lower, upper), as partitions of initial sync do.
+    """
+    cond = {}
+    if lower is not None:
+        cond['$gte'] = lower
+    if upper is not None:
+        cond['$lt'] = upper
+    return {'_id': cond} if cond else {}
+
+
+def checksum(coll, lower, upper):
+    """ Return (count, md5 hexdigest of BSON bytes) of documents in _id range in _id order.
+    """
+    md5 = hashlib.md5()
+    n = 0
+    cursor = coll.with_options(codec_options=RAW_CODEC_OPTIONS).find(
+        range_query(lower, upper), sort=[('_id', pymongo.ASCENDING)], batch_size=1000)
+    for doc in cursor:
+        md5.update(doc.raw)
+        n += 1
+    return n, md5.hexdigest()
+
+
+def checksum_both(src_coll, dst_coll, lower, upper):
+    """ Checksum a range on source and destination concurrently.
+    Return (source checksum, destination checksum).
+    """
+    g = gevent.spawn(checksum, dst_coll, lower, upper)
+    src_res = checksum(src_coll, lower, upper)
+    return src_res, g.get()
+
+
+class RangeChecker(object):
+    """ Compare collections by checksums of _id ranges.
+
+    A collection is split into ranges by splitVector on source, as initial sync does,
+    then count and hash of BSON bytes of each range are computed on source and destination concurrently.
+    Documents must be written with the same field order on both sides, which is true for synced documents.
+    """
+    def __init__(self, src_mc, dst_mc, n_partitions=16, concurrency=16):
+        self._src_mc = src_mc
+        self._dst_mc = dst_mc
+        self._n_partitions = n_partitions
+        self._pool = gevent.pool.Pool(concurrency)
+
+    def split(self, dbname, collname):
+        """ Return _id ranges of a source collection.
+        """
+        if self._n_partitions <= 1:
+            return gen_ranges([])
+        try:
+            points = split_coll(self._src_mc[dbname], collname, self._n_partitions)
+        except pymongo.errors.OperationFailure:
+            # no privilege of splitVector, check as a whole
+            points = []
+        return gen_ranges(points)
+
+    def check_coll(self, dbname, collname, dst_dbname=None):
+        """ Check all ranges of a collection.
+        Return a list of results, mismatched or not.
+        """
+        return self.check_colls([(dbname, collname, dst_dbname or dbname)])
+
+    def check_colls(self, colls):
+        """ Check ranges of collections [(dbname, collname, dst_dbname)] with shared concurrency.
+        Return a list of results, mismatched or not.
+        """
+        greenlets = []
+        for dbname, collname, dst_dbname in colls:
+            for lower, upper in self.split(dbname, collname):
+                greenlets.append(self._pool.spawn(self.check_range, dbname, collname, dst_dbname, lower, upper))
+        gevent.joinall(greenlets, raise_error=True)
+        return [g.value for g in greenlets]
+
+    def check_range(self, dbname, collname, dst_dbname, lower, upper):
+        """ Check a range, return a result.
+        """
+        (src_count, src_md5), (dst_count, dst_md5) = checksum_both(
+            self._src_mc[dbname][collname], self._dst_mc[dst_dbname][collname], lower, upper)
+        return {'ns': gen_namespace(dbname, collname),
+                'dst_ns': gen_namespace(dst_dbname, collname),
+                'lower': lower,
+                'upper': upper,
+                'src_count': src_count,
+                'dst_count': dst_count,
+                'src_md5': src_md5,
+                'dst_md5': dst_md5,
+                'match': src_count == dst_count and src_md5 == dst_md5}
+
+
+def dump_ranges(results, filepath):
+    """ Write results into a JSON file, _id bounds in MongoDB extended JSON.
+    """
+    with open(filepath, 'w') as f:
+        f.write(json_util.dumps(results, indent=2, sort_keys=True))
+
+
+def load_ranges(filepath):
+    """ Load results from a JSON file written by dump_ranges.
+    """
+    with open(filepath) as f:
+        return json_util.loads(f.read())
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from bson.objectid import ObjectId
+    assert gen_ranges([]) == [(None, None)]
+    assert gen_ranges([1, 5]) == [(None, 1), (1, 5), (5, None)]
+    assert range_query(None, None) == {}
+    assert range_query(None, 1) == {'_id': {'$lt': 1}}
+    assert range_query(1, 5) == {'_id': {'$gte': 1, '$lt': 5}}
+    oid = ObjectId()
+    filepath = tempfile.mktemp()
+    dump_ranges([{'ns': 'db.coll', 'lower': oid, 'upper': None, 'match': False}], filepath)
+    assert load_ranges(filepath) == [{'ns': 'db.coll', 'lower': oid, 'upper': None, 'match': False}]
+    os.remove(filepath)
+    print('test cases all pass')
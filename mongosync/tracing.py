@@ -0,0 +1,118 @@
+import time
+import collections
+from mongosync import metrics
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+STAGES = ('fetch', 'batch', 'apply', 'total')
+
+
+class Trace(object):
+    """ Times of a sampled oplog.
+    """
+    __slots__ = ('ns', 'write_time', 'read_time', 'submit_time')
+
+    def __init__(self, ns, write_time, read_time):
+        self.ns = ns
+        self.write_time = write_time  # optime on source, in seconds
+        self.read_time = read_time
+        self.submit_time = None
+
+
+class Tracer(object):
+    """ Trace a sample of oplogs from source to destination.
+
+    Every n-th oplog read is traced through the stages:
+      - fetch: from written on source to read
+      - batch: from read to its batch submitted
+      - apply: from submitted to acknowledged by destination
+      - total: from written on source to acknowledged
+
+    Latencies are observed into histograms by namespace and stage, and averages are logged periodically.
+    The source write time is the optime, so fetch and total have a resolution of one second,
+    and include clock skew between source and local.
+    """
+    def __init__(self, sample_every=1000, log_interval=60):
+        self._sample_every = sample_every
+        self._n = 0
+        self._histograms = {}  # (ns, stage) => histogram series
+        self._window = collections.defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0.0])  # ns => [n, sums of stages]
+        self._log_interval = log_interval
+        self._last_logtime = time.time()
+
+    @property
+    def enabled(self):
+        return self._sample_every > 0
+
+    def read(self, oplog):
+        """ Count oplog read, return a trace if sampled else None.
+        """
+        if not self._sample_every:
+            return None
+        self._n += 1
+        if self._n < self._sample_every:
+            return None
+        self._n = 0
+        return Trace(oplog['ns'], oplog['ts'].time, time.time())
+
+    def submit(self, traces):
+        """ Mark traces submitted to destination.
+        """
+        now = time.time()
+        for trace in traces:
+            if trace.submit_time is None:
+                trace.submit_time = now
+
+    def ack(self, traces):
+        """ Mark traces acknowledged by destination and observe latencies.
+        """
+        if not traces:
+            return
+        now = time.time()
+        for trace in traces:
+            submit_time = trace.submit_time if trace.submit_time is not None else now
+            latencies = (max(trace.read_time - trace.write_time, 0),
+                         submit_time - trace.read_time,
+                         now - submit_time,
+                         max(now - trace.write_time, 0))
+            window = self._window[trace.ns]
+            window[0] += 1
+            for i, stage in enumerate(STAGES):
+                self._histogram(trace.ns, stage).observe(latencies[i])
+                window[i + 1] += latencies[i]
+        if now - self._last_logtime >= self._log_interval:
+            self._last_logtime = now
+            self.log_summary()
+
+    def log_summary(self):
+        """ Log average latencies since the last summary, slowest namespace first.
+        """
+        for ns, window in sorted(self._window.iteritems(), key=lambda item: item[1][4] / item[1][0], reverse=True):
+            n = window[0]
+            log.info('latency of %s in %d sampled oplogs: %s' % (
+                ns, n, ', '.join('%s %.3fs' % (stage, window[i + 1] / n) for i, stage in enumerate(STAGES))))
+        self._window.clear()
+
+    def _histogram(self, ns, stage):
+        series = self._histograms.get((ns, stage))
+        if series is None:
+            series = self._histograms[(ns, stage)] = metrics.REPLICATION_LATENCY.labels(ns, stage)
+        return series
+
+
+if __name__ == '__main__':
+    from bson.timestamp import Timestamp
+    tracer = Tracer(sample_every=2, log_interval=0)
+    oplog = {'ns': 'db.coll', 'ts': Timestamp(int(time.time()) - 1, 1)}
+    assert tracer.read(oplog) is None
+    trace = tracer.read(oplog)
+    assert trace is not None and tracer.read(oplog) is None
+    tracer.submit([trace])
+    tracer.ack([trace])
+    assert not tracer._window
+    text = metrics.expose()
+    assert 'mongosync_replication_latency_seconds_count{ns="db.coll",stage="total"} 1\n' in text
+    assert 'mongosync_replication_latency_seconds_bucket{ns="db.coll",stage="apply",le="0.001"} 1\n' in text
+    assert not Tracer(sample_every=0).read(oplog)
+    print('test cases all pass')
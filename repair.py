@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# summary: repair mismatched _id ranges found by check.py --ranges
+# usage: python repair.py -f sync.toml --ranges mismatched_ranges.json [--optime-logfile FILE]
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+from mongosync.command_options import RepairCommandOptions
+from mongosync.config import MongoConfig
+from mongosync.logger import Logger
+from mongosync.range_checksum import load_ranges
+
+if __name__ == '__main__':
+    conf = RepairCommandOptions.parse()
+    Logger.init(conf.logfilepath)
+    log = Logger.get()
+
+    if not isinstance(conf.sync_conf.dst_conf, MongoConfig):
+        log.error('repair supports MongoDB destination only')
+        sys.exit(1)
+
+    from mongosync.mongo.handler import MongoHandler
+    from mongosync.mongo.repairer import RangeRepairer
+
+    src = MongoHandler(conf.sync_conf.src_conf)
+    if not src.connect():
+        log.error('connect to source failed')
+        sys.exit(1)
+    dst = MongoHandler(conf.sync_conf.dst_conf)
+    if not dst.connect():
+        log.error('connect to destination failed')
+        sys.exit(1)
+
+    results = load_ranges(conf.ranges_filepath)
+    log.info('repair %d ranges in %s' % (len(results), conf.ranges_filepath))
+    repairer = RangeRepairer(src, dst,
+                             leaf_docs=conf.leaf_docs,
+                             concurrency=conf.concurrency,
+                             rounds=conf.rounds,
+                             settle=conf.settle,
+                             optime_logfilepath=conf.optime_logfilepath,
+                             dry_run=conf.dry_run)
+    stats = repairer.repair(results)
+    sys.exit(1 if stats['unresolved'] else 0)
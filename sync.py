@@ -8,7 +8,9 @@
 from gevent import monkey
 monkey.patch_all()
 
+import os
 import sys
+from mongosync import memory, metrics, profiler
 from mongosync.command_options import CommandOptions
 from mongosync.config import MongoConfig, EsConfig
 from mongosync.logger import Logger
@@ -20,10 +22,19 @@ if __name__ == '__main__':
     conf.info(log)
     if conf.logfilepath:
         conf.info(sys.stdout)
+    if conf.metrics_port:
+        metrics_server = metrics.start_server(conf.metrics_port)
+    output_dir = os.path.dirname(os.path.abspath(conf.logfilepath)) if conf.logfilepath else '.'
+    profiler.install(output_dir=output_dir)
+    memory.install(output_dir=output_dir)
 
     if isinstance(conf.dst_conf, MongoConfig):
-        from mongosync.mongo.syncer import MongoSyncer
-        syncer = MongoSyncer(conf)
+        if conf.engine == 'pipeline':
+            from mongosync.mongo.pipeline_syncer import PipelineMongoSyncer
+            syncer = PipelineMongoSyncer(conf)
+        else:
+            from mongosync.mongo.syncer import MongoSyncer
+            syncer = MongoSyncer(conf)
         syncer.run()
     elif isinstance(conf.dst_conf, EsConfig):
         from mongosync.es.syncer import EsSyncer